@@ -0,0 +1,241 @@
+# Block averaging and GLM analysis of the ONAC block-design tasks.
+
+# Data are handled as arrays of shape (..., samples), e.g. (channels, samples) or (channels, chromophores, samples).
+# All leading dimensions are flattened into one "signal" axis so that every channel is processed by the same
+# NumPy call rather than in a Python loop.
+
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+from concurrent.futures import ProcessPoolExecutor
+from scipy.stats import gamma
+
+import numpy as np
+import os
+import time
+
+from motion_correction import tddr_chunked
+
+#%%%%%%%%%% Task designs %%%%%%%%%%
+# Timings (seconds) follow the task code in experiment/master_WV.py and experiment/broadbandNIRS.py.
+#       - object_recognition: 12 stimuli x 2.5s per block, preceded by a 5s baseline (block trigger 'C')
+#       - visual_stimulation: 10s of stimulation with 2s baselines either side
+#       - breath_holding: 20s holds with 20s baselines
+TASK_DESIGNS = {
+    'object_recognition': {'duration': 30.0, 'baseline': 5.0, 'post': 1.0},
+    'visual_stimulation': {'duration': 10.0, 'baseline': 2.0, 'post': 2.0},
+    'breath_holding': {'duration': 20.0, 'baseline': 20.0, 'post': 0.0},
+}
+
+#%%%%%%%%%% Analysis %%%%%%%%%%
+
+def canonical_hrf(fs, length=30.0, peak=6.0, undershoot=16.0, ratio=1/6):
+    """
+    Double-gamma canonical haemodynamic response function.
+
+    :param fs: Sampling frequency (Hz).
+    :param length: Length of the kernel in seconds.
+    :param peak: Time to peak of the response in seconds.
+    :param undershoot: Time to peak of the undershoot in seconds.
+    :param ratio: Ratio of undershoot to peak amplitude.
+    :return: Kernel normalised to unit sum.
+    """
+
+    t = np.arange(0, length, 1 / fs)
+    hrf = gamma.pdf(t, peak) - ratio * gamma.pdf(t, undershoot)
+    return hrf / hrf.sum()
+
+
+class BlockAnalysis:
+
+    def __init__(self, task, fs, design=None):
+        """
+        :param task: Name of the task, a key of TASK_DESIGNS.
+        :param fs: Sampling frequency of the recording (Hz).
+        :param design: Optional dictionary overriding the default task design.
+        """
+
+        if design is None:
+            if task not in TASK_DESIGNS:
+                raise ValueError('Unknown task: ' + str(task))
+            design = TASK_DESIGNS[task]
+        self.__task = task
+        self.__fs = fs
+        self.__duration = int(round(design['duration'] * fs))
+        self.__baseline = int(round(design['baseline'] * fs))
+        self.__post = int(round(design['post'] * fs))
+        self.__hrf = canonical_hrf(fs)
+
+    def __flatten(self, data):
+        data = np.asarray(data, dtype=float)
+        return data.reshape(-1, data.shape[-1]), data.shape[:-1]
+
+    def epochs(self, data, onsets):
+        """
+        Cuts event-locked epochs out of a continuous recording with a single fancy-indexing operation.
+
+        :param data: Array of shape (..., samples).
+        :param onsets: Onset sample of each block.
+        :return: Array of shape (blocks, ..., window) where window covers baseline, block and post-block period.
+        """
+
+        signals, shape = self.__flatten(data)
+        onsets = np.asarray(onsets, dtype=int)
+        window = np.arange(-self.__baseline, self.__duration + self.__post)
+        index = onsets[:, None] + window[None, :]
+        valid = (index[:, 0] >= 0) & (index[:, -1] < signals.shape[-1])
+        if not valid.all():
+            print(f'Dropping {np.sum(~valid)} block(s) that fall outside the recording')
+        epochs = signals[:, index[valid]]  # (signals, blocks, window)
+        return np.moveaxis(epochs, 1, 0).reshape((int(valid.sum()),) + shape + (len(window),))
+
+    def baseline_correct(self, epochs):
+        """
+        Subtracts the mean of the pre-block baseline from each epoch.
+
+        :param epochs: Array of shape (blocks, ..., window) as returned by epochs().
+        """
+
+        if self.__baseline == 0:
+            return epochs
+        return epochs - epochs[..., :self.__baseline].mean(axis=-1, keepdims=True)
+
+    def block_average(self, data, onsets, codes):
+        """
+        Computes baseline-corrected block averages for every condition.
+
+        :param data: Array of shape (..., samples).
+        :param onsets: Onset sample of each block.
+        :param codes: Trigger code (condition) of each block.
+        :return: Dictionary of condition -> (mean, standard error, number of blocks), with arrays of shape
+        (..., window).
+        """
+
+        onsets = np.asarray(onsets, dtype=int)
+        codes = np.asarray(codes)
+        averages = {}
+        for code in np.unique(codes):
+            epochs = self.baseline_correct(self.epochs(data, onsets[codes == code]))
+            n = epochs.shape[0]
+            if n == 0:
+                continue
+            sem = epochs.std(axis=0, ddof=1) / np.sqrt(n) if n > 1 else np.full(epochs.shape[1:], np.nan)
+            averages[str(code)] = (epochs.mean(axis=0), sem, n)
+        return averages
+
+    def design_matrix(self, n_samples, onsets, codes):
+        """
+        Builds a GLM design matrix with one HRF-convolved boxcar per condition, plus constant and linear drift terms.
+
+        :param n_samples: Number of samples in the recording.
+        :param onsets: Onset sample of each block.
+        :param codes: Trigger code (condition) of each block.
+        :return: Design matrix of shape (samples, regressors) and the list of regressor names.
+        """
+
+        onsets = np.asarray(onsets, dtype=int)
+        codes = np.asarray(codes)
+        conditions = list(np.unique(codes))
+        boxcars = np.zeros((n_samples, len(conditions)))
+        for i, condition in enumerate(conditions):
+            for onset in onsets[codes == condition]:
+                boxcars[max(onset, 0):min(onset + self.__duration, n_samples), i] = 1
+        regressors = np.apply_along_axis(lambda x: np.convolve(x, self.__hrf)[:n_samples], 0, boxcars)
+        drift = np.linspace(-1, 1, n_samples)
+        X = np.column_stack((regressors, np.ones(n_samples), drift))
+        return X, [str(c) for c in conditions] + ['constant', 'drift']
+
+    def glm(self, data, onsets, codes):
+        """
+        Estimates GLM betas for every channel at once using the pseudo-inverse of the design matrix.
+
+        :param data: Array of shape (..., samples).
+        :param onsets: Onset sample of each block.
+        :param codes: Trigger code (condition) of each block.
+        :return: Dictionary of regressor name -> betas with shape (...).
+        """
+
+        signals, shape = self.__flatten(data)
+        X, names = self.design_matrix(signals.shape[-1], onsets, codes)
+        betas = np.linalg.pinv(X) @ signals.T  # (regressors, signals)
+        return {name: betas[i].reshape(shape) for i, name in enumerate(names)}
+
+    def analyse(self, data, onsets, codes):
+        """
+        Runs the block average and GLM for one recording.
+        """
+
+        return {'averages': self.block_average(data, onsets, codes),
+                'betas': self.glm(data, onsets, codes)}
+
+
+#%%%%%%%%%% Cohort processing %%%%%%%%%%
+
+def _analyse_recording(args):
+    task, fs, recording, motion_correction = args
+    data = tddr_chunked(recording['data'], fs) if motion_correction else recording['data']
+    results = BlockAnalysis(task, fs).analyse(data, recording['onsets'], recording['codes'])
+    results['participant'] = recording['participant']
+    return results
+
+
+def analyse_cohort(recordings, task, fs, workers=None, motion_correction=False):
+    """
+    Analyses a cohort in parallel, one participant per process.
+
+    :param recordings: List of dictionaries with keys 'participant', 'data', 'onsets' and 'codes'.
+    :param task: Name of the task, a key of TASK_DESIGNS.
+    :param fs: Sampling frequency (Hz).
+    :param workers: Number of processes. Defaults to the number of cores.
+    :param motion_correction: Correct motion artefacts with TDDR (see motion_correction.py) before averaging, chunk
+                              by chunk so long recordings (and memory-mapped ones) are never corrected in one piece.
+    :return: List of results in the same order as recordings.
+    """
+
+    if workers is None:
+        workers = os.cpu_count()
+    jobs = [(task, fs, recording, motion_correction) for recording in recordings]
+    if workers == 1 or len(jobs) < 2:
+        return [_analyse_recording(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_analyse_recording, jobs))
+
+
+def simulate_recording(participant, task, fs, channels, n_blocks=10, seed=None):
+    """
+    Creates a synthetic recording with a known block response, used for benchmarking.
+    """
+
+    rng = np.random.default_rng(seed)
+    design = TASK_DESIGNS[task]
+    block = int((design['baseline'] + design['duration'] + design['post']) * fs)
+    n_samples = block * (n_blocks + 1)
+    onsets = np.arange(n_blocks) * block + int(design['baseline'] * fs)
+    codes = np.array(['A', 'B'])[np.arange(n_blocks) % 2]
+    analysis = BlockAnalysis(task, fs)
+    X, _ = analysis.design_matrix(n_samples, onsets, codes)
+    amplitudes = rng.normal(1, 0.2, size=(X.shape[1], channels))
+    data = (X @ amplitudes).T + rng.normal(0, 0.5, size=(channels, n_samples))
+    return {'participant': participant, 'data': data, 'onsets': onsets, 'codes': codes}
+
+
+def benchmark(participants=(4, 16), channels=(16, 64, 256), task='visual_stimulation', fs=10.0, workers=None):
+    """
+    Times the cohort analysis as the number of participants and channels grows.
+
+    :return: List of (participants, channels, seconds) tuples.
+    """
+
+    results = []
+    for n_participants in participants:
+        for n_channels in channels:
+            recordings = [simulate_recording('P' + str(p), task, fs, n_channels, seed=p) for p in range(n_participants)]
+            start = time.perf_counter()
+            analyse_cohort(recordings, task, fs, workers=workers)
+            elapsed = time.perf_counter() - start
+            print(f'{n_participants} participants x {n_channels} channels: {elapsed:.3f}s')
+            results.append((n_participants, n_channels, elapsed))
+    return results
+
+
+if __name__ == '__main__':
+    benchmark()
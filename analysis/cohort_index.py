@@ -0,0 +1,223 @@
+# Cohort catalogue for the ONAC study.
+
+# Crawls the per-task participant_data folders of each site (Lumo and Mini-CYRIL) and keeps a SQLite catalogue of
+# participants, sessions and task files, with row counts, hashes and frame statistics. Crawls are incremental: a file
+# is only re-read if its modification time or size has changed since the last crawl, and files (and sessions and
+# participants left without files) that have been deleted or moved are removed.
+
+# A session is one visit of a participant to a site. The tasks name their files P<participant>_<session>_<suffix>,
+# where the session is the date and time it started (PsychoPy's data.getDateStr(), e.g.
+# P12_2024-03-05_14h02.11.123_data.csv, see Experiment.__filename_save); a resumed session keeps the date it started.
+# Files written before sessions were named (e.g. P12_data.csv) are grouped by the date they were last modified.
+
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+import pandas as pd
+import argparse
+import os
+import re
+import sqlite3
+import sys
+import time
+
+#%%%%%%%%%% Paths %%%%%%%%%%
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'experiment'))
+from storage import Storage, file_hash
+
+# Files are saved as P<participant number>..., see Experiment.__filename_save
+PARTICIPANT_PATTERN = re.compile(r'^P(\d+)')
+SESSION_PATTERN = re.compile(r'^P\d+_((\d{4}-\d{2}-\d{2})_\d{2}h\d{2}\.\d{2}\.\d+)')
+
+# Bumped when the schema changes; older catalogues are rebuilt by the next crawl
+SCHEMA_VERSION = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS participants (
+    participant INTEGER PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    participant INTEGER NOT NULL REFERENCES participants(participant),
+    site TEXT NOT NULL,
+    session TEXT NOT NULL,
+    session_date TEXT NOT NULL,
+    first_modified REAL,
+    UNIQUE (participant, site, session)
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    session_id INTEGER NOT NULL REFERENCES sessions(session_id),
+    task TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    n_rows INTEGER,
+    frames INTEGER,
+    dropped_frames INTEGER,
+    dropped_fraction REAL
+);
+CREATE INDEX IF NOT EXISTS files_task ON files (task, dropped_fraction);
+CREATE INDEX IF NOT EXISTS files_session ON files (session_id);
+"""
+
+#%%%%%%%%%% Catalogue %%%%%%%%%%
+
+class CohortIndex:
+
+    def __init__(self, database, sites=None):
+        """
+        :param database: Filepath of the SQLite catalogue (created if it does not exist).
+        :param sites: Dictionary of site name -> root folder. Defaults to the output roots of the storage config.
+        """
+
+        if sites is None:
+            storage = Storage.load()
+            sites = {site: storage.output_root(site) for site in storage.sites}
+        self.__sites = sites
+        self.__db = sqlite3.connect(database)
+        if self.__db.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+            self.__db.executescript('DROP TABLE IF EXISTS files; DROP TABLE IF EXISTS sessions;')
+            self.__db.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        self.__db.executescript(SCHEMA)
+
+    def close(self):
+        self.__db.close()
+
+    #%%%%% CRAWLING %%%%%
+    def __task_files(self, root):
+        """
+        Yields (task, filepath) for every file in <root>/<task>/participant_data/.
+        """
+
+        if not os.path.isdir(root):
+            print(f'Skipping missing root {root}')
+            return
+        for task in sorted(os.listdir(root)):
+            data_dir = os.path.join(root, task, 'participant_data')
+            if not os.path.isdir(data_dir):
+                continue
+            for entry in os.scandir(data_dir):
+                if entry.is_file() and PARTICIPANT_PATTERN.match(entry.name):
+                    yield task, entry
+
+    def __read_file(self, filepath):
+        """
+        :return: Number of rows, total frames and dropped frames (None if the file has no frame statistics).
+        """
+
+        if not filepath.endswith('.csv'):
+            return None, None, None
+        try:
+            df = pd.read_csv(filepath)
+        except (pd.errors.ParserError, pd.errors.EmptyDataError, UnicodeDecodeError):
+            return None, None, None
+        if 'frames' in df.columns and 'dropped_frames' in df.columns:
+            return len(df), int(df['frames'].sum()), int(df['dropped_frames'].sum())
+        return len(df), None, None
+
+    @staticmethod
+    def session_key(name, mtime):
+        """
+        :return: (session, session date) of a task file.
+        """
+
+        match = SESSION_PATTERN.match(name)
+        if match:
+            return match.group(1), match.group(2)
+        date = time.strftime('%Y-%m-%d', time.localtime(mtime))
+        return date, date
+
+    def __session_id(self, participant, site, session, session_date, mtime):
+        key = (participant, site, session)
+        self.__db.execute('INSERT OR IGNORE INTO participants (participant) VALUES (?)', (participant,))
+        self.__db.execute('INSERT OR IGNORE INTO sessions (participant, site, session, session_date, first_modified) '
+                          'VALUES (?, ?, ?, ?, ?)', key + (session_date, mtime))
+        self.__db.execute('UPDATE sessions SET first_modified = MIN(first_modified, ?) WHERE participant = ? AND '
+                          'site = ? AND session = ?', (mtime,) + key)
+        return self.__db.execute('SELECT session_id FROM sessions WHERE participant = ? AND site = ? AND session = ?',
+                                 key).fetchone()[0]
+
+    def update(self):
+        """
+        Crawls all sites, indexing new and modified files and dropping files that no longer exist.
+
+        :return: Number of files (re)indexed.
+        """
+
+        start = time.perf_counter()
+        known = {path: (mtime, size) for path, mtime, size in self.__db.execute('SELECT path, mtime, size FROM files')}
+        seen = set()
+        indexed = 0
+        for site, root in self.__sites.items():
+            for task, entry in self.__task_files(root):
+                path = entry.path
+                stat = entry.stat()
+                seen.add(path)
+                if known.get(path) == (stat.st_mtime, stat.st_size):
+                    continue
+                participant = int(PARTICIPANT_PATTERN.match(entry.name).group(1))
+                n_rows, frames, dropped = self.__read_file(path)
+                dropped_fraction = dropped / frames if frames else None
+                session_id = self.__session_id(participant, site, *self.session_key(entry.name, stat.st_mtime),
+                                               stat.st_mtime)
+                self.__db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                  (path, session_id, task, stat.st_mtime, stat.st_size, file_hash(path), n_rows,
+                                   frames, dropped, dropped_fraction))
+                indexed += 1
+        removed = [(path,) for path in known if path not in seen]
+        self.__db.executemany('DELETE FROM files WHERE path = ?', removed)
+        # Sessions and participants whose files have all been deleted or moved (re-indexed files may also have moved
+        # to another session)
+        self.__db.execute('DELETE FROM sessions WHERE session_id NOT IN (SELECT session_id FROM files)')
+        self.__db.execute('DELETE FROM participants WHERE participant NOT IN (SELECT participant FROM sessions)')
+        self.__db.commit()
+        print(f'Indexed {indexed} file(s), removed {len(removed)} in {time.perf_counter() - start:.2f}s')
+        return indexed
+
+    #%%%%% QUERIES %%%%%
+    def query(self, sql, params=()):
+        return self.__db.execute(sql, params).fetchall()
+
+    def sessions(self, task=None):
+        """
+        :return: List of (participant, site, session date, session, task, n_rows, path) for every indexed task file.
+        """
+
+        sql = ('SELECT s.participant, s.site, s.session_date, s.session, f.task, f.n_rows, f.path FROM files f '
+               'JOIN sessions s ON s.session_id = f.session_id')
+        if task is not None:
+            return self.query(sql + ' WHERE f.task = ? ORDER BY s.participant, s.session', (task,))
+        return self.query(sql + ' ORDER BY s.participant, s.session, f.task')
+
+    def dropped_frames(self, task='visual_stimulation', threshold=0.05):
+        """
+        :return: List of (participant, site, session, dropped fraction, path) for sessions of a task with more than
+        threshold of frames dropped.
+        """
+
+        return self.query('SELECT s.participant, s.site, s.session, f.dropped_fraction, f.path FROM files f '
+                          'JOIN sessions s ON s.session_id = f.session_id '
+                          'WHERE f.task = ? AND f.dropped_fraction > ? ORDER BY f.dropped_fraction DESC',
+                          (task, threshold))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Index ONAC participant data')
+    parser.add_argument('--database', default='onac_cohort.sqlite')
+    parser.add_argument('--config', default=None, help='Storage config json (default: onac_config.json)')
+    parser.add_argument('--task', default=None, help='List the sessions of one task')
+    parser.add_argument('--dropped-frames', type=float, default=None,
+                        help='List sessions of --task (default visual_stimulation) with more than this fraction of '
+                             'frames dropped')
+    args = parser.parse_args()
+
+    storage = Storage.load(args.config)
+    index = CohortIndex(args.database, {site: storage.output_root(site) for site in storage.sites})
+    index.update()
+    if args.dropped_frames is not None:
+        rows = index.dropped_frames(args.task or 'visual_stimulation', args.dropped_frames)
+    else:
+        rows = index.sessions(args.task)
+    for row in rows:
+        print(*row, sep='\t')
+    index.close()
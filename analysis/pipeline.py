@@ -0,0 +1,497 @@
+# Per-participant analysis pipeline for the ONAC study.
+
+# The processing of a participant is modelled as a DAG of stages (reading the randomised stimulus files, the per-task
+# data files and the ExperimentHandler output, merging, scoring, and NIRS block analysis). The output of every stage
+# is cached on disk under a key hashed from the content of its input files, its parameters, its version and the keys
+# of the stages it depends on. Changing a file or a parameter therefore invalidates exactly the stages downstream of
+# it, and everything else is loaded from the cache.
+
+# All keys are computed before anything runs, so only invalidated stages are scheduled. Stages of different
+# participants, and independent stages of the same participant, run in parallel in a process pool. File hashes are
+# remembered by modification time and size, so unchanged files are not re-read to check them.
+
+# Usage: python pipeline.py --participants 1 2 3 [--workers 8] [--set nirs.motion_correction=true] [--force nirs]
+
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import pandas as pd
+import numpy as np
+import argparse
+import glob
+import hashlib
+import json
+import os
+import pickle
+import re
+import sys
+import time
+
+from block_averaging import BlockAnalysis
+from motion_correction import tddr_chunked
+
+#%%%%%%%%%% Paths %%%%%%%%%%
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'experiment'))
+from storage import Storage, file_hash
+
+HASHES = 'file_hashes.json'
+
+#%%%%%%%%%% Pipeline %%%%%%%%%%
+
+class Stage:
+
+    def __init__(self, name, function, inputs=(), files=None, params=None, version=1):
+        """
+        :param name: Name of the stage.
+        :param function: Module-level function(participant, inputs, files, params) returning the stage output, which
+                         must be picklable. inputs maps the name of each upstream stage to its output.
+        :param inputs: Names of the stages this stage depends on.
+        :param files: Optional function(participant, context) returning the input files of the stage.
+        :param params: Default parameters, which are part of the cache key.
+        :param version: Bump to invalidate cached outputs when the stage code changes.
+        """
+
+        self.name = name
+        self.function = function
+        self.inputs = tuple(inputs)
+        self.files = files
+        self.params = dict(params or {})
+        self.version = version
+
+
+class FileHashes:
+
+    def __init__(self, filepath):
+        """
+        SHA-256 of files, remembered by modification time and size.
+        """
+
+        self.__filepath = filepath
+        self.__hashes = {}
+        if os.path.exists(filepath):
+            with open(filepath) as f:
+                self.__hashes = json.load(f)
+
+    def __call__(self, filepath):
+        stat = os.stat(filepath)
+        entry = self.__hashes.get(filepath)
+        if entry is None or entry[0] != stat.st_mtime or entry[1] != stat.st_size:
+            entry = [stat.st_mtime, stat.st_size, file_hash(filepath)]
+            self.__hashes[filepath] = entry
+        return entry[2]
+
+    def save(self):
+        tmp = self.__filepath + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.__hashes, f)
+        os.replace(tmp, self.__filepath)
+
+
+def _run_stage(args):
+    """
+    Runs one stage of one participant (in a worker process) and writes its output to the cache.
+    """
+
+    function, participant, input_paths, files, params, target = args
+    start = time.perf_counter()
+    inputs = {}
+    for name, filepath in input_paths.items():
+        with open(filepath, 'rb') as f:
+            inputs[name] = pickle.load(f)
+    output = function(participant, inputs, files, params)
+    tmp = target + '.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(output, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, target)
+    return time.perf_counter() - start
+
+
+class Pipeline:
+
+    def __init__(self, stages, cache_dir, context=None, params=None, workers=None):
+        """
+        :param stages: List of Stage.
+        :param cache_dir: Folder of the cached stage outputs.
+        :param context: Dictionary passed to the files functions of the stages (e.g. data roots).
+        :param params: Dictionary of stage name -> parameters overriding the stage defaults.
+        :param workers: Number of processes. Defaults to the number of cores.
+        """
+
+        self.__stages = {stage.name: stage for stage in stages}
+        for stage in stages:
+            for name in stage.inputs:
+                if name not in self.__stages:
+                    raise ValueError('Stage ' + stage.name + ' depends on unknown stage ' + name)
+        for name in params or {}:
+            if name not in self.__stages:
+                raise ValueError('Parameters given for unknown stage ' + name)
+        self.__order = self.__topological_order()
+        self.__cache_dir = cache_dir
+        self.__context = context or {}
+        self.__params = {name: dict(stage.params, **(params or {}).get(name, {}))
+                         for name, stage in self.__stages.items()}
+        self.__workers = os.cpu_count() if workers is None else workers
+        os.makedirs(cache_dir, exist_ok=True)
+        self.__hashes = FileHashes(os.path.join(cache_dir, HASHES))
+
+    def __topological_order(self):
+        order = []
+        state = {}  # name -> 'visiting' or 'done'
+
+        def visit(name):
+            if state.get(name) == 'done':
+                return
+            if state.get(name) == 'visiting':
+                raise ValueError('The pipeline has a cycle through stage ' + name)
+            state[name] = 'visiting'
+            for upstream in self.__stages[name].inputs:
+                visit(upstream)
+            state[name] = 'done'
+            order.append(name)
+
+        for name in self.__stages:
+            visit(name)
+        return order
+
+    def __target(self, participant, name, key):
+        return os.path.join(self.__cache_dir, name, 'P' + str(participant) + '_' + key[:24] + '.pkl')
+
+    def plan(self, participant):
+        """
+        Computes the cache key of every stage of a participant, without running anything.
+
+        :return: Dictionary of stage name -> (key, input files, cache filepath).
+        """
+
+        plan = {}
+        for name in self.__order:
+            stage = self.__stages[name]
+            files = sorted(stage.files(participant, self.__context)) if stage.files is not None else []
+            description = {'stage': name, 'version': stage.version, 'params': self.__params[name],
+                           'files': [[f, self.__hashes(f)] for f in files],
+                           'inputs': {upstream: plan[upstream][0] for upstream in stage.inputs}}
+            key = hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+            plan[name] = (key, files, self.__target(participant, name, key))
+        return plan
+
+    def run(self, participants, force=()):
+        """
+        Brings every stage of every participant up to date.
+
+        :param participants: Participant numbers.
+        :param force: Names of stages to rerun even if cached (their downstream stages are rerun too).
+        :return: Dictionary of participant -> {stage name: cache filepath}, and a DataFrame of what was run.
+        """
+
+        plans = {p: self.plan(p) for p in participants}
+        self.__hashes.save()
+        for name in self.__order:
+            os.makedirs(os.path.join(self.__cache_dir, name), exist_ok=True)
+
+        # Work out which stages are stale
+        pending = {}  # (participant, name) -> upstream (participant, name) jobs still to finish
+        report = []
+        for p, plan in plans.items():
+            stale = set()
+            for name in self.__order:
+                key, files, target = plan[name]
+                upstream_stale = [u for u in self.__stages[name].inputs if u in stale]
+                if name in force or upstream_stale or not os.path.exists(target):
+                    stale.add(name)
+                    pending[(p, name)] = {(p, u) for u in upstream_stale}
+                else:
+                    report.append({'participant': p, 'stage': name, 'cached': True, 'seconds': 0.0})
+
+        def job(p, name):
+            stage = self.__stages[name]
+            key, files, target = plans[p][name]
+            input_paths = {u: plans[p][u][2] for u in stage.inputs}
+            return stage.function, p, input_paths, files, self.__params[name], target
+
+        start = time.perf_counter()
+        done = set()
+        if self.__workers == 1 or len(pending) < 2:
+            for p in participants:
+                for name in self.__order:
+                    if (p, name) in pending:
+                        report.append({'participant': p, 'stage': name, 'cached': False,
+                                       'seconds': _run_stage(job(p, name))})
+        else:
+            with ProcessPoolExecutor(max_workers=self.__workers) as executor:
+                running = {}
+                while pending or running:
+                    for task in [t for t, upstream in pending.items() if upstream <= done]:
+                        running[executor.submit(_run_stage, job(*task))] = task
+                        del pending[task]
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        p, name = running.pop(future)
+                        report.append({'participant': p, 'stage': name, 'cached': False, 'seconds': future.result()})
+                        done.add((p, name))
+
+        report = pd.DataFrame(report, columns=['participant', 'stage', 'cached', 'seconds'])
+        summary = report.groupby('stage')['cached'].agg(cached='sum', total='size')
+        print(f'Pipeline: {int((~report["cached"]).sum())} stage(s) run, {int(report["cached"].sum())} cached, '
+              f'{time.perf_counter() - start:.2f}s')
+        for name in self.__order:
+            if name in summary.index:
+                print(f"    {name}: {summary.loc[name, 'total'] - summary.loc[name, 'cached']} run, "
+                      f"{summary.loc[name, 'cached']} cached")
+        self.__prune(plans)
+        return {p: {name: plan[name][2] for name in self.__order} for p, plan in plans.items()}, report
+
+    def __prune(self, plans):
+        """
+        Removes the cached outputs of the participants that do not belong to their current plan (left by earlier runs
+        with other files or parameters).
+        """
+
+        for p, plan in plans.items():
+            for name in self.__order:
+                target = plan[name][2]
+                pattern = os.path.join(glob.escape(os.path.dirname(target)), glob.escape('P' + str(p) + '_') + '*.pkl')
+                for filepath in glob.glob(pattern):
+                    if filepath != target:
+                        os.remove(filepath)
+
+    def load(self, participant, name):
+        """
+        :return: The cached output of a stage (run() must have been called).
+        """
+
+        key, files, target = self.plan(participant)[name]
+        with open(target, 'rb') as f:
+            return pickle.load(f)
+
+#%%%%%%%%%% ONAC stages %%%%%%%%%%
+# Per-task output files, as named by Experiment (experiment/master_WV.py):
+# <task folder>/participant_data/P<n>_<session><suffix>, where the session is the date and time it started
+TASK_FILES = {
+    'object_recognition': ('object_recognition_task', '_object_recognition_task.csv'),
+    'mismatched_negativity': ('mismatched_negativity_task', '_mismatched_negativity_task.csv'),
+    'memory_task': ('memory_task', '_data.csv'),
+    'visual_stimulation': ('visual_stimulation', '_data.csv'),
+    'naturalistic_motor_task': ('naturalistic_motor_task', '_naturalistic_motor_task.csv'),
+}
+
+# PsychoPy's data.getDateStr(), e.g. 2024-03-05_14h02.11.123
+SESSION = r'\d{4}-\d{2}-\d{2}_\d{2}h\d{2}\.\d{2}\.\d+'
+
+# The ExperimentHandler csvs of the Lumo tasks are <participant>_<experiment name>_<date>.csv (Experiment.__setup);
+# broadbandNIRS.py saves its own under another experiment name
+EXPERIMENT_NAME = 'Optical Neuroimaging and Cognition (ONAC)'
+
+# Stimulus files written by randomisation_script.py and oddball_sequences.py: <task folder>/stimuli/P<n>_<folder>_...
+STIMULUS_FOLDERS = ['object_recognition_task', 'mismatched_negativity_task', 'visual_stimulation', 'simple_motor_task']
+
+# Tasks with NIRS recordings analysed by block averaging, stored as <nirs root>/P<n>_<task>.npz with the arrays data
+# (channels, ..., samples), onsets and codes
+NIRS_TASKS = ['object_recognition', 'visual_stimulation']
+
+
+def _existing(filepaths):
+    return [f for f in filepaths if os.path.isfile(f)]
+
+
+def _session_pattern(prefix, suffix):
+    return re.compile(re.escape(prefix + '_') + '(' + SESSION + ')' + re.escape(suffix) + '$')
+
+
+def _session_files(folder, prefix, suffix):
+    """
+    :return: Dictionary of session -> filepath of the files <folder>/<prefix>_<session><suffix>, in session order.
+    """
+
+    pattern = _session_pattern(prefix, suffix)
+    files = {}
+    for filepath in glob.glob(os.path.join(glob.escape(folder), glob.escape(prefix + '_') + '*' + suffix)):
+        match = pattern.match(os.path.basename(filepath))
+        if match:
+            files[match.group(1)] = filepath
+    return dict(sorted(files.items()))
+
+
+def stimulus_files(participant, context):
+    root = context['stimulus_root']
+    return _existing([root + '/' + folder + '/stimuli/P' + str(participant) + '_' + folder + '_stimuli.csv'
+                      for folder in STIMULUS_FOLDERS])
+
+
+def task_files(participant, context):
+    root = context['output_root']
+    return [f for folder, suffix in TASK_FILES.values()
+            for f in _session_files(root + '/' + folder + '/participant_data', 'P' + str(participant), suffix).values()]
+
+
+def handler_files(participant, context):
+    # Experiment.__endfilename: <data dir>/<participant>_<experiment name>_<date>.csv, next to the session reports
+    # (<date>_memory_usage.csv, ...), which the date pattern leaves out
+    return list(_session_files(context['handler_dir'], str(participant) + '_' + EXPERIMENT_NAME, '.csv').values())
+
+
+def nirs_files(participant, context):
+    return _existing([os.path.join(context['nirs_dir'], 'P' + str(participant) + '_' + task + '.npz')
+                      for task in NIRS_TASKS])
+
+
+def read_stimuli(participant, inputs, files, params):
+    """
+    :return: Dictionary of stimulus folder -> randomised stimulus table.
+    """
+
+    stimuli = {}
+    for filepath in files:
+        folder = re.match(r'P\d+_(.+)_stimuli\.csv$', os.path.basename(filepath)).group(1)
+        stimuli[folder] = pd.read_csv(filepath)
+    return stimuli
+
+
+def read_task_data(participant, inputs, files, params):
+    """
+    :return: Dictionary of task -> task data table of all of the participant's sessions, with a session column.
+    """
+
+    data = {}
+    for task, (folder, suffix) in TASK_FILES.items():
+        pattern = _session_pattern('P' + str(participant), suffix)
+        tables = []
+        for filepath in files:
+            match = pattern.match(os.path.basename(filepath))
+            if match and filepath.endswith('/' + folder + '/participant_data/' + match.group(0)):
+                tables.append(pd.read_csv(filepath).assign(session=match.group(1)))
+        if tables:
+            data[task] = pd.concat(tables, ignore_index=True)
+    return data
+
+
+def read_handler(participant, inputs, files, params):
+    """
+    :return: The trial-by-trial ExperimentHandler data of all of the participant's sessions, in one table.
+    """
+
+    if not files:
+        return pd.DataFrame()
+    return pd.concat([pd.read_csv(f).assign(session_file=os.path.basename(f)) for f in files], ignore_index=True)
+
+
+def merge(participant, inputs, files, params):
+    """
+    Joins each task's data with the participant's stimulus table, where the task has one.
+
+    :return: Dictionary of task -> merged table, plus the ExperimentHandler table under 'experiment_handler'.
+    """
+
+    stimuli = inputs['stimuli']
+    merged = {}
+    for task, data in inputs['task_data'].items():
+        data = data.drop(columns=[c for c in data.columns if c.startswith('Unnamed')]).assign(participant=participant)
+        folder = TASK_FILES[task][0]
+        if folder in stimuli and 'stimulus' in data.columns and 'Link' in stimuli[folder].columns:
+            data = data.merge(stimuli[folder], how='left', left_on='stimulus', right_on='Link')
+        merged[task] = data
+    merged['experiment_handler'] = inputs['experiment_handler'].assign(participant=participant)
+    return merged
+
+
+def score(participant, inputs, files, params):
+    """
+    :return: Behavioural and timing measures, one row per (task, measure).
+    """
+
+    merged = inputs['merged']
+    scores = []
+    memory = merged.get('memory_task')
+    if memory is not None and len(memory):
+        for (phase, condition), trials in memory.groupby(['phase', 'condition']):
+            scores.append(('memory_task', phase + '_' + str(condition) + '_accuracy', trials['response'].mean()))
+            scores.append(('memory_task', phase + '_' + str(condition) + '_median_rt',
+                           trials['reaction_time'].median()))
+            scores.append(('memory_task', phase + '_' + str(condition) + '_missed',
+                           trials['reaction_time'].isna().mean()))
+    visual = merged.get('visual_stimulation')
+    if visual is not None and 'dropped_frames' in visual.columns and visual['frames'].sum() > 0:
+        scores.append(('visual_stimulation', 'dropped_fraction',
+                       visual['dropped_frames'].sum() / visual['frames'].sum()))
+    motor = merged.get('naturalistic_motor_task')
+    if motor is not None and len(motor):
+        for stimulus, trials in motor.groupby('Stimulus'):
+            scores.append(('naturalistic_motor_task', str(stimulus) + '_mean_duration', trials['Duration'].mean()))
+    mmn = merged.get('mismatched_negativity')
+    if mmn is not None and len(mmn):
+        for condition, tones in mmn.groupby('condition'):
+            scores.append(('mismatched_negativity', str(condition) + '_tones', float(len(tones))))
+    objects = merged.get('object_recognition')
+    if objects is not None:
+        scores.append(('object_recognition', 'stimuli_presented', float(len(objects))))
+    return pd.DataFrame(scores, columns=['task', 'measure', 'value']).assign(participant=participant)
+
+
+def nirs(participant, inputs, files, params):
+    """
+    Block averages and GLM betas of every NIRS recording of the participant.
+
+    :return: Dictionary of task -> BlockAnalysis.analyse results.
+    """
+
+    results = {}
+    for filepath in files:
+        task = re.match(r'P\d+_(.+)\.npz$', os.path.basename(filepath)).group(1)
+        recording = np.load(filepath, allow_pickle=False)
+        data = recording['data']
+        if params['motion_correction']:
+            data = tddr_chunked(data, params['fs'])
+        results[task] = BlockAnalysis(task, params['fs']).analyse(data, recording['onsets'], recording['codes'])
+    return results
+
+
+def onac_stages():
+    """
+    :return: The stages of the ONAC participant pipeline.
+    """
+
+    return [Stage('stimuli', read_stimuli, files=stimulus_files),
+            Stage('task_data', read_task_data, files=task_files),
+            Stage('experiment_handler', read_handler, files=handler_files),
+            Stage('merged', merge, inputs=('stimuli', 'task_data', 'experiment_handler')),
+            Stage('scores', score, inputs=('merged',)),
+            Stage('nirs', nirs, files=nirs_files, params={'fs': 10.0, 'motion_correction': False})]
+
+
+def _parse_value(text):
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the ONAC per-participant analysis pipeline')
+    parser.add_argument('--participants', nargs='+', required=True)
+    parser.add_argument('--config', default=None, help='Storage config json (default: onac_config.json)')
+    parser.add_argument('--site', default='Lumo')
+    parser.add_argument('--cache', default='onac_pipeline_cache')
+    parser.add_argument('--handler-dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                                                              'experiment', 'data'),
+                        help='Folder of the ExperimentHandler csvs')
+    parser.add_argument('--nirs-dir', default='nirs', help='Folder of the P<n>_<task>.npz NIRS recordings')
+    parser.add_argument('--set', nargs='*', default=[], metavar='STAGE.PARAM=VALUE', help='Override stage parameters')
+    parser.add_argument('--force', nargs='*', default=[], help='Stages to rerun even if cached')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--scores', default=None, help='csv to write the cohort scores to')
+    args = parser.parse_args()
+
+    params = {}
+    for setting in args.set:
+        name, value = setting.split('=', 1)
+        stage, param = name.split('.', 1)
+        params.setdefault(stage, {})[param] = _parse_value(value)
+
+    storage = Storage.load(args.config)
+    context = {'stimulus_root': storage.stimulus_root(args.site), 'output_root': storage.output_root(args.site),
+               'handler_dir': os.path.abspath(args.handler_dir), 'nirs_dir': os.path.abspath(args.nirs_dir)}
+    pipeline = Pipeline(onac_stages(), args.cache, context, params, args.workers)
+    outputs, report = pipeline.run(args.participants, force=args.force)
+    if args.scores is not None:
+        pd.concat([pipeline.load(p, 'scores') for p in args.participants], ignore_index=True).to_csv(args.scores,
+                                                                                                     index=False)
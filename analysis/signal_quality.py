@@ -0,0 +1,195 @@
+# Signal quality control of the ONAC recordings.
+
+# Computes, for every channel and block, three signal-quality indices of the raw intensity:
+#   - scalp coupling index (SCI): correlation between two wavelengths in the cardiac band. A well coupled optode sees
+#     the same heartbeat at both wavelengths.
+#   - cardiac power: fraction of the signal power in the cardiac band.
+#   - coefficient of variation (CV): standard deviation over mean of the intensity, in percent (worst wavelength).
+
+# Data are arrays of shape (channels, wavelengths, samples) of raw intensity. Block tasks are epoched around their
+# triggers with the windows of block_averaging.TASK_DESIGNS; the resting state is one long block, which is cut into
+# fixed-length segments. Filtering and correlation are done with one batched FFT over every block, channel and
+# wavelength, so a whole session is checked in well under a second.
+
+# Run this file to benchmark the quality matrix of a simulated session.
+
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+import pandas as pd
+import numpy as np
+import time
+
+from block_averaging import BlockAnalysis, TASK_DESIGNS
+
+CARDIAC_BAND = (0.5, 2.5)  # Hz
+
+# A channel is good in a block if every index passes
+QC_THRESHOLDS = {'sci': 0.75, 'cardiac_power': 0.1, 'cv': 7.5}
+
+# Length of the segments the resting state is cut into (seconds)
+RESTING_STATE_SEGMENT = 30.0
+
+#%%%%%%%%%% Quality indices %%%%%%%%%%
+
+def _band_limited(epochs, fs, band):
+    """
+    Removes the mean and everything outside the band from the last axis.
+
+    :return: Filtered epochs and the fraction of the (non-DC) power inside the band.
+    """
+
+    n = epochs.shape[-1]
+    spectrum = np.fft.rfft(epochs, axis=-1)
+    frequencies = np.fft.rfftfreq(n, 1 / fs)
+    in_band = (frequencies >= band[0]) & (frequencies <= band[1])
+    power = np.abs(spectrum[..., 1:]) ** 2
+    band_power = power[..., in_band[1:]].sum(axis=-1) / np.maximum(power.sum(axis=-1), np.finfo(float).tiny)
+    spectrum[..., ~in_band] = 0
+    return np.fft.irfft(spectrum, n=n, axis=-1), band_power
+
+
+def quality_indices(epochs, fs, wavelengths=(0, -1), band=CARDIAC_BAND):
+    """
+    Computes the quality indices of every block and channel at once.
+
+    :param epochs: Raw intensity of shape (blocks, channels, wavelengths, samples).
+    :param fs: Sampling frequency (Hz); must be above twice the top of the cardiac band.
+    :param wavelengths: Indices of the two wavelengths used for the SCI.
+    :return: Dictionary of arrays of shape (blocks, channels) for 'sci', 'cardiac_power' and 'cv'.
+    """
+
+    if fs <= 2 * band[1]:
+        raise ValueError(f'A sampling frequency of {fs}Hz cannot resolve the cardiac band')
+    epochs = np.asarray(epochs, dtype=float)
+    mean = epochs.mean(axis=-1)
+    cv = np.max(100 * epochs.std(axis=-1) / np.abs(mean), axis=-1)
+
+    pair = epochs[:, :, list(wavelengths)]
+    # Optical density, so that the SCI does not depend on the light level
+    optical_density = -np.log(pair / pair.mean(axis=-1, keepdims=True))
+    filtered, band_power = _band_limited(optical_density, fs, band)
+    norms = np.sqrt(np.sum(filtered ** 2, axis=-1))
+    sci = np.sum(filtered[:, :, 0] * filtered[:, :, 1], axis=-1) / np.maximum(norms[:, :, 0] * norms[:, :, 1],
+                                                                               np.finfo(float).tiny)
+    return {'sci': sci, 'cardiac_power': band_power.mean(axis=-1), 'cv': cv}
+
+
+class SignalQuality:
+
+    def __init__(self, fs, thresholds=None, wavelengths=(0, -1)):
+        """
+        :param fs: Sampling frequency of the recordings (Hz).
+        :param thresholds: Optional dictionary overriding QC_THRESHOLDS.
+        :param wavelengths: Indices of the two wavelengths used for the SCI.
+        """
+
+        self.__fs = fs
+        self.__thresholds = dict(QC_THRESHOLDS, **(thresholds or {}))
+        self.__wavelengths = wavelengths
+
+    def epochs(self, data, task, onsets, offset=None):
+        """
+        Cuts a recording into the blocks checked for quality.
+
+        :param data: Raw intensity of shape (channels, wavelengths, samples).
+        :param task: 'resting_state' or a key of TASK_DESIGNS.
+        :param onsets: Onset sample of every block (resting state: the 'G' trigger).
+        :param offset: Resting state only: sample of the end trigger ('H'). Defaults to the end of the recording.
+        :return: Array of shape (blocks, channels, wavelengths, samples).
+        """
+
+        data = np.asarray(data, dtype=float)
+        if task == 'resting_state':
+            start = int(onsets[0])
+            stop = data.shape[-1] if offset is None else int(offset)
+            segment = int(round(RESTING_STATE_SEGMENT * self.__fs))
+            n_segments = (stop - start) // segment
+            if n_segments == 0:
+                raise ValueError('The resting state is shorter than one segment')
+            blocks = data[..., start:start + n_segments * segment].reshape(data.shape[:-1] + (n_segments, segment))
+            return np.moveaxis(blocks, -2, 0)
+        if task not in TASK_DESIGNS:
+            raise ValueError('Unknown task: ' + str(task))
+        return BlockAnalysis(task, self.__fs).epochs(data, onsets)
+
+    def assess(self, data, task, onsets, offset=None):
+        """
+        :return: Quality matrix with one row per channel and block and the columns task, block, channel, sci,
+                 cardiac_power, cv and good.
+        """
+
+        indices = quality_indices(self.epochs(data, task, onsets, offset), self.__fs, self.__wavelengths)
+        n_blocks, n_channels = indices['sci'].shape
+        quality = pd.DataFrame({'task': task,
+                                'block': np.repeat(np.arange(n_blocks), n_channels),
+                                'channel': np.tile(np.arange(n_channels), n_blocks)})
+        for name, values in indices.items():
+            quality[name] = values.ravel()
+        quality['good'] = ((quality['sci'] >= self.__thresholds['sci']) &
+                           (quality['cardiac_power'] >= self.__thresholds['cardiac_power']) &
+                           (quality['cv'] <= self.__thresholds['cv']))
+        return quality
+
+    def session(self, recordings):
+        """
+        Assesses every task of a session.
+
+        :param recordings: Dictionary of task -> dictionary with keys 'data', 'onsets' and optionally 'offset'.
+        :return: The long quality table, and a channels x (task, block) matrix of the fraction of indices passed.
+        """
+
+        quality = pd.concat([self.assess(r['data'], task, r['onsets'], r.get('offset'))
+                             for task, r in recordings.items()], ignore_index=True)
+        quality['score'] = ((quality['sci'] >= self.__thresholds['sci']).astype(int) +
+                            (quality['cardiac_power'] >= self.__thresholds['cardiac_power']).astype(int) +
+                            (quality['cv'] <= self.__thresholds['cv']).astype(int)) / 3
+        matrix = quality.pivot_table(index='channel', columns=['task', 'block'], values='score')
+        return quality, matrix
+
+#%%%%%%%%%% Benchmark %%%%%%%%%%
+
+def simulate_intensity(channels, samples, fs, bad_channels=(), seed=None):
+    """
+    Creates raw intensity at two wavelengths with a shared heartbeat. Bad channels have no heartbeat and a lot of
+    noise, as for an optode that is not touching the scalp.
+    """
+
+    rng = np.random.default_rng(seed)
+    t = np.arange(samples) / fs
+    heart_rate = rng.uniform(1.0, 1.4)
+    cardiac = np.sin(2 * np.pi * heart_rate * t)
+    data = np.empty((channels, 2, samples))
+    for wavelength, amplitude in enumerate((0.01, 0.015)):
+        data[:, wavelength] = 1000 * (1 + amplitude * cardiac + rng.normal(0, 0.002, size=(channels, samples)))
+    bad = list(bad_channels)
+    data[bad] = 1000 * (1 + rng.normal(0, 0.1, size=(len(bad), 2, samples)))
+    return data
+
+
+def benchmark(channels=64, fs=10.0, seed=0):
+    """
+    Times the quality matrix of a simulated session with resting state, breath holding and visual stimulation.
+    """
+
+    rng = np.random.default_rng(seed)
+    bad = rng.choice(channels, size=channels // 8, replace=False)
+    recordings = {}
+    for task, n_blocks in (('breath_holding', 5), ('visual_stimulation', 12)):
+        design = TASK_DESIGNS[task]
+        block = int((design['baseline'] + design['duration'] + design['post']) * fs)
+        onsets = np.arange(n_blocks) * block + int(design['baseline'] * fs)
+        recordings[task] = {'data': simulate_intensity(channels, block * (n_blocks + 1), fs, bad, seed),
+                            'onsets': onsets}
+    recordings['resting_state'] = {'data': simulate_intensity(channels, int(600 * fs), fs, bad, seed), 'onsets': [0]}
+
+    start = time.perf_counter()
+    quality, matrix = SignalQuality(fs).session(recordings)
+    elapsed = time.perf_counter() - start
+    flagged = set(quality.loc[~quality['good'], 'channel'])
+    print(f'{channels} channels, {matrix.shape[1]} blocks: quality matrix in {elapsed:.3f}s, '
+          f'{len(flagged)} channel(s) flagged, {len(set(bad) - flagged)} bad channel(s) missed')
+    return quality, matrix
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,208 @@
+# Broadband NIRS spectral unmixing for the Mini-CYRIL recordings.
+
+# Converts broadband intensity spectra to concentration changes of oxygenated haemoglobin (HbO2), deoxygenated
+# haemoglobin (HHb) and oxidised cytochrome-c-oxidase (oxCCO) with the UCLn algorithm (modified Beer-Lambert law
+# solved by least squares over all wavelengths):
+
+#       delta_c = pinv(E) @ (delta_A / DPF(lambda)) / (DPF * d)
+
+# Everything after the logarithm is linear, so pinv(E), the wavelength dependence of the pathlength, the DPF and the
+# source-detector separation are folded into one (chromophores x wavelengths) operator when the unmixer is created.
+# Every channel and time point is then solved by one batched matrix product. Long recordings are streamed through in
+# chunks of samples, so memory use does not depend on the recording length.
+
+# Data are arrays of shape (channels, wavelengths, samples); results have shape (channels, chromophores, samples),
+# the layout used by block_averaging.py.
+
+# Run this file to benchmark samples per second on the CPU.
+
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+import pandas as pd
+import numpy as np
+import argparse
+import time
+
+CHROMOPHORES = ('HbO2', 'HHb', 'oxCCO')
+
+#%%%%%%%%%% Extinction spectra %%%%%%%%%%
+
+def load_extinction(filepath, wavelengths, chromophores=CHROMOPHORES):
+    """
+    Reads tabulated extinction spectra and interpolates them at the wavelengths of the spectrometer.
+
+    :param filepath: csv with a 'wavelength' column (nm) and one column per chromophore, in 1/(mM cm) (base 10).
+    :param wavelengths: Wavelengths of the spectrometer pixels (nm).
+    :return: Extinction matrix of shape (wavelengths, chromophores).
+    """
+
+    spectra = pd.read_csv(filepath).sort_values('wavelength')
+    wavelengths = np.asarray(wavelengths, dtype=float)
+    if wavelengths.min() < spectra['wavelength'].min() or wavelengths.max() > spectra['wavelength'].max():
+        raise ValueError('The extinction spectra do not cover ' + str(wavelengths.min()) + '-' +
+                         str(wavelengths.max()) + 'nm')
+    return np.stack([np.interp(wavelengths, spectra['wavelength'], spectra[c]) for c in chromophores], axis=1)
+
+#%%%%%%%%%% Unmixing %%%%%%%%%%
+
+class SpectralUnmixer:
+
+    def __init__(self, extinction, dpf=6.26, separation=3.0, wavelength_dependence=None, dtype=np.float64):
+        """
+        :param extinction: Extinction matrix of shape (wavelengths, chromophores), in 1/(mM cm).
+        :param dpf: Differential pathlength factor.
+        :param separation: Source-detector separation (cm).
+        :param wavelength_dependence: Relative pathlength at each wavelength (unitless, 1 at the DPF wavelength), or
+                                      None to assume a constant pathlength.
+        :param dtype: Floating point type of the computation; float32 halves memory traffic.
+        """
+
+        extinction = np.asarray(extinction, dtype=float)
+        n_wavelengths = extinction.shape[0]
+        if wavelength_dependence is None:
+            wavelength_dependence = np.ones(n_wavelengths)
+        # Solve for uM: extinction is per mM, and attenuation is in log10 units
+        operator = np.linalg.pinv(extinction) / np.asarray(wavelength_dependence, dtype=float)[None, :]
+        self.__operator = (operator * 1000 / (dpf * separation)).astype(dtype)
+        self.__dtype = dtype
+        self.__reference = None  # Operator applied to log10 of the reference spectrum, per channel
+
+    @property
+    def operator(self):
+        """
+        :return: The (chromophores x wavelengths) matrix mapping log10 intensity changes to concentration changes.
+        """
+
+        return self.__operator
+
+    @property
+    def n_wavelengths(self):
+        return self.__operator.shape[1]
+
+    def set_reference(self, intensity):
+        """
+        Sets the reference spectrum of every channel, which concentration changes are relative to.
+
+        :param intensity: Array of shape (channels, wavelengths, samples), e.g. a baseline period; averaged over
+                          samples.
+        """
+
+        reference = np.log10(np.mean(intensity, axis=-1, dtype=float)).astype(self.__dtype)
+        self.__reference = (self.__operator @ reference[..., None])[..., 0]
+
+    def unmix(self, intensity, out=None):
+        """
+        Converts a block of intensity spectra to concentration changes.
+
+        :param intensity: Array of shape (channels, wavelengths, samples).
+        :param out: Optional array of shape (channels, chromophores, samples) to write into.
+        :return: Concentration changes in uM, shape (channels, chromophores, samples).
+        """
+
+        if self.__reference is None:
+            raise RuntimeError('set_reference() must be called before unmixing')
+        if intensity.shape[1] != self.n_wavelengths:
+            raise ValueError(f'Expected {self.n_wavelengths} wavelengths, got {intensity.shape[1]}')
+        log_intensity = np.log10(intensity, dtype=self.__dtype)
+        # delta_A = log10(I_ref) - log10(I), so delta_c = operator @ log10(I_ref) - operator @ log10(I)
+        out = np.matmul(self.__operator, log_intensity, out=out)
+        np.subtract(self.__reference[..., None], out, out=out)
+        return out
+
+    def stream(self, chunks):
+        """
+        Unmixes an iterable of consecutive intensity chunks, one chunk at a time.
+
+        :param chunks: Iterable of arrays of shape (channels, wavelengths, chunk samples).
+        :return: Generator of concentration chunks of shape (channels, chromophores, chunk samples).
+        """
+
+        for chunk in chunks:
+            yield self.unmix(chunk)
+
+    def unmix_file(self, source, target, chunk_samples=4096, baseline_samples=None):
+        """
+        Unmixes a recording stored as a .npy file of shape (channels, wavelengths, samples) into a .npy file of shape
+        (channels, chromophores, samples), memory-mapping both so only one chunk is in memory at a time.
+
+        :param baseline_samples: Number of samples at the start to use as the reference. If None, the reference set
+                                 with set_reference() is used.
+        """
+
+        intensity = np.load(source, mmap_mode='r')
+        n_channels, _, n_samples = intensity.shape
+        if baseline_samples is not None:
+            self.set_reference(intensity[..., :baseline_samples])
+        result = np.lib.format.open_memmap(target, mode='w+', dtype=self.__dtype,
+                                           shape=(n_channels, self.__operator.shape[0], n_samples))
+        buffer = np.empty((n_channels, self.__operator.shape[0], chunk_samples), dtype=self.__dtype)
+        for start in range(0, n_samples, chunk_samples):
+            stop = min(start + chunk_samples, n_samples)
+            result[..., start:stop] = self.unmix(intensity[..., start:stop], out=buffer[..., :stop - start])
+        result.flush()
+        return result
+
+#%%%%%%%%%% Benchmark %%%%%%%%%%
+
+def simulate_recording(extinction, channels, samples, dpf=6.26, separation=3.0, seed=None):
+    """
+    Creates synthetic intensity spectra from known concentration changes, used for validation and benchmarking.
+
+    :return: Intensity of shape (channels, wavelengths, samples) and the true concentration changes in uM.
+    """
+
+    rng = np.random.default_rng(seed)
+    t = np.arange(samples)
+    concentrations = np.stack([np.sin(2 * np.pi * t / 200 + phase) for phase in rng.uniform(0, np.pi, 3)])
+    concentrations = (concentrations[None] * rng.uniform(0.5, 2, size=(channels, 3, 1)) *
+                      np.array([1, 0.5, 0.1])[:, None])
+    attenuation = np.einsum('wc,ncs->nws', extinction, concentrations) * dpf * separation / 1000
+    reference = rng.uniform(1e3, 1e4, size=(channels, extinction.shape[0], 1))
+    intensity = reference * 10 ** -attenuation
+    return intensity, concentrations
+
+
+def synthetic_extinction(wavelengths):
+    """
+    Smooth, well-conditioned stand-in spectra for benchmarking when no tabulated spectra are at hand.
+    """
+
+    x = (np.asarray(wavelengths, dtype=float) - 780) / 120
+    return np.stack([0.5 + 0.8 * x, 1.5 - 0.9 * x + 0.6 * np.exp(-((x - 0.03) / 0.05) ** 2),
+                     0.3 + 0.4 * np.exp(-((x - 0.55) / 0.3) ** 2)], axis=1)
+
+
+def benchmark(channels=(2, 8, 16), wavelengths=(121, 512, 1024), samples=20000, chunk_samples=4096,
+              dtypes=(np.float64, np.float32)):
+    """
+    Times unmixing in chunks for several recording sizes.
+
+    :return: List of (channels, wavelengths, dtype, samples per second) tuples.
+    """
+
+    results = []
+    for n_wavelengths in wavelengths:
+        extinction = synthetic_extinction(np.linspace(780, 900, n_wavelengths))
+        for n_channels in channels:
+            intensity, truth = simulate_recording(extinction, n_channels, samples, seed=0)
+            for dtype in dtypes:
+                unmixer = SpectralUnmixer(extinction, dtype=dtype)
+                unmixer.set_reference(intensity[..., :1])
+                chunks = (intensity[..., i:i + chunk_samples] for i in range(0, samples, chunk_samples))
+                start = time.perf_counter()
+                result = np.concatenate(list(unmixer.stream(chunks)), axis=-1)
+                elapsed = time.perf_counter() - start
+                error = np.max(np.abs(result - (truth - truth[..., :1])))
+                rate = samples / elapsed
+                print(f'{n_channels} channels x {n_wavelengths} wavelengths ({np.dtype(dtype).name}): '
+                      f'{rate:,.0f} samples/s, {rate * n_channels:,.0f} channel-samples/s, max error {error:.1e}uM')
+                results.append((n_channels, n_wavelengths, np.dtype(dtype).name, rate))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark broadband NIRS spectral unmixing')
+    parser.add_argument('--samples', type=int, default=20000)
+    parser.add_argument('--chunk', type=int, default=4096)
+    args = parser.parse_args()
+    benchmark(samples=args.samples, chunk_samples=args.chunk)
@@ -0,0 +1,199 @@
+# Offline audio preprocessing for the ONAC tasks.
+
+# Converts every WAV referenced by the tasks (the mismatched negativity tones and the naturalistic motor task
+# instructions) to the output device's sample rate, sample format and channel layout, and normalises loudness, so
+# that nothing is resampled at playback time. Each group of files (e.g. all MMN tones) shares one gain, so relative
+# levels within the group, such as intensity deviants, are preserved.
+
+# Converted files are written to <site root>/preprocessed_audio/<format>/ with a manifest of hashes, which keeps
+# them inside the stimulus tree (and therefore inside the stimulus cache, see storage.py). The device format is the
+# 'audio' entry of the storage config, which the tasks also use for playback. A converted file is only used while its
+# source is unchanged; edited sources are played from the original until preprocessing is rerun.
+
+# Usage: python audio_preprocessing.py [--rate 48000] [--channels 2] [--format int16]
+
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+from concurrent.futures import ProcessPoolExecutor
+from scipy.io import wavfile
+
+import pandas as pd
+import numpy as np
+import argparse
+import json
+import os
+
+from audio_sequencer import read_wav, convert
+from storage import Storage, file_hash, site_relative
+
+# Loudness target (RMS of the loudest file in each group) and peak ceiling, in dB full scale
+TARGET_RMS_DB = -20.0
+PEAK_CEILING_DB = -1.0
+
+FORMATS = {'int16': np.int16, 'int32': np.int32, 'float32': np.float32}
+
+MANIFEST = 'manifest.json'
+
+#%%%%%%%%%% Preprocessing %%%%%%%%%%
+
+def _format_folder(rate, channels, sample_format):
+    return str(rate) + 'Hz_' + str(channels) + 'ch_' + sample_format
+
+
+def referenced_wavs(storage):
+    """
+    Lists the WAV files referenced by the task csvs of the Lumo site, grouped for loudness normalisation. Paths stored
+    in the csvs (e.g. under the original piloting machine's folders) are resolved through the storage config.
+
+    :param storage: Storage config; the files are listed under the stimulus root of the Lumo site.
+    :return: Dictionary of group name -> list of WAV filepaths.
+    """
+
+    root = storage.stimulus_root('Lumo')
+    groups = {}
+    mmn = os.path.join(root, 'mismatched_negativity_task', 'auditory_stimuli.csv')
+    if os.path.exists(mmn):
+        sounds = pd.read_csv(mmn)['sound'].unique()
+        groups['mismatched_negativity'] = [root + '/mismatched_negativity_task/auditory_stimuli/' + j + '.wav'
+                                           for j in sounds]
+    motor = os.path.join(root, 'naturalistic_motor_task', 'naturalistic_motor_task_stimuli.csv')
+    if os.path.exists(motor):
+        for j in pd.read_csv(motor)['instruction'].unique():
+            # Instructions are spoken by different voices, so each is normalised on its own
+            groups['naturalistic_motor_task/' + os.path.basename(j)] = [storage.resolve(j)]
+    return groups
+
+
+def _convert_file(args):
+    filepath, rate, channels = args
+    source_rate, samples = read_wav(filepath)
+    return filepath, convert(samples, source_rate, rate, channels)
+
+
+def _to_format(samples, sample_format):
+    dtype = FORMATS[sample_format]
+    if np.issubdtype(dtype, np.integer):
+        return np.round(samples * np.iinfo(dtype).max).astype(dtype)
+    return samples.astype(dtype)
+
+
+def preprocess(storage, rate, channels, sample_format, workers=None):
+    """
+    Converts and normalises every referenced WAV in parallel and writes the verified cache.
+
+    :param storage: Storage config; the cache is written under the stimulus root of the Lumo site.
+    :param rate: Sample rate of the output device.
+    :param channels: Channel count of the output device.
+    :param sample_format: Sample format of the output device, a key of FORMATS.
+    :param workers: Number of processes. Defaults to the number of cores.
+    :return: The manifest, mapping site-relative source paths to their converted file.
+    """
+
+    root = storage.stimulus_root('Lumo')
+    output = os.path.join(root, 'preprocessed_audio', _format_folder(rate, channels, sample_format))
+    os.makedirs(output, exist_ok=True)
+    manifest_file = os.path.join(output, MANIFEST)
+    manifest = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+
+    groups = referenced_wavs(storage)
+    files = sorted({f for group in groups.values() for f in group})
+    print(f'Preprocessing {len(files)} WAV file(s) to {rate}Hz, {channels} channel(s), {sample_format}...')
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        converted = dict(executor.map(_convert_file, [(f, rate, channels) for f in files]))
+
+    ceiling = 10 ** (PEAK_CEILING_DB / 20)
+    for group, group_files in groups.items():
+        rms = max(np.sqrt(np.mean(converted[f] ** 2)) for f in group_files)
+        peak = max(np.abs(converted[f]).max() for f in group_files)
+        gain = 10 ** (TARGET_RMS_DB / 20) / rms if rms > 0 else 1.0
+        if peak * gain > ceiling:
+            gain = ceiling / peak
+        for f in group_files:
+            key = site_relative(f, root)
+            target = os.path.join(output, key.replace(os.sep, '__').lstrip('_'))
+            wavfile.write(target, rate, _to_format(converted[f] * gain, sample_format))
+            stat = os.stat(f)
+            manifest[key] = {'file': os.path.relpath(target, output),
+                             'source_size': stat.st_size,
+                             'source_mtime': stat.st_mtime,
+                             'source_sha256': file_hash(f),
+                             'sha256': file_hash(target),
+                             'gain_db': float(20 * np.log10(gain))}
+
+    with open(manifest_file, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    print(f'Wrote {len(files)} file(s) to {output}')
+    return manifest
+
+
+class AudioCache:
+
+    def __init__(self, root, rate, channels, sample_format, verify=True):
+        """
+        Looks up the preprocessed copy of a WAV file.
+
+        :param root: Stimulus root of the site (the store or its staged cache).
+        :param rate: Sample rate, channels and sample_format of the output device (Storage.audio_format).
+        :param verify: Check the hash of every converted file when the cache is opened.
+        """
+
+        self.__root = root
+        self.__checked = {}  # site-relative source -> preprocessed copy, or None if the source has changed
+        self.__folder = os.path.join(root, 'preprocessed_audio', _format_folder(rate, channels, sample_format))
+        self.__manifest = {}
+        manifest_file = os.path.join(self.__folder, MANIFEST)
+        if os.path.exists(manifest_file):
+            with open(manifest_file) as f:
+                self.__manifest = json.load(f)
+        else:
+            print(f'No preprocessed audio in {self.__folder}, run audio_preprocessing.py')
+        if verify:
+            for key, entry in self.__manifest.items():
+                if file_hash(os.path.join(self.__folder, entry['file'])) != entry['sha256']:
+                    raise IOError('Preprocessed copy of ' + key + ' is corrupted, rerun audio_preprocessing.py')
+
+    def __source_changed(self, filepath, entry):
+        # Size and mtime are enough when they match (copies into the stimulus cache keep the mtime); otherwise the
+        # source is re-hashed, so touched but unchanged files are still used
+        stat = os.stat(filepath)
+        if stat.st_size == entry.get('source_size') and stat.st_mtime == entry.get('source_mtime'):
+            return False
+        return file_hash(filepath) != entry['source_sha256']
+
+    def resolve(self, filepath):
+        """
+        :return: The preprocessed copy of filepath, or filepath itself (with a warning) if it was not preprocessed or
+                 has changed since.
+        """
+
+        key = site_relative(filepath, self.__root)
+        if key not in self.__checked:
+            entry = self.__manifest.get(key)
+            if entry is None:
+                print(f'Warning: {filepath} has not been preprocessed and will be converted at playback')
+                self.__checked[key] = None
+            elif self.__source_changed(filepath, entry):
+                print(f'Warning: {filepath} has changed since it was preprocessed and will be converted at playback, '
+                      f'rerun audio_preprocessing.py')
+                self.__checked[key] = None
+            else:
+                self.__checked[key] = os.path.join(self.__folder, entry['file'])
+        return filepath if self.__checked[key] is None else self.__checked[key]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert task audio to the output device format')
+    parser.add_argument('--config', default=None, help='Storage config json (default: onac_config.json)')
+    parser.add_argument('--rate', type=int, default=None, help='Default: the audio rate of the storage config')
+    parser.add_argument('--channels', type=int, default=None)
+    parser.add_argument('--format', default=None, choices=list(FORMATS))
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    storage = Storage.load(args.config)
+    audio = storage.audio_format
+    preprocess(storage, args.rate or audio['rate'], args.channels or audio['channels'],
+               args.format or audio['sample_format'], args.workers)
@@ -0,0 +1,109 @@
+# Audio sequencing for the mismatched negativity task.
+
+# Renders the full standard/deviant sequence of a block into one pre-mixed buffer, with every tone placed at an exact
+# sample offset, so that the block is played as a single stream rather than one Sound per tone scheduled from the
+# frame loop. The onset of every tone is returned as a sample-indexed table, which the task uses to send each tone's
+# trigger on the flip nearest its onset and which is saved for aligning triggers offline.
+
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+from scipy.io import wavfile
+from scipy.signal import resample_poly
+from math import gcd
+
+import pandas as pd
+import numpy as np
+
+#%%%%%%%%%% Audio sequencer %%%%%%%%%%
+
+def read_wav(filepath):
+    """
+    Reads a WAV file as float32 samples in [-1, 1] with shape (samples, channels).
+
+    :return: Sample rate and samples.
+    """
+
+    rate, samples = wavfile.read(filepath)
+    if samples.dtype.kind == 'i':
+        samples = samples / float(np.iinfo(samples.dtype).max + 1)
+    elif samples.dtype.kind == 'u':  # 8-bit WAVs are unsigned
+        samples = (samples - 128) / 128.0
+    samples = np.asarray(samples, dtype=np.float32)
+    if samples.ndim == 1:
+        samples = samples[:, None]
+    return rate, samples
+
+
+def convert(samples, rate, sample_rate, channels):
+    """
+    Resamples float samples of shape (samples, channels) to sample_rate and remaps them to the given channel count.
+    """
+
+    if rate != sample_rate:
+        divisor = gcd(rate, sample_rate)
+        samples = resample_poly(samples, sample_rate // divisor, rate // divisor, axis=0)
+    if samples.shape[1] != channels:
+        samples = np.repeat(samples.mean(axis=1, keepdims=True), channels, axis=1)
+    return samples.astype(np.float32)
+
+
+class AudioSequencer:
+
+    def __init__(self, sample_rate, channels, soa=1.0):
+        """
+        :param sample_rate: Sample rate of the output device (Storage.audio_format, like the preprocessed audio).
+        :param channels: Number of output channels.
+        :param soa: Stimulus-onset asynchrony in seconds.
+        """
+
+        self.__sample_rate = sample_rate
+        self.__channels = channels
+        self.__soa = soa
+        self.__tones = {}
+
+    @property
+    def channels(self):
+        return self.__channels
+
+    @property
+    def sample_rate(self):
+        return self.__sample_rate
+
+    def tone(self, filepath):
+        """
+        :return: A tone converted to the output rate and channel layout, loaded once per file.
+        """
+
+        if filepath not in self.__tones:
+            rate, samples = read_wav(filepath)
+            self.__tones[filepath] = convert(samples, rate, self.__sample_rate, self.__channels)
+        return self.__tones[filepath]
+
+    def render(self, filepaths, triggers, conditions):
+        """
+        Mixes a block's tones into one buffer, tone k starting exactly at sample round(k * soa * sample_rate).
+
+        :param filepaths: WAV file of every tone, in order.
+        :param triggers: Trigger code of every tone.
+        :param conditions: Condition (standard/deviant) of every tone.
+        :return: Buffer of shape (samples, channels) and the onset table.
+        """
+
+        if len(filepaths) == 0:
+            raise ValueError('Cannot render a block without tones')
+        if not len(filepaths) == len(triggers) == len(conditions):
+            raise ValueError('Every tone needs one file, trigger and condition')
+        onsets = np.round(np.arange(len(filepaths)) * self.__soa * self.__sample_rate).astype(int)
+        tones = [self.tone(f) for f in filepaths]
+        length = max(onsets[-1] + len(tones[-1]), int(round(len(filepaths) * self.__soa * self.__sample_rate)))
+        buffer = np.zeros((length, self.__channels), dtype=np.float32)
+        for onset, tone in zip(onsets, tones):
+            buffer[onset:onset + len(tone)] += tone
+        np.clip(buffer, -1, 1, out=buffer)
+
+        onset_table = pd.DataFrame({'onset_sample': onsets,
+                                    'onset_time': onsets / self.__sample_rate,
+                                    'trigger': triggers,
+                                    'sound': filepaths,
+                                    'condition': conditions})
+        return buffer, onset_table
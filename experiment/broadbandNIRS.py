@@ -8,10 +8,13 @@ from random import gauss
 import psychopy.event
 import pandas as pd
 import numpy as np
-import random as rd
 import os
 import serial
 
+from session_checkpoint import SessionCheckpoint
+from session_rng import SessionRNG
+from storage import Storage
+
 # %%%%%%%%%% Path directories %%%%%%%%%%
 _thisDir = os.path.dirname(os.path.abspath(__file__))
 os.chdir(_thisDir)
@@ -21,9 +24,16 @@ os.chdir(_thisDir)
 
 class broadbandNIRS:
 
-    def __init__(self, portname, blank_rs=True, fullscreen=False):
+    def __init__(self, portname, blank_rs=True, fullscreen=False, config=None, baudrate=9600, seed=None):
         self.__port_name = portname
-        self.__path = '/Users/emilia/Documents/Dementia task piloting/Mini-CYRIL'
+        self.__baudrate = baudrate
+        self.__seed = seed
+        self.__rng = None
+        self.__checkpoint = None
+        self.__task = None
+        self.__endfilename = None
+        self.__storage = Storage.load(config)
+        self.__path = self.__storage.stimulus_root('Mini-CYRIL')
         self.__win = None
         self.__clock = None
         self.__kb = None
@@ -39,7 +49,8 @@ class broadbandNIRS:
     # %%%%% SETTING UP EXPERIMENT %%%%%
     def __setup(self):
         print(f"Setting up experiment...")
-        experiment_name = 'Optical Neuroimaging and Cognition (ONAC)'
+        # Distinct from the Lumo tasks' name, so the ExperimentHandler files of the two are told apart in analysis
+        experiment_name = 'Optical Neuroimaging and Cognition (ONAC) broadband NIRS'
         self.__experiment_info = {'Participant': ''}
         # dlg = gui.DlgFromDict(dictionary=self.__experiment_info, sortKeys=False, title=experiment_name)
         # if not dlg.OK:
@@ -49,23 +60,36 @@ class broadbandNIRS:
         self.__experiment_info['date'] = data.getDateStr()
         self.__experiment_info['expName'] = experiment_name
         self.__experiment_info['psychopyVersion'] = '2021.2.3'
+
+        # Copy stimuli to the local cache (if configured) before anything is loaded
+        self.__path = self.__storage.stage('Mini-CYRIL')
+
+        self.__rng = SessionRNG(self.__experiment_info['Participant'], seed=self.__seed)
+        self.__experiment_info['seed'] = self.__rng.seed
         filename = _thisDir + os.sep + u'data/%s_%s_%s' % (self.__experiment_info['Participant'],
                                                            experiment_name, self.__experiment_info['date'])
+        self.__endfilename = filename
+        checkpoint_file = os.path.join(self.__storage.checkpoints('Mini-CYRIL'),
+                                       'P' + str(self.__experiment_info['Participant']) + '_broadband_checkpoint.json')
+        self.__checkpoint = SessionCheckpoint(checkpoint_file, self.__experiment_info['Participant'], self.__rng,
+                                              session=self.__experiment_info['date'])
+        self.__checkpoint.save()
 
         self.__this_exp = data.ExperimentHandler(name=experiment_name, extraInfo=self.__experiment_info,
-                                                 originPath='C:/Users/emilia/Documents/Dementia task piloting/Mini-CYRIL/',
+                                                 originPath=os.path.abspath(__file__),
                                                  savePickle=True, saveWideText=True,
                                                  dataFileName=filename)
         # Setting up a log file
         log_file = logging.LogFile(filename + '.log', level=logging.EXP)
         logging.console.setLevel(logging.WARNING)
-        self.__filename_save = '/P' + str(self.__experiment_info['Participant'])
+        # Outputs are named P<n>_<session>_<suffix>, like the Lumo tasks (see analysis/cohort_index.py)
+        self.__filename_save = '/P' + str(self.__experiment_info['Participant']) + '_' + self.__checkpoint.session
 
         end_exp_now = False
         frame_tolerance = 0.001
 
         if self.__port_name is not None:
-            self.__port = serial.Serial(self.__port_name, baudrate=9600)
+            self.__port = serial.Serial(self.__port_name, baudrate=self.__baudrate)
 
         # Set up window
         self.__win = visual.Window([300, 300], color=[-1, -1, -1], fullscr=self.__fullscreen)
@@ -87,11 +111,23 @@ class broadbandNIRS:
         self.__fixation_cross = TextStim(self.__win, text='+', color=(-1, -1, 1))
 
     # %%%%% SOME USEFUL FUNCTIONS %%%%%
+    def __jitter(self):
+        return self.__rng.jitter(self.__task if self.__task is not None else 'session')
+
+    def __start_task(self, task):
+        self.__task = task
+        self.__rng.plan_jitter(task)
+
+    def __end_task(self):
+        self.__checkpoint.complete_task(self.__task)
+        self.__task = None
+
     def __baseline(self, duration=30):
         baseline_text = TextStim(self.__win, text='+', height=0.3, color=(-1, -1, 1))
+        duration = duration + self.__jitter()  # Randomise the baseline duration
         self.__win.color = [0, 0, 0]
         self.__clock.reset()
-        while self.__clock.getTime() < (duration + (rd.random() / 10)):  # Randomise the baseline duration
+        while self.__clock.getTime() < duration:
             baseline_text.draw()
             self.__win.flip()
         self.__win.color = [-1, -1, -1]
@@ -119,7 +155,7 @@ class broadbandNIRS:
         psychopy.event.waitKeys()
 
     def __wait(self, duration=2):
-        core.wait(duration + rd.random() / 10)
+        core.wait(duration + self.__jitter())
 
     def __blank_screen(self, duration=1):
         self.__blank.draw()
@@ -136,6 +172,7 @@ class broadbandNIRS:
 
         instructions = pd.read_csv(filepath)
         for j in instructions['path']:
+            j = self.__storage.resolve(j)
             instruction_stim = ImageStim(self.__win, j, units='pix', size=(1440, 900))
             instruction_stim.draw()
             self.__win.flip()
@@ -150,6 +187,7 @@ class broadbandNIRS:
         """
 
         print(f"Running resting state...")
+        self.__start_task('resting_state')
         # LOAD TRIAL COMPONENTS
         resting_state_tone = sound.Sound(value='C', secs=0.1)
 
@@ -177,6 +215,7 @@ class broadbandNIRS:
         resting_state_tone.play()
 
         self.__break()
+        self.__end_task()
 
     def breath_holding(self, duration=20):
 
@@ -186,6 +225,8 @@ class broadbandNIRS:
 
         """
 
+        self.__start_task('breath_holding')
+
         # Present instructions
         self.__present_instructions((self.__path + '/breath_holding/instructions.csv'))
 
@@ -216,6 +257,7 @@ class broadbandNIRS:
 
             df = pd.DataFrame({'condition': [condition]})
             breath_holding_data.append(df)
+            self.__checkpoint.complete_block('breath_holding', i, [{'condition': condition}])
 
             if i in [4, 8]:
                 self.__break_mid()
@@ -225,8 +267,9 @@ class broadbandNIRS:
         # Data saving
         print(f"Saving data...")
         breath_holding_data = pd.concat(breath_holding_data, ignore_index=True)
-        breath_holding_data.to_csv((self.__path + '/breath_holding/participant_data/P' + \
-                                    str(self.__experiment_info['Participant'] + '_breath_holding_data.csv')))
+        breath_holding_data.to_csv((self.__storage.participant_data('Mini-CYRIL', 'breath_holding') +
+                                    self.__filename_save + '_breath_holding_data.csv'))
+        self.__end_task()
 
     def __end_all_experiment(self, duration=3):
         """
@@ -243,6 +286,7 @@ class broadbandNIRS:
         self.__wait(duration)
         self.__win.mouseVisible = True
         self.__win.flip()
+        self.__rng.save_plan(self.__endfilename + '_rng_plan.json')
         # self.__port.close()
         self.__win.close()
         core.quit()
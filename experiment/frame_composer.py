@@ -0,0 +1,94 @@
+# Frame composition for the ONAC tasks.
+
+# Each visual layer of a task phase (e.g. a wedge and the fixation cross, or a prompt text) is rendered once into a
+# single texture with BufferImageStim, so that every frame of the phase is one textured quad draw instead of several
+# draws and text re-layouts. The CPU time spent drawing each frame is recorded so the saving can be measured.
+
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+from psychopy import visual
+
+import numpy as np
+import time
+
+# Number of per-frame costs kept (about 10 minutes at 60Hz); older values are overwritten
+COST_BUFFER_SIZE = 36000
+
+#%%%%%%%%%% Frame composer %%%%%%%%%%
+
+class FrameComposer:
+
+    def __init__(self, win):
+        self.__win = win
+        self.__frames = {}
+        self.__costs = np.zeros(COST_BUFFER_SIZE)
+        self.__n_costs = 0
+
+    def compose(self, name, stimuli, rect=(-1, 1, 1, -1), background=None):
+        """
+        Renders a list of stimuli, in order, into one texture. This clears the back buffer, so it must be called
+        before a timed phase starts, never during one.
+
+        :param name: Name used to draw the composite later.
+        :param stimuli: List of stimuli to draw, back to front.
+        :param rect: Region of the window to capture as [left, top, right, bottom] in norm units.
+        :param background: Window colour to capture the stimuli against, if different from the current colour.
+        :return: The composite stimulus.
+        """
+
+        if name in self.__frames:
+            return self.__frames[name]
+        colour = self.__win.color
+        if background is not None:
+            self.__win.color = background
+        self.__win.clearBuffer()
+        self.__frames[name] = visual.BufferImageStim(self.__win, stim=stimuli, rect=list(rect))
+        self.__win.color = colour
+        self.__win.clearBuffer()
+        return self.__frames[name]
+
+    def has(self, name):
+        return name in self.__frames
+
+    def draw(self, name):
+        """
+        Draws a composite and records the CPU time the draw call took.
+        """
+
+        start = time.perf_counter()
+        self.__frames[name].draw()
+        self.__costs[self.__n_costs % COST_BUFFER_SIZE] = time.perf_counter() - start
+        self.__n_costs += 1
+
+    def time_draw(self, stimulus):
+        """
+        Draws a stimulus that is not composed (e.g. an image that changes every trial), recording its cost like draw().
+        """
+
+        start = time.perf_counter()
+        stimulus.draw()
+        self.__costs[self.__n_costs % COST_BUFFER_SIZE] = time.perf_counter() - start
+        self.__n_costs += 1
+
+    def release(self, name):
+        self.__frames.pop(name, None)
+
+    #%%%%% CPU COST %%%%%
+    def frame_costs(self):
+        """
+        :return: Per-frame draw CPU time in seconds since the last reset (at most COST_BUFFER_SIZE values).
+        """
+
+        return self.__costs[:min(self.__n_costs, COST_BUFFER_SIZE)].copy()
+
+    def report(self, label):
+        """
+        Prints the mean and 95th percentile per-frame draw cost and resets the counter.
+        """
+
+        costs = self.frame_costs()
+        if len(costs) > 0:
+            print(f'{label}: {len(costs)} frames, draw cost mean {np.mean(costs) * 1e6:.0f}us, '
+                  f'95th percentile {np.percentile(costs, 95) * 1e6:.0f}us')
+        self.__n_costs = 0
+        return costs
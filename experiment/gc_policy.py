@@ -0,0 +1,210 @@
+# Garbage collection policy and profiling for the ONAC tasks.
+
+# Every cyclic garbage collection pause is timed (via gc.callbacks) and attributed to the current task and phase,
+# along with the number of memory blocks allocated in each phase (and, optionally, the source lines allocating them,
+# via tracemalloc).
+
+# Policies:
+#   - 'default': Python's automatic collection, profiled only.
+#   - 'controlled': objects alive after setup are frozen, automatic collection is disabled, and the garbage is
+#     collected explicitly at the collection points (breaks, baselines and instruction screens), so no pause can land
+#     in a timed phase.
+
+# Run this file to compare the pause distributions of both policies in a simulated frame loop.
+
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+import numpy as np
+import argparse
+import gc
+import sys
+import time
+import tracemalloc
+
+POLICIES = ['default', 'controlled']
+
+#%%%%%%%%%% GC policy %%%%%%%%%%
+
+class GCPolicy:
+
+    def __init__(self, policy='default', allocations=False):
+        """
+        :param policy: One of POLICIES.
+        :param allocations: Also record the top allocating source lines of every phase with tracemalloc (slow).
+        """
+
+        if policy not in POLICIES:
+            raise ValueError('Unknown GC policy: ' + str(policy))
+        self.__policy = policy
+        self.__allocations = allocations
+        self.__task = 'session'
+        self.__phase = 'setup'
+        self.__explicit = False
+        self.__start = None
+        self.__pauses = []  # One record per collection
+        self.__phases = {}  # (task, phase) -> {'blocks': allocated blocks, 'entered': count, 'top': [...]}
+        self.__blocks = None
+        self.__snapshot = None
+
+    @property
+    def policy(self):
+        return self.__policy
+
+    #%%%%% SESSION LIFECYCLE %%%%%
+    def start(self):
+        """
+        Starts profiling and applies the policy. Call once setup has loaded everything that lives for the session.
+        """
+
+        gc.callbacks.append(self.__callback)
+        if self.__allocations:
+            tracemalloc.start()
+            self.__snapshot = tracemalloc.take_snapshot()
+        self.__blocks = sys.getallocatedblocks()
+        if self.__policy == 'controlled':
+            gc.disable()
+            self.collect('setup')
+            gc.freeze()  # Long-lived objects are no longer scanned by later collections
+
+    def stop(self):
+        self.__account()
+        if self.__callback in gc.callbacks:
+            gc.callbacks.remove(self.__callback)
+        if self.__policy == 'controlled':
+            gc.enable()
+            gc.unfreeze()
+        if self.__allocations:
+            tracemalloc.stop()
+
+    def __callback(self, event, info):
+        if event == 'start':
+            self.__start = time.perf_counter()
+        elif self.__start is not None:
+            self.__pauses.append({'policy': self.__policy, 'task': self.__task, 'phase': self.__phase,
+                                  'generation': info['generation'], 'collected': info['collected'],
+                                  'explicit': self.__explicit, 'pause_ms': (time.perf_counter() - self.__start) * 1e3})
+            self.__start = None
+
+    #%%%%% PHASES %%%%%
+    def __account(self):
+        """
+        Attributes the allocations since the last phase change to the current phase.
+        """
+
+        if self.__blocks is None:
+            return
+        usage = self.__phases.setdefault((self.__task, self.__phase), {'blocks': 0, 'entered': 0, 'top': []})
+        blocks = sys.getallocatedblocks()
+        usage['blocks'] += blocks - self.__blocks
+        self.__blocks = blocks
+        if self.__allocations:
+            snapshot = tracemalloc.take_snapshot()
+            top = snapshot.compare_to(self.__snapshot, 'lineno')[:5]
+            usage['top'] = [str(stat) for stat in top]
+            self.__snapshot = snapshot
+
+    def set_task(self, task):
+        self.phase('start', task)
+
+    def phase(self, phase, task=None):
+        """
+        Marks the start of a phase, e.g. a timed stimulus loop.
+
+        :param phase: Name of the phase.
+        :param task: Name of the task, if it has changed.
+        """
+
+        self.__account()
+        if task is not None:
+            self.__task = task
+        self.__phase = phase
+        self.__phases.setdefault((self.__task, self.__phase), {'blocks': 0, 'entered': 0, 'top': []})['entered'] += 1
+
+    def collect(self, phase, force=False):
+        """
+        A collection point, where a pause cannot disturb stimulus timing. Collects the garbage under the controlled
+        policy; under the default policy only marks the phase.
+
+        :param force: Collect under every policy, e.g. to free the resources released at the end of a task.
+        """
+
+        self.phase(phase)
+        if force or self.__policy == 'controlled':
+            self.__explicit = True
+            gc.collect()
+            self.__explicit = False
+
+    #%%%%% REPORTING %%%%%
+    def pauses(self):
+        return list(self.__pauses)
+
+    def allocations(self):
+        """
+        :return: Allocated blocks per task and phase, as a list of dictionaries.
+        """
+
+        return [{'policy': self.__policy, 'task': task, 'phase': phase, 'entered': usage['entered'],
+                 'allocated_blocks': usage['blocks'], 'top_allocations': ' | '.join(usage['top'])}
+                for (task, phase), usage in self.__phases.items()]
+
+    def summary(self):
+        """
+        Prints the distribution of collection pauses outside the collection points, per task.
+        """
+
+        pauses = [p for p in self.__pauses if not p['explicit']]
+        print(f'GC policy {self.__policy}: {len(pauses)} automatic collection(s), '
+              f'{len(self.__pauses) - len(pauses)} explicit')
+        for task in dict.fromkeys(p['task'] for p in pauses):
+            durations = np.array([p['pause_ms'] for p in pauses if p['task'] == task])
+            print(f'{task}: {len(durations)} pause(s), median {np.median(durations):.3f}ms, '
+                  f'99th percentile {np.percentile(durations, 99):.3f}ms, max {durations.max():.3f}ms')
+
+#%%%%%%%%%% Benchmark %%%%%%%%%%
+
+class _Node:
+    def __init__(self):
+        self.other = self  # A reference cycle, only freed by the cyclic collector
+
+
+def benchmark(n_frames=3600, frame_dur=1 / 60, block_frames=600):
+    """
+    Runs a simulated frame loop that allocates like the task loops (cycles, strings, small lists) under each policy.
+    Every block_frames frames there is a baseline, which is a collection point.
+    """
+
+    session_objects = [_Node() for _ in range(200000)]  # Long-lived objects loaded at setup
+    results = {}
+    for policy in POLICIES:
+        gc_policy = GCPolicy(policy)
+        gc_policy.start()
+        gc_policy.set_task('benchmark')
+        late = 0
+        deadline = time.perf_counter()
+        for i in range(n_frames):
+            if i % block_frames == 0:
+                gc_policy.collect('baseline')
+                gc_policy.phase('stimulus')
+                deadline = time.perf_counter()  # The baseline is not timed
+            garbage = [_Node() for _ in range(300)]
+            trigger = 'E' + str(i)
+            wedge = [i % 2, i % 3, trigger]
+            deadline += frame_dur
+            if time.perf_counter() > deadline:
+                late += 1
+            while time.perf_counter() < deadline:
+                pass
+        gc_policy.stop()
+        gc_policy.summary()
+        print(f'{policy}: {late} late frame(s) during stimulation')
+        results[policy] = gc_policy.pauses()
+    del session_objects
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare GC pause distributions of the GC policies')
+    parser.add_argument('--frames', type=int, default=3600)
+    parser.add_argument('--fps', type=float, default=60)
+    args = parser.parse_args()
+    benchmark(args.frames, 1 / args.fps)
@@ -0,0 +1,353 @@
+# Process-isolated I/O for the ONAC tasks.
+
+# The render loop (win.flip() and everything timed against it) stays in the main process, which is given elevated
+# scheduling priority. ExperimentHandler data, CSV writing and stimulus preloading are sent to a worker process
+# through a shared-memory ring (see shared_ring.py), so the frame loop never touches disk or pandas.
+
+# Serial triggers are written directly from the render process by default, so a trigger sent with callOnFlip leaves
+# on the flip itself (~0.07ms per write). Handing them to the worker instead adds 1-5ms of host latency (the worker's
+# polling and scheduling, see trigger_latency.py); direct_triggers=False keeps that option for setups where a serial
+# write can block. Triggers are still passed to the worker afterwards, to be published as telemetry.
+
+# Errors and acknowledgements come back on a second ring; check() raises them in the render process between blocks,
+# so a failed save stops the session instead of being found at the end.
+
+# Run this file to benchmark frame timing with inline I/O against the worker.
+
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+import multiprocessing as mp
+import numpy as np
+import argparse
+import os
+import pickle
+import tempfile
+import time
+
+from shared_ring import SharedRing
+from telemetry import TelemetryPublisher
+
+# Message types
+TRIGGER, ADD_DATA, NEXT_ENTRY, WRITE_CSV, PRELOAD, SAVE, SYNC, STOP = range(8)
+
+# How long the worker sleeps when there is nothing to do; bounds the added trigger latency
+POLL_INTERVAL = 0.0002
+
+#%%%%%%%%%% Worker process %%%%%%%%%%
+
+def _lower_priority():
+    try:
+        os.nice(5)
+    except (AttributeError, OSError):  # Not available on Windows
+        pass
+
+
+def _preload(filepath):
+    # Reading the file once puts it in the OS page cache, so the render process loads it from memory
+    with open(filepath, 'rb') as f:
+        while f.read(1 << 20):
+            pass
+
+
+def _write_csv(records, filepath, kwargs):
+    import pandas as pd
+    folder = os.path.dirname(filepath)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    pd.DataFrame(records).to_csv(filepath, **kwargs)
+
+
+def io_worker(requests_name, replies_name, port_name, baudrate, handler_kwargs, telemetry=None, direct=False):
+    """
+    Main loop of the worker process. Owns the ExperimentHandler and (unless triggers are written directly by the
+    render process) the serial port, and publishes every trigger once it has been written to the port.
+    """
+
+    _lower_priority()
+    requests = SharedRing(requests_name)
+    replies = SharedRing(replies_name)
+    try:
+        port = None
+        if port_name is not None:
+            import serial
+            port = serial.Serial(port_name, baudrate=baudrate)
+        publisher = TelemetryPublisher(telemetry, source='io_worker')
+        this_exp = None
+        if handler_kwargs is not None:
+            from psychopy import data
+            this_exp = data.ExperimentHandler(**handler_kwargs)
+    except Exception as e:
+        replies.put(pickle.dumps(('failed', repr(e))))
+        requests.close()
+        replies.close()
+        return
+    replies.put(pickle.dumps(('ready',)))
+
+    running = True
+    while running:
+        message = requests.get()
+        if message is None:
+            time.sleep(POLL_INTERVAL)
+            continue
+        kind, args = pickle.loads(message)
+        try:
+            if kind == TRIGGER:
+                if port is not None:
+                    port.write(args)
+                publisher.publish('trigger', code=args.decode(), port=port is not None or direct)
+            elif kind == ADD_DATA:
+                this_exp.addData(*args)
+            elif kind == NEXT_ENTRY:
+                this_exp.nextEntry()
+            elif kind == WRITE_CSV:
+                _write_csv(*args)
+            elif kind == PRELOAD:
+                _preload(args)
+            elif kind == SAVE:
+                this_exp.saveAsWideText(args + '.csv', delim='auto')
+                this_exp.saveAsPickle(args)
+            elif kind == SYNC:
+                replies.put(pickle.dumps(('synced', args)))
+            elif kind == STOP:
+                running = False
+        except Exception as e:
+            replies.put(pickle.dumps(('error', kind, repr(e))))
+
+    if port is not None:
+        port.close()
+    publisher.close()
+    requests.close()
+    replies.close()
+
+#%%%%%%%%%% Render-process side %%%%%%%%%%
+
+class IOBridge:
+
+    def __init__(self, port_name=None, baudrate=9600, handler_kwargs=None, capacity=1 << 22, telemetry=None,
+                 direct_triggers=True):
+        """
+        Starts the I/O worker.
+
+        :param port_name: Serial port of the NIRS trigger box, or None to run without triggers.
+        :param baudrate: Baud rate of the serial port.
+        :param direct_triggers: Write triggers to the port from the render process (True) or from the worker.
+        :param handler_kwargs: Arguments of psychopy.data.ExperimentHandler, created in the worker.
+        :param capacity: Size of the request ring in bytes.
+        :param telemetry: (host, port) to publish sent triggers to, or None.
+        """
+
+        self.__requests = SharedRing(capacity=capacity)
+        self.__replies = SharedRing(capacity=1 << 16)
+        self.__dropped = 0
+        self.__syncs = 0
+        self.__errors = []
+        self.__port = None
+        direct = direct_triggers and port_name is not None
+        self.__worker = mp.get_context('spawn').Process(target=io_worker, daemon=True,
+                                                        args=(self.__requests.name, self.__replies.name,
+                                                              None if direct else port_name, baudrate,
+                                                              handler_kwargs, telemetry, direct))
+        try:
+            if direct:
+                import serial
+                self.__port = serial.Serial(port_name, baudrate=baudrate)
+            self.__worker.start()
+            self.__wait_until_ready()
+        except BaseException:
+            # Don't leak the port or the shared memory blocks if the worker cannot start
+            if self.__port is not None:
+                self.__port.close()
+            if self.__worker.is_alive():
+                self.__worker.terminate()
+            self.__requests.close()
+            self.__replies.close()
+            raise
+
+    def __wait_until_ready(self, timeout=60):
+        # Blocks until the worker has opened the port, so the first trigger is not delayed by its start-up
+        deadline = time.perf_counter() + timeout
+        while True:
+            reply = self.__replies.get()
+            if reply is not None:
+                reply = pickle.loads(reply)
+                if reply[0] == 'ready':
+                    return
+                raise RuntimeError('The I/O worker failed to start: ' + reply[1])
+            if not self.__worker.is_alive() or time.perf_counter() > deadline:
+                raise RuntimeError('The I/O worker failed to start')
+            time.sleep(0.01)
+
+    def __send(self, kind, args=None):
+        message = pickle.dumps((kind, args), protocol=pickle.HIGHEST_PROTOCOL)
+        if not self.__requests.put(message):
+            # Only happens if the worker has stalled for a long time; wait rather than lose data
+            self.__dropped += 1
+            while not self.__requests.put(message):
+                if not self.__worker.is_alive():
+                    raise RuntimeError('The I/O worker has stopped')
+                time.sleep(POLL_INTERVAL)
+
+    #%%%%% HOT LOOP %%%%%
+    def trigger(self, code):
+        """
+        Sends a trigger code to the NIRS system. Safe to use with win.callOnFlip.
+        """
+
+        code = code.encode() if isinstance(code, str) else code
+        if self.__port is not None:
+            self.__port.write(code)
+        self.__send(TRIGGER, code)
+
+    def add_data(self, name, value):
+        self.__send(ADD_DATA, (name, value))
+
+    def next_entry(self):
+        self.__send(NEXT_ENTRY)
+
+    #%%%%% BETWEEN BLOCKS %%%%%
+    def write_csv(self, records, filepath, **kwargs):
+        """
+        Writes a list of dictionaries as a csv (via pandas.DataFrame.to_csv) in the worker.
+        """
+
+        self.__send(WRITE_CSV, (records, filepath, kwargs))
+
+    def preload(self, filepath):
+        self.__send(PRELOAD, str(filepath))
+
+    def save(self, filename):
+        """
+        Saves the ExperimentHandler as wide text and pickle.
+        """
+
+        self.__send(SAVE, filename)
+
+    def __read_replies(self):
+        synced = set()
+        reply = self.__replies.get()
+        while reply is not None:
+            reply = pickle.loads(reply)
+            if reply[0] == 'synced':
+                synced.add(reply[1])
+            else:
+                self.__errors.append(reply)
+            reply = self.__replies.get()
+        return synced
+
+    def errors(self):
+        """
+        :return: Errors reported by the worker since the last call.
+        """
+
+        self.__read_replies()
+        errors, self.__errors = self.__errors, []
+        return errors
+
+    def check(self, wait=True, timeout=30):
+        """
+        Raises the errors reported by the worker. Call between blocks and after saving, never in the frame loop.
+
+        :param wait: Wait until every request sent so far has been handled (e.g. so a csv write has finished).
+        """
+
+        if wait:
+            self.__syncs += 1
+            self.__send(SYNC, self.__syncs)
+            deadline = time.perf_counter() + timeout
+            while self.__syncs not in self.__read_replies():
+                if not self.__worker.is_alive():
+                    raise RuntimeError('The I/O worker has stopped')
+                if time.perf_counter() > deadline:
+                    raise RuntimeError(f'The I/O worker did not respond within {timeout}s')
+                time.sleep(POLL_INTERVAL)
+        errors = self.errors()
+        if errors:
+            raise RuntimeError('I/O worker error(s): ' + '; '.join(str(e) for e in errors))
+
+    def close(self, timeout=30):
+        """
+        Stops the worker once every queued request has been handled.
+        """
+
+        self.__send(STOP)
+        self.__worker.join(timeout)
+        if self.__port is not None:
+            self.__port.close()
+        errors = self.errors()
+        if self.__dropped:
+            print(f'The I/O ring was full {self.__dropped} time(s)')
+        self.__requests.close()
+        self.__replies.close()
+        if errors:
+            raise RuntimeError('I/O worker error(s): ' + '; '.join(str(e) for e in errors))
+
+#%%%%%%%%%% Benchmark %%%%%%%%%%
+
+def _frame_loop(n_frames, frame_dur, on_frame):
+    """
+    Simulates a vsync-locked loop: per-frame work, then a busy-wait until the next frame deadline.
+
+    :return: Array of frame intervals in seconds.
+    """
+
+    flips = np.zeros(n_frames)
+    deadline = time.perf_counter()
+    for i in range(n_frames):
+        on_frame(i)
+        deadline += frame_dur
+        while time.perf_counter() < deadline:
+            pass
+        now = time.perf_counter()
+        if now - deadline > frame_dur:  # Missed a frame: re-sync to the next vsync
+            deadline += frame_dur * np.floor((now - deadline) / frame_dur)
+        flips[i] = now
+    return np.diff(flips)
+
+
+def benchmark(n_frames=1800, frame_dur=1 / 60, rows_per_flush=150):
+    """
+    Compares frame intervals when trial data and triggers are handled inline in the frame loop with handing them to
+    the I/O worker. Every frame sends a trigger and adds a data row (a dictionary, in both cases); every
+    rows_per_flush frames the rows so far are written to a csv with pandas, as at the end of a block, so the two loops
+    do the same work and differ only in where the csv is written.
+    """
+
+    import pandas  # Imported up front, so the first inline flush does not time the import
+    folder = tempfile.mkdtemp()
+    devnull = open(os.devnull, 'wb')
+    records = []
+
+    def inline(i):
+        devnull.write(b'E')
+        records.append({'frame': i, 'value': i * 0.5})
+        if i % rows_per_flush == rows_per_flush - 1:
+            _write_csv(records, os.path.join(folder, 'inline.csv'), {})
+
+    bridge = IOBridge()
+    bridge_records = []
+
+    def worker(i):
+        bridge.trigger('E')
+        bridge_records.append({'frame': i, 'value': i * 0.5})
+        if i % rows_per_flush == rows_per_flush - 1:
+            bridge.write_csv(bridge_records, os.path.join(folder, 'worker.csv'))
+
+    results = {}
+    for label, on_frame in (('inline', inline), ('worker', worker)):
+        intervals = _frame_loop(n_frames, frame_dur, on_frame)
+        dropped = int(np.sum(intervals > frame_dur * 1.5))
+        results[label] = intervals
+        print(f'{label}: mean {np.mean(intervals) * 1e3:.3f}ms, 99th percentile '
+              f'{np.percentile(intervals, 99) * 1e3:.3f}ms, max {np.max(intervals) * 1e3:.3f}ms, '
+              f'{dropped} dropped frame(s)')
+    bridge.close()
+    devnull.close()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Frame-time benchmark of inline I/O against the I/O worker')
+    parser.add_argument('--frames', type=int, default=1800)
+    parser.add_argument('--fps', type=float, default=60)
+    args = parser.parse_args()
+    benchmark(args.frames, 1 / args.fps)
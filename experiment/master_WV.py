@@ -14,11 +14,22 @@ from psychopy.constants import FINISHED, NOT_STARTED
 import psychopy.event
 import pandas as pd
 import numpy as np
-import random as rd
 import os
-import serial
 import psychtoolbox as ptb
-import random as rd
+import argparse
+
+from session_checkpoint import SessionCheckpoint
+from resource_manager import ResourceManager
+from session_rng import SessionRNG
+from storage import Storage
+from frame_composer import FrameComposer
+from audio_sequencer import AudioSequencer
+from audio_preprocessing import AudioCache
+from video_transcoding import VideoCache
+from io_bridge import IOBridge
+from gc_policy import GCPolicy, POLICIES
+from telemetry import TelemetryPublisher, DEFAULT_ADDRESS, parse_address
+from oddball_sequences import participant_file
 
 #%%%%%%%%%% Path directories %%%%%%%%%%
 _thisDir = os.path.dirname(os.path.abspath(__file__))
@@ -26,56 +37,107 @@ os.chdir(_thisDir)
 
 #%%%%%%%%%% Experiment %%%%%%%%%%
 
+# Tasks in the order they are run in a full session
+TASKS = ['overall_instructions', 'object_recognition', 'mismatched_negativity', 'resting_state', 'memory_task',
+         'visual_stimulation', 'naturalistic_motor_task']
+
 class Experiment:
 
-    def __init__(self, portname, memory_condition, blank_rs=True, fullscreen=False):
+    def __init__(self, portname, memory_condition, blank_rs=True, fullscreen=False, participant=None, tasks=None,
+                 resume=False, fresh=False, seed=None, config=None, gc_policy='default', profile_allocations=False,
+                 telemetry=DEFAULT_ADDRESS, baudrate=9600):
         self.__port_name = portname
-        self.__path = '/Users/emilia/Documents/Dementia task piloting/Lumo'
+        self.__baudrate = baudrate
+        self.__storage = Storage.load(config)
+        self.__path = self.__storage.stimulus_root('Lumo')
         self.__win = None
         self.__clock = None
         self.__kb = None
-        self.__port = None
+        self.__io = None
         self.__blank = None
         self.__fixation_cross = None
         self.__filename_save = None
         self.__experiment_info = None
-        self.__this_exp = None
         self.__endfilename = None
         self.__rs_format = blank_rs
         self.__fullscreen = fullscreen
         self.__memory_condition = memory_condition
+        self.__participant = participant
+        self.__tasks = TASKS if tasks is None else tasks
+        for task in self.__tasks:
+            if task not in TASKS:
+                raise ValueError('Unknown task: ' + str(task))
+        self.__resume = resume
+        self.__fresh = fresh
+        self.__checkpoint = None
+        self.__baseline_text = None
+        self.__frames = None
+        self.__audio = None
+        self.__video = None
+        self.__seed = seed
+        self.__rng = None
+        self.__task = None
+        self.__frame_dur = None
+        self.__gc = GCPolicy(gc_policy, allocations=profile_allocations)
+        # Resources are freed at the end of each task, a collection point, so the collection is not counted as a pause
+        self.__resources = ResourceManager(collect=lambda: self.__gc.collect('release', force=True))
+        self.__telemetry_address = telemetry
+        self.__telemetry = TelemetryPublisher(telemetry)
 
     #%%%%% SETTING UP EXPERIMENT %%%%%
     def __setup(self):
         print(f"Setting up experiment...")
         experiment_name = 'Optical Neuroimaging and Cognition (ONAC)'
         self.__experiment_info = {'Participant': ''}
-        dlg = gui.DlgFromDict(dictionary=self.__experiment_info, sortKeys=False, title=experiment_name)
-        if not dlg.OK:
-            print("User pressed 'Cancel'!")
-            core.quit()
+        if self.__participant is not None:
+            self.__experiment_info['Participant'] = str(self.__participant)
+        else:
+            dlg = gui.DlgFromDict(dictionary=self.__experiment_info, sortKeys=False, title=experiment_name)
+            if not dlg.OK:
+                print("User pressed 'Cancel'!")
+                core.quit()
 
         self.__experiment_info['date'] = data.getDateStr()
         self.__experiment_info['expName'] = experiment_name
         self.__experiment_info['psychopyVersion'] = '2021.2.3'
+        # Copy stimuli to the local cache (if configured) before anything is loaded
+        self.__path = self.__storage.stage('Lumo')
+        self.__audio = AudioCache(self.__path, **self.__storage.audio_format)
+        self.__video = VideoCache(self.__path)
+
+        self.__rng = SessionRNG(self.__experiment_info['Participant'], seed=self.__seed)
         self.__endfilename = _thisDir + os.sep + u'data/%s_%s_%s' % (self.__experiment_info['Participant'],
                                                            experiment_name, self.__experiment_info['date'])
 
-        self.__this_exp = data.ExperimentHandler(name=experiment_name, extraInfo=self.__experiment_info,
-                                                 originPath='C:/Users/emilia/Documents/Dementia task piloting/Lumo/dementia_task_piloting/',
-                                                 savePickle=True, saveWideText=True,
-                                                 dataFileName=filename)
         # Setting up a log file
-        log_file = logging.LogFile(filename + '.log', level=logging.EXP)
+        log_file = logging.LogFile(self.__endfilename + '.log', level=logging.EXP)
         logging.console.setLevel(logging.WARNING)
-        self.__filename_save = '/P' + str(self.__experiment_info['Participant'])
+
+        # Session checkpoint
+        # Kept under the output root with the participant data, not next to the code
+        checkpoint_file = os.path.join(self.__storage.checkpoints('Lumo'),
+                                       'P' + str(self.__experiment_info['Participant']) + '_session_checkpoint.json')
+        if self.__resume:
+            self.__checkpoint = SessionCheckpoint.load(checkpoint_file, self.__experiment_info['Participant'], self.__rng,
+                                                       session=self.__experiment_info['date'])
+        else:
+            if SessionCheckpoint.unfinished(checkpoint_file) and not self.__fresh:
+                raise RuntimeError('Participant ' + str(self.__experiment_info['Participant']) + ' has an unfinished '
+                                   'session (' + checkpoint_file + '): run with --resume to continue it, or --fresh '
+                                   'to start a new session and overwrite it')
+            self.__checkpoint = SessionCheckpoint(checkpoint_file, self.__experiment_info['Participant'], self.__rng,
+                                                  session=self.__experiment_info['date'])
+            self.__checkpoint.save()
+        # Recorded once a resumed session's RNG has been restored, so it is the seed that generated the session
+        self.__experiment_info['seed'] = self.__rng.seed
+        # Task outputs are named P<n>_<session>_<suffix> by the date and time the session started, which a resumed
+        # session keeps, so every file of a visit carries the same session (see analysis/cohort_index.py)
+        self.__experiment_info['session'] = self.__checkpoint.session
+        self.__filename_save = '/P' + str(self.__experiment_info['Participant']) + '_' + self.__checkpoint.session
 
         end_exp_now = False
         frame_tolerance = 0.001
 
-        if self.__port_name is not None:
-            self.__port = serial.Serial(self.__port_name, baudrate=9600)
-
         # Set up window
         # self.__win = visual.Window([1440, 900], color=[-1, -1, -1], fullscr=True)
         self.__win = visual.Window([300, 300], color=[-1, -1, -1], fullscr=self.__fullscreen)
@@ -86,44 +148,80 @@ class Experiment:
             frame_dur = 1.0 / round(self.__experiment_info['frameRate'])
         else:
             frame_dur = 1.0 / 60.0
+        self.__frame_dur = frame_dur
+
+        # Frames longer than this are counted as dropped
+        self.__win.refreshThreshold = frame_dur + 0.004
+
+        # The ExperimentHandler lives in a worker process, so that trial data and file writes never block the frame
+        # loop; triggers are written to the serial port directly, on the flip. Started after the frame rate is known,
+        # as extraInfo is copied to it
+        self.__io = IOBridge(self.__port_name, baudrate=self.__baudrate,
+                             handler_kwargs={'name': experiment_name, 'extraInfo': self.__experiment_info,
+                                             'originPath': os.path.abspath(__file__),
+                                             'savePickle': True, 'saveWideText': True,
+                                             'dataFileName': self.__endfilename},
+                             telemetry=self.__telemetry_address)
 
         # Hide mouse
         self.__win.mouseVisible = False
 
+        # The render loop gets elevated priority; I/O runs at lower priority in the worker
+        core.rush(True)
+
         # Setting up useful trial components
         self.__clock = core.Clock()
         self.__kb = keyboard.Keyboard()
-        self.__blank = TextStim(self.__win, text='')
-        self.__fixation_cross = TextStim(self.__win, text='+', color=(-1, -1, 1))
+        self.__blank = self.__resources.text(self.__win, 'blank', session=True, text='')
+        self.__fixation_cross = self.__resources.text(self.__win, 'fixation_cross', session=True, text='+',
+                                                      color=(-1, -1, 1))
+        self.__baseline_text = self.__resources.text(self.__win, 'baseline_text', session=True, text='+', height=0.3,
+                                                     color=(-1, -1, 1))
+
+        # Pre-rendered frame layers
+        self.__frames = FrameComposer(self.__win)
+        self.__frames.compose('baseline', [self.__baseline_text], rect=(-0.2, 0.2, 0.2, -0.2), background=[0, 0, 0])
+
+        # Everything loaded so far lives for the whole session
+        self.__gc.start()
 
 #%%%%% SOME USEFUL FUNCTIONS %%%%%
 
+    def __jitter(self):
+        return self.__rng.jitter(self.__task if self.__task is not None else 'session')
+
     def __baseline(self, duration=30):
-        baseline_text = TextStim(self.__win, text='+', height=0.3, color=(-1, -1, 1))
+        self.__gc.collect('baseline')
+        self.__resources.sample()
+        duration = duration + self.__jitter()  # Randomise the baseline duration
         self.__win.color = [0, 0, 0]
+        self.__telemetry.pause()
         self.__clock.reset()
-        while self.__clock.getTime() < (duration+(rd.random()/10)):  # Randomise the baseline duration
-            baseline_text.draw()
+        while self.__clock.getTime() < duration:
+            self.__frames.draw('baseline')
             self.__win.flip()
+            self.__telemetry.frame()
         self.__win.color = [-1, -1, -1]
         self.__win.flip()
 
     def __break(self):
         print(f'Break time!')
+        self.__telemetry.publish('status', text='Break')
         break_text = (self.__path + '/Instructions/task_finished.png')
-        break_stim = ImageStim(self.__win, break_text, units='pix', size=(1440, 900))
+        break_stim = self.__resources.image(self.__win, break_text, session=True)
         break_stim.draw()
         self.__win.flip()
+        self.__gc.collect('break')
         psychopy.event.waitKeys()
 
     def __ready(self):
-        ready_text = ImageStim(self.__win, image=(self.__path + '/ready.png'), units='pix', size=(1440, 900))
+        ready_text = self.__resources.image(self.__win, self.__path + '/ready.png', session=True)
         ready_text.draw()
         self.__win.flip()
         psychopy.event.waitKeys()
 
     def __wait(self, duration=2):
-        core.wait(duration+rd.random()/10)
+        core.wait(duration + self.__jitter())
 
     def __blank_screen(self, duration=1, colour='black'):
         if colour == 'black':
@@ -149,13 +247,16 @@ class Experiment:
 
         instructions = pd.read_csv(filepath)
         for j in instructions['path']:
-            instruction_stim = ImageStim(self.__win, j, units='pix', size=(1440, 900))
+            j = self.__storage.resolve(j)
+            instruction_stim = self.__resources.image(self.__win, j)
             instruction_stim.draw()
             self.__win.flip()
+            self.__gc.collect('instructions')
             psychopy.event.waitKeys()
+            self.__resources.release(j)
 
     def __showimage(self, image, duration=None):
-        showimg = ImageStim(self.__win, image=(self.__path + image))
+        showimg = self.__resources.image(self.__win, self.__path + image)
         showimg.draw()
         self.__win.flip()
         if duration is not None:
@@ -163,6 +264,7 @@ class Experiment:
             self.__win.flip()
         else:
             psychopy.event.waitKeys()
+        self.__resources.release(self.__path + image)
 
     def __chunking(self, lst, n):
         for i in range(0, len(lst), n):
@@ -231,41 +333,57 @@ class Experiment:
 
         # # EXPERIMENT BLOCK
         print(f'Starting object recognition testing trials...')
-        object_stim = ImageStim(self.__win, units='pix', size=(900, 600))
-
-        for k in object_stimuli:
+        object_stim = self.__resources.acquire('object_stim', lambda: ImageStim(self.__win, units='pix', size=(900, 600)),
+                                               nbytes=900 * 600 * 4)
+        start_block = self.__checkpoint.next_block('object_recognition')
+
+        for block_number, k in enumerate(object_stimuli):
+            if block_number < start_block:
+                continue
+            # Warm the OS file cache for this block's images while the baseline is shown
+            for j in k:
+                self.__io.preload(self.__path + img_path + j)
             self.__baseline(5) # Baseline duration
-            self.__win.callOnFlip(self.__port.write, 'C'.encode())
+            self.__win.callOnFlip(self.__io.trigger, 'C')
+            self.__gc.phase('stimulus')
+            self.__telemetry.publish('block', block=block_number)
 
             for j in k:
+                self.__telemetry.publish('trial', trial=j)
                 k = self.__path + img_path + j
                 object_stim.setImage(k)
                 trigger_sent = False
                 self.__clock.reset()
                 while self.__clock.getTime() < 2.5:
                     if not trigger_sent:
-                        self.__win.callOnFlip(self.__port.write, 'E'.encode())
+                        self.__win.callOnFlip(self.__io.trigger, 'E')
                         trigger_sent = True
                     if self.__clock.getTime() < 2:
                         object_stim.draw()
                     else:
                         self.__blank.draw()
                     self.__win.flip()
-                self.__port.write('F'.encode())
+                    self.__telemetry.frame()
+                self.__io.trigger('F')
                 object_recognition_data.append(j)
-                self.__this_exp.addData('OR_stimulus', j)
-                self.__this_exp.nextEntry()
-            self.__port.write('D'.encode())
+                self.__io.add_data('OR_stimulus', j)
+                self.__io.next_entry()
+            self.__io.trigger('D')
             self.__baseline(1)
+            self.__checkpoint.complete_block('object_recognition', block_number,
+                                             [{'stimulus': j} for j in object_recognition_data])
+            self.__io.check(wait=False)
+            object_recognition_data = []
 
         # Break
         self.__break()
 
         # Data saving
         print(f'Saving data...')
-        object_recognition_data = pd.DataFrame(object_recognition_data, columns=['stimulus'])
-        object_recognition_data.to_csv((self.__path + '/object_recognition_task/participant_data/'
-                                        + str(self.__filename_save) + '_object_recognition_task.csv'), header=True)
+        self.__io.write_csv(self.__checkpoint.records('object_recognition'),
+                            (self.__storage.participant_data('Lumo', 'object_recognition_task')
+                             + str(self.__filename_save) + '_object_recognition_task.csv'), header=True)
+        self.__io.check()
 
     def mismatched_negativity(self):
         '''
@@ -279,51 +397,75 @@ class Experiment:
         print(f'Running mismatched negativity task...')
         movie_stimuli = pd.read_csv(self.__path + '/mismatched_negativity_task/MMN_movie_stimuli.csv').values.tolist()
         movie_stimuli = [item for y in movie_stimuli for item in y]
-        auditory_stimuli = pd.read_csv(self.__path + '/mismatched_negativity_task/auditory_stimuli.csv')
+        # Per-participant oddball sequence (see oddball_sequences.py), or the shared sequence if none was generated
+        auditory_file = participant_file(self.__path, self.__experiment_info['Participant'])
+        if not os.path.exists(auditory_file):
+            print(f'No oddball sequence for this participant, using the shared auditory_stimuli.csv')
+            auditory_file = self.__path + '/mismatched_negativity_task/auditory_stimuli.csv'
+        auditory_stimuli = pd.read_csv(auditory_file)
         duration = 1
 
         # Instructions
         # self.__present_instructions(self.__path + '/mismatched_negativity_task/mismatched_negativity_instructions.csv')
 
-        MMN_data = []
+        start_block = self.__checkpoint.next_block('mismatched_negativity')
+        if start_block == 0:
+            self.__baseline(30) #TODO: how long to do the baseline for?
 
-        self.__baseline(30) #TODO: how long to do the baseline for?
+        # Each block's tones are pre-mixed into one buffer with exact stimulus-onset asynchronies
+        audio_format = self.__storage.audio_format
+        sequencer = AudioSequencer(audio_format['rate'], audio_format['channels'], soa=duration)
 
-        for i in range(0, 6):
-            movie = str(movie_stimuli[i])
-            movie_stim = MovieStim3(self.__win, movie)
-            movie_stim.autodraw = True
+        for i in range(start_block, 6):
+            movie = self.__video.resolve(self.__storage.resolve(movie_stimuli[i]))
+            movie_stim = self.__resources.movie(self.__win, movie)
+            if i + 1 < 6:
+                self.__io.preload(self.__video.resolve(self.__storage.resolve(movie_stimuli[i + 1])))
             auditory_stim = auditory_stimuli.loc[auditory_stimuli['block'] == i]
             triggers = auditory_stim.loc[:, 'trigger'].values.tolist()
             sounds = auditory_stim.loc[:, 'sound'].values.tolist()
             conditions = auditory_stim.loc[:, 'condition'].values.tolist()
-
+            sound_files = [self.__audio.resolve(self.__path + '/mismatched_negativity_task/auditory_stimuli/' + j + '.wav')
+                           for j in sounds]
+
+            block_buffer, onset_table = sequencer.render(sound_files, triggers, conditions)
+            block_sound = self.__resources.acquire('MMN_block_' + str(i),
+                                                   lambda: sound.Sound(value=block_buffer,
+                                                                       sampleRate=sequencer.sample_rate,
+                                                                       stereo=sequencer.channels == 2),
+                                                   nbytes=block_buffer.nbytes, kind='audio')
+            block_duration = len(block_buffer) / sequencer.sample_rate
+
+            self.__gc.phase('stream')
+            self.__telemetry.publish('block', block=i)
+            # The stream starts on the next flip, which is also when the block clock is reset
             next_flip = self.__win.getFutureFlipTime(clock='ptb')
+            block_sound.play(when=next_flip)
+            self.__win.callOnFlip(self.__clock.reset)
+            movie_stim.draw()
+            self.__win.flip()
 
-            for k in range(len(auditory_stim)):
-                trig = triggers[k]
-                sound_file = self.__path + '/mismatched_negativity_task/auditory_stimuli/' + \
-                                      sounds[k] + '.wav'
-                sound_play = sound.Sound(sound_file)
-
-                self.__clock.reset()
-                trigger_sent = False
-                sound_played = False
-
-                while self.__clock.getTime() < 1:
-                    # if not trigger_sent:
-                        # self.__win.callOnFlip(self.__port.write, trig.encode())
-                        # trigger_sent = True
-
-                    if not sound_played:
-                        sound_play.play(when=next_flip)
-
-                    self.__win.flip()
-                    movie_stim.autodraw = False
-
-            df = pd.DataFrame({'condition': [conditions[k]], 'sound': sounds[k], \
-                               'repetition': [k], 'block': [i]})
-            MMN_data.append(df)
+            # Each tone's trigger is sent on the flip nearest its onset in the stream
+            next_trigger = 0
+            onset_times = onset_table['onset_time'].values
+            while self.__clock.getTime() < block_duration:
+                flip_time = self.__win.getFutureFlipTime(clock='ptb') - next_flip
+                if next_trigger < len(onset_times) and flip_time >= onset_times[next_trigger] - self.__frame_dur / 2:
+                    self.__win.callOnFlip(self.__io.trigger, str(triggers[next_trigger]))
+                    next_trigger += 1
+                movie_stim.draw()
+                self.__win.flip()
+                self.__telemetry.frame()
+
+            self.__resources.release('MMN_block_' + str(i))
+            self.__resources.release(movie)
+            self.__checkpoint.complete_block('mismatched_negativity', i,
+                                             [{'condition': conditions[k], 'sound': sounds[k], 'repetition': k,
+                                               'block': i, 'trigger': triggers[k],
+                                               'onset_sample': onset_table['onset_sample'][k],
+                                               'onset_time': onset_table['onset_time'][k],
+                                               'stream_start': next_flip} for k in range(len(sounds))])
+            self.__io.check(wait=False)
 
         # PRACTICE TRIALS
         self.__ready()
@@ -332,9 +474,10 @@ class Experiment:
 
         # Data saving
         print(f'Saving data...')
-        MMN_data = pd.concat(MMN_data)
-        MMN_data.to_csv((self.__path + '/mismatched_negativity_task/participant_data/' + str(self.__filename_save)
-                         + 'mismatched_negativity_task.csv'), header=True)
+        self.__io.write_csv(self.__checkpoint.records('mismatched_negativity'),
+                            (self.__storage.participant_data('Lumo', 'mismatched_negativity_task')
+                             + str(self.__filename_save) + '_mismatched_negativity_task.csv'), header=True)
+        self.__io.check()
 
     def resting_state(self, duration=1):
         """
@@ -345,7 +488,8 @@ class Experiment:
 
         print(f"Running resting state...")
         # LOAD TRIAL COMPONENTS
-        resting_state_tone = sound.Sound(value='C', secs=0.1)
+        resting_state_tone = self.__resources.acquire('resting_state_tone', lambda: sound.Sound(value='C', secs=0.1),
+                                                      kind='audio')
 
         # INSTRUCTIONS
         # self.__present_instructions(self.__path + '/resting_state/resting_state_instructions.csv')
@@ -356,16 +500,17 @@ class Experiment:
         self.__wait(duration=2)
 
         # Start resting state
+        end_time = duration * 10 + 2 + self.__jitter()
         self.__clock.reset()
         trigger_sent = False
-        while self.__clock.getTime() < (duration * 10+2+(rd.random()/10)):
+        while self.__clock.getTime() < end_time:
             while self.__clock.getTime() < (duration*10):
                 if not trigger_sent:
-                    self.__win.callOnFlip(self.__port.write, 'G'.encode())
+                    self.__win.callOnFlip(self.__io.trigger, 'G')
                     trigger_sent = True
             self.__blank.draw()
             self.__win.flip()
-        self.__port.write('H'.encode())
+        self.__io.trigger('H')
 
         resting_state_tone.play()
 
@@ -379,7 +524,7 @@ class Experiment:
 
         """
         # Set up trial components
-        trial_text = TextStim(self.__win, text='')
+        trial_text = self.__resources.text(self.__win, 'memory_trial_text', text='')
         if self.__memory_condition == 'LL':
             encoding_text = 'Indoor or outdoor?'
             testing_text = 'Old or new?'
@@ -389,18 +534,25 @@ class Experiment:
             testing_text = 'New or old?'
             trial_text.text  = encoding_text
 
-        correct_text = TextStim(self.__win, text='Correct!', color=[0, 1, -1])
-        incorrect_text = TextStim(self.__win, text='Incorrect', color=[1, 0, 0])
-        no_key_pressed = TextStim(self.__win, text='No key pressed!', color=[-1, -1, 1])
+        correct_text = self.__resources.text(self.__win, 'memory_correct_text', text='Correct!', color=[0, 1, -1])
+        incorrect_text = self.__resources.text(self.__win, 'memory_incorrect_text', text='Incorrect', color=[1, 0, 0])
+        no_key_pressed = self.__resources.text(self.__win, 'memory_no_key_pressed', text='No key pressed!',
+                                               color=[-1, -1, 1])
 
         # Load stimuli
         encoding_stimuli = pd.read_csv(self.__path + '/memory_task/encoded_stimuli_' + str(self.__memory_condition) + '.csv')
         new_stimuli = pd.read_csv(self.__path + '/memory_task/new_stimuli_' + str(self.__memory_condition) + '.csv')
         practice_stimuli = pd.read_csv(self.__path + '/memory_task/practice_stimuli_' + str(self.__memory_condition) + '.csv')
 
+        # Randomisation is restored from the checkpoint when resuming so that the same stimulus order is used
+        memory_state = self.__checkpoint.task_state('memory_task')
+
         # Determine conditions
         # Will this participant encode more indoor or outdoors?
-        k = rd.randint(0, 1)
+        if memory_state is None:
+            k = self.__rng.randint('memory_task', 0, 1)
+        else:
+            k = memory_state['k']
         if k == 0: # More indoor than outdoor so drop last outdoor
             encoding_stimuli.drop(encoding_stimuli.tail(1).index, inplace=True)
             new_stimuli.drop(new_stimuli.tail(1).index,inplace=True)
@@ -408,12 +560,20 @@ class Experiment:
             encoding_stimuli.drop(encoding_stimuli.head(1).index, inplace=True)
             new_stimuli.drop(new_stimuli.head(1).index, inplace=True)
 
-        testing_stimuli = pd.concat((encoding_stimuli, new_stimuli))
+        encoding_stimuli = encoding_stimuli.reset_index(drop=True)
+        testing_stimuli = pd.concat((encoding_stimuli, new_stimuli), ignore_index=True)
+        practice_stimuli = practice_stimuli.reset_index(drop=True)
 
         # Randomise stimuli
-        rand_encoding_stimuli = encoding_stimuli.sample(frac=1, ignore_index=True)
-        rand_testing_stimuli = testing_stimuli.sample(frac=1, ignore_index=True)
-        rand_practice_stimuli = practice_stimuli.sample(frac=1, ignore_index=True)
+        if memory_state is None:
+            memory_state = {'k': k,
+                            'encoding_order': list(self.__rng.shuffle(encoding_stimuli, 'memory_task').index),
+                            'testing_order': list(self.__rng.shuffle(testing_stimuli, 'memory_task').index),
+                            'practice_order': list(self.__rng.shuffle(practice_stimuli, 'memory_task').index)}
+            self.__checkpoint.set_task_state('memory_task', memory_state)
+        rand_encoding_stimuli = encoding_stimuli.iloc[memory_state['encoding_order']].reset_index(drop=True)
+        rand_testing_stimuli = testing_stimuli.iloc[memory_state['testing_order']].reset_index(drop=True)
+        rand_practice_stimuli = practice_stimuli.iloc[memory_state['practice_order']].reset_index(drop=True)
 
         # Present instructions
         # self.__present_instructions((self.__path + '/memory_task/memory_task_instructions_' + str(self.__memory_condition) + '.csv'))
@@ -454,7 +614,9 @@ class Experiment:
         #
         # self.__wait(2)
 
-        self.__blank_screen(duration=1, colour='grey')
+        start_block = self.__checkpoint.next_block('memory_task')
+        if start_block == 0:
+            self.__blank_screen(duration=1, colour='grey')
 
         # Set up trial components
         phases = ['encoding', 'recall']
@@ -463,24 +625,35 @@ class Experiment:
         correct_answer_columns = ['corr_ans_encoding', 'corr_ans_recall']
         condition_columns = ['condition_encoding', 'condition_recall']
 
-        text = TextStim(self.__win, text='')
-        stimulus = ImageStim(self.__win, units='pix', size=(960, 600))
+        text = self.__resources.text(self.__win, 'memory_prompt', text='')
+        stimulus = self.__resources.acquire('memory_stimulus',
+                                            lambda: ImageStim(self.__win, units='pix', size=(960, 600)),
+                                            nbytes=960 * 600 * 4)
+        block_number = -1
 
         for a in range(len(phases)):
             phase = phases[a]
             text.text = prompts[a]
+            # The prompt is rendered once per phase rather than re-laid out every frame
+            self.__frames.compose('memory_' + phase, [text], rect=(-0.8, 0.2, 0.8, -0.2))
             all_stimuli = list(self.__chunking(stimuli[a], 2))
             correct_answer_column = correct_answer_columns[a]
             condition_column = condition_columns[a]
-            block_data = []
 
             for block in all_stimuli:
+                block_number += 1
+                if block_number < start_block:
+                    continue
+                block_data = []
 
                 self.__baseline(2)
+                self.__gc.phase(phase)
+                self.__telemetry.publish('block', block=block_number, phase=phase)
 
                 block = block.reset_index()
 
                 for j in range(len(block)):
+                    self.__telemetry.publish('trial', trial=int(block['index'][j]))
                     stimulus.setImage(block['stimulus'][j])
                     correct_answer = block[str(correct_answer_column)][j]
                     condition = block[str(condition_column)][j]
@@ -500,14 +673,14 @@ class Experiment:
 
                     while self.__clock.getTime() < 5:
                         if self.__clock.getTime() < 3:
-                            stimulus.draw()
+                            self.__frames.time_draw(stimulus)
                             if not img_trigger_sent:
-                                self.__win.callOnFlip(self.__port.write, img_trigger.encode())
+                                self.__win.callOnFlip(self.__io.trigger, img_trigger)
                                 img_trigger_sent = True
                         else:
-                            text.draw()
+                            self.__frames.draw('memory_' + phase)
                             if not ans_trigger_sent:
-                                self.__win.callOnFlip(self.__port.write, ans_trigger.encode())
+                                self.__win.callOnFlip(self.__io.trigger, ans_trigger)
                                 ans_trigger_sent = True
                             if not clock_reset:
                                 self.__win.callOnFlip(self.__kb.clock.reset)
@@ -519,6 +692,7 @@ class Experiment:
                                 if len(keys) > 0:
                                     key_pressed = True
                         self.__win.flip()
+                        self.__telemetry.frame()
 
                     if key_pressed:
                         response = str(keys[-1].name)
@@ -532,36 +706,44 @@ class Experiment:
                         reaction_time = np.nan
                         response = np.nan
 
-                    looped_data = pd.DataFrame({'phase': phase,
-                                       'stimulus': text.text,
-                                       'condition': [condition],
-                                       'trial_number': [block['index'][j]],
-                                       'reaction_time': [reaction_time],
-                                       'response': [result],
-                                       'correct_answer': [correct_answer],
-                                       'key_pressed': [response],
-                                        'k_num': [k]})
+                    looped_data = {'phase': phase,
+                                   'stimulus': text.text,
+                                   'condition': condition,
+                                   'trial_number': block['index'][j],
+                                   'reaction_time': reaction_time,
+                                   'response': result,
+                                   'correct_answer': correct_answer,
+                                   'key_pressed': response,
+                                   'k_num': k}
                     block_data.append(looped_data)
+                    self.__telemetry.publish('response', key=response, rt=reaction_time, correct=result)
+
+                    self.__io.add_data('IMT_stimulus', text.text)
+                    self.__io.add_data('IMT_rt', reaction_time)
+                    self.__io.add_data('IMT_response', result)
+                    self.__io.add_data('IMT_corr_ans', correct_answer)
+                    self.__io.add_data('IMT_key_pressed', response)
+                    self.__io.add_data('IMT_phase', phase)
+                    self.__io.add_data('IMT_condition', condition)
+                    self.__io.next_entry()
 
-                    self.__this_exp.addData('IMT_stimulus', text.text)
-                    self.__this_exp.addData('IMT_rt', reaction_time)
-                    self.__this_exp.addData('IMT_response', result)
-                    self.__this_exp.addData('IMT_corr_ans', correct_answer)
-                    self.__this_exp.addData('IMT_key_pressed', response)
-                    self.__this_exp.addData('IMT_phase', phase)
-                    self.__this_exp.addData('IMT_condition', condition)
-                    self.__this_exp.nextEntry()
+                self.__checkpoint.complete_block('memory_task', block_number, block_data)
+                self.__io.check(wait=False)
 
-            if a == 0:
+            if a == 0 and block_number + 1 >= start_block:
                 self.__present_instructions((self.__path + '/memory_task/memory_task_instructions_recall_' + \
             str(self.__memory_condition) + '.csv'))
                 self.__wait()
                 self.__blank_screen(duration=1, colour='black')
 
+        self.__frames.report('memory_task')
+        for phase in phases:
+            self.__frames.release('memory_' + phase)
         self.__break()
-        data_export = pd.concat(block_data, ignore_index=True)
-        data_export.to_csv((self.__path + '/memory_task/participant_data/' + str(self.__filename_save) \
-                                        + '_data.csv'), header=True, index=False)
+        self.__io.write_csv(self.__checkpoint.records('memory_task'),
+                            (self.__storage.participant_data('Lumo', 'memory_task') + str(self.__filename_save)
+                             + '_data.csv'), header=True, index=False)
+        self.__io.check()
 
     def visual_stimulation(self):
         '''
@@ -575,25 +757,32 @@ class Experiment:
         print(f"Running visual stimulation paradigm")
 
         # Set up trial components
-        wedge_1 = visual.RadialStim(self.__win, tex='sqrXsqr', color=1, size=1,
-                                   visibleWedge=[180, 360], radialCycles=6, angularCycles=12, interpolate=False,
-                                   autoLog=False, pos=(0, 0))
-        wedge_2 = visual.RadialStim(self.__win, tex='sqrXsqr', color=-1, size=1,
-                                   visibleWedge=[180, 360], radialCycles=6, angularCycles=12, interpolate=False,
-                                   autoLog=False, pos=(0, 0))
+        def wedge(color):
+            return visual.RadialStim(self.__win, tex='sqrXsqr', color=color, size=1,
+                                     visibleWedge=[180, 360], radialCycles=6, angularCycles=12, interpolate=False,
+                                     autoLog=False, pos=(0, 0))
+
+        # Each wedge holds a grating texture and a mask at the default texRes (64 x 64), as RGBA floats
+        wedge_bytes = 2 * 64 * 64 * 4 * 4
+        wedge_1 = self.__resources.acquire('wedge_1', lambda: wedge(1), nbytes=wedge_bytes)
+        wedge_2 = self.__resources.acquire('wedge_2', lambda: wedge(-1), nbytes=wedge_bytes)
 
-        fixation_cross = TextStim(self.__win, text='+', height=0.3, color=[0, 0, 0])
+        fixation_cross = self.__resources.text(self.__win, 'visual_fixation_cross', text='+', height=0.3,
+                                               color=[0, 0, 0])
 
         visual_conditions = pd.read_csv((self.__path + '/visual_stimulation/stimuli/P' + \
                                          str(self.__experiment_info['Participant']) + '_visual_stimulation_stimuli.csv'))
 
+        start_block = self.__checkpoint.next_block('visual_stimulation')
+
         # Instructions
-        self.__present_instructions(self.__path + '/visual_stimulation/instructions.csv')
+        if start_block == 0:
+            self.__present_instructions(self.__path + '/visual_stimulation/instructions.csv')
 
         t = 0
-        visual_stim_data = []
+        wedge_frames = set()
 
-        for i in range(0, len(visual_conditions.loc[:,'frequency'])):
+        for i in range(start_block, len(visual_conditions.loc[:,'frequency'])):
             frequency = 1/visual_conditions.loc[:,'frequency'][i]
             trigger = visual_conditions.loc[:, 'trigger'][i]
             wedge_1.visibleWedge = list((visual_conditions.loc[:,'orientation1'][i],
@@ -603,34 +792,55 @@ class Experiment:
             side = visual_conditions.loc[:, 'side'][i]
             trigger_sent = False
 
+            # Each wedge phase and the fixation cross are pre-rendered into one layer per orientation
+            orientation = str(wedge_1.visibleWedge)
+            wedge_rect = (-0.5, 0.5, 0.5, -0.5)
+            self.__frames.compose('wedge_1' + orientation, [wedge_1, fixation_cross], rect=wedge_rect)
+            self.__frames.compose('wedge_2' + orientation, [wedge_2, fixation_cross], rect=wedge_rect)
+            frame_1 = 'wedge_1' + orientation
+            frame_2 = 'wedge_2' + orientation
+            wedge_frames.update((frame_1, frame_2))
+
             self.__baseline(2)
+            self.__gc.phase('stimulation')
+            self.__telemetry.publish('block', block=i, frequency=frequency, side=side)
 
             self.__clock.reset()
+            self.__win.recordFrameIntervals = True
+            dropped_frames = self.__win.nDroppedFrames
+            frames = 0
 
             while self.__clock.getTime() < 10:
                 if not trigger_sent:
-                    self.__win.callOnFlip(self.__port.write, trigger.encode())
+                    self.__win.callOnFlip(self.__io.trigger, trigger)
                     trigger_sent = True
                 if self.__clock.getTime() % frequency < frequency / 2.0:
-                    stim = wedge_1
+                    self.__frames.draw(frame_1)
                 else:
-                    stim = wedge_2
-                stim.draw()
-                fixation_cross.draw()
+                    self.__frames.draw(frame_2)
                 self.__win.flip()
-            self.__port.write(''.encode())
+                self.__telemetry.frame()
+                frames += 1
+            self.__win.recordFrameIntervals = False
+            dropped_frames = self.__win.nDroppedFrames - dropped_frames
+            self.__io.trigger('')
             self.__baseline(2)
-            df = pd.DataFrame({'frequency': [frequency],
-                               'side': [side]})
-            visual_stim_data.append(df)
-
+            self.__checkpoint.complete_block('visual_stimulation', i, [{'frequency': frequency, 'side': side,
+                                                                        'frames': frames,
+                                                                        'dropped_frames': dropped_frames}])
+            self.__io.check(wait=False)
+
+        self.__frames.report('visual_stimulation')
+        for frame in wedge_frames:
+            self.__frames.release(frame)
         self.__break()
 
         # Data saving
         print(f'Saving data...')
-        visual_stim_data_export = pd.concat(visual_stim_data, ignore_index=True)
-        visual_stim_data_export.to_csv((self.__path + '/visual_stimulation/participant_data/' + str(self.__filename_save) \
-                            + 'data.csv'), header=True, index=False)
+        self.__io.write_csv(self.__checkpoint.records('visual_stimulation'),
+                            (self.__storage.participant_data('Lumo', 'visual_stimulation') + str(self.__filename_save)
+                             + '_data.csv'), header=True, index=False)
+        self.__io.check()
 
     def naturalistic_motor_task(self):
         """
@@ -643,17 +853,19 @@ class Experiment:
         # Load task components
         naturalistic_motor_stims = pd.read_csv(self.__path +
                                                '/naturalistic_motor_task/naturalistic_motor_task_stimuli.csv')
-        naturalistic_motor_data = []
-        naturalistic_motor_stim = TextStim(self.__win, text='')
+        naturalistic_motor_stim = self.__resources.text(self.__win, 'naturalistic_motor_stim', text='')
+        start_block = self.__checkpoint.next_block('naturalistic_motor_task')
 
         # Instructions
-        print(f'Presenting naturalistic motor task instructions...')
+        if start_block == 0:
+            print(f'Presenting naturalistic motor task instructions...')
 
-        naturalistic_motor_instructions = MovieStim3(self.__win, (self.__path + '/naturalistic_motor_task/instruction_video.mp4'), \
-                                                     size = (1440, 900))
-        while naturalistic_motor_instructions.status != visual.FINISHED:
-            naturalistic_motor_instructions.draw()
-            self.__win.flip()
+            instruction_video = self.__video.resolve(self.__path + '/naturalistic_motor_task/instruction_video.mp4')
+            naturalistic_motor_instructions = self.__resources.movie(self.__win, instruction_video, size=(1440, 900))
+            while naturalistic_motor_instructions.status != visual.FINISHED:
+                naturalistic_motor_instructions.draw()
+                self.__win.flip()
+            self.__resources.release(instruction_video)
 
         self.__ready()
 
@@ -662,12 +874,16 @@ class Experiment:
         # Start testing trials
         print(f'Starting naturalistic motor task testing...')
 
-        for k in list(range(3)):
+        for k in list(range(start_block, 3)):
+            naturalistic_motor_data = []
+            self.__telemetry.publish('block', block=k)
             for j in range(len(naturalistic_motor_stims)):
+                self.__telemetry.publish('trial', trial=j)
                 naturalistic_motor_stim.text = naturalistic_motor_stims['stimulus'].iloc[j]
                 trigger = naturalistic_motor_stims['trigger'].iloc[j]
                 end_trigger = naturalistic_motor_stims['end_trigger'].iloc[j]
-                audio_stim = sound.Sound(naturalistic_motor_stims['instruction'].iloc[j])
+                audio_file = self.__audio.resolve(self.__storage.resolve(naturalistic_motor_stims['instruction'].iloc[j]))
+                audio_stim = self.__resources.sound(audio_file)
 
                 time = 10
 
@@ -684,7 +900,7 @@ class Experiment:
                 while self.__clock.getTime() < time and not key_pressed:
                     naturalistic_motor_stim.draw()
                     if not trigger_sent:
-                        self.__win.callOnFlip(self.__port.write, trigger.encode())
+                        self.__win.callOnFlip(self.__io.trigger, trigger)
                         trigger_sent = True
                     if not sound_played:
                         audio_stim.play(when=next_flip)
@@ -695,25 +911,30 @@ class Experiment:
                         time += 1
                         if len(keys) > 0:
                             break
-                self.__port.write(end_trigger.encode())
-                df = pd.DataFrame({'Stimulus': [naturalistic_motor_stim.text],
-                                   'Duration': [keys[-1].rt],
-                                   'Trial': [k]})
-                naturalistic_motor_data.append(df)
-                self.__this_exp.addData('NMT_stimulus', naturalistic_motor_stim.text)
-                self.__this_exp.addData('NMT_duration', keys[-1].rt)
-                self.__this_exp.nextEntry()
+                self.__io.trigger(end_trigger)
+                self.__telemetry.publish('response', key=keys[-1].name, duration=keys[-1].rt)
+                naturalistic_motor_data.append({'Stimulus': naturalistic_motor_stim.text,
+                                                'Duration': keys[-1].rt,
+                                                'Trial': k})
+                self.__io.add_data('NMT_stimulus', naturalistic_motor_stim.text)
+                self.__io.add_data('NMT_duration', keys[-1].rt)
+                self.__io.next_entry()
                 self.__wait(1)
+                self.__resources.release(audio_file)
                 self.__kb.clearEvents()
 
+            self.__checkpoint.complete_block('naturalistic_motor_task', k, naturalistic_motor_data)
+            self.__io.check(wait=False)
+
             # Break
             self.__break()
 
         # Data saving
         print(f'Saving data...')
-        naturalistic_motor_data = pd.concat(naturalistic_motor_data, ignore_index=True)
-        naturalistic_motor_data.to_csv((self.__path + '/naturalistic_motor_task/participant_data/' + str(self.__filename_save)
-                                        + 'naturalistic_motor_task.csv'), header=True, index=False)
+        self.__io.write_csv(self.__checkpoint.records('naturalistic_motor_task'),
+                            (self.__storage.participant_data('Lumo', 'naturalistic_motor_task')
+                             + str(self.__filename_save) + '_naturalistic_motor_task.csv'), header=True, index=False)
+        self.__io.check()
 
     #%%%%% END EXPERIMENT ROUTINE %%%%%
     def __end_all_experiment(self, duration=3):
@@ -725,35 +946,87 @@ class Experiment:
 
         print(f"Ending experiment...")
         end_text = (self.__path + '/Instructions/study_finished.png')
-        ending = ImageStim(self.__win, end_text)
+        ending = self.__resources.image(self.__win, end_text)
         ending.draw()
         self.__win.flip()
         self.__wait(duration)
         self.__win.mouseVisible = True
         self.__win.flip()
-        self.__this_exp.saveAsWideText(self.__endfilename + '.csv', delim='auto')
-        self.__this_exp.saveAsPickle(self.__endfilename)
+        self.__io.save(self.__endfilename)
+        self.__rng.save_plan(self.__endfilename + '_rng_plan.json')
+        self.__io.write_csv(self.__resources.report(), self.__endfilename + '_memory_usage.csv', index=False)
+        self.__gc.stop()
+        self.__gc.summary()
+        self.__telemetry.publish('status', text='Session finished')
+        self.__telemetry.report()
+        self.__telemetry.close()
+        self.__io.write_csv(self.__gc.pauses(), self.__endfilename + '_gc_pauses.csv', index=False)
+        self.__io.write_csv(self.__gc.allocations(), self.__endfilename + '_allocations.csv', index=False)
+        self.__io.check()
+        self.__resources.release_all()
         logging.flush()
-        self.__port.close()
+        core.rush(False)
+        self.__io.close()
         self.__win.close()
         core.quit()
 
     #%%%%% RUN EXPERIMENT %%%%%%
     def run(self):
         self.__setup()
-        escape_experiment = False
-        while not escape_experiment:
+        task_functions = {'overall_instructions': self.__overall_instructions,
+                          'object_recognition': self.object_recognition,
+                          'mismatched_negativity': self.mismatched_negativity,
+                          'resting_state': self.resting_state,
+                          'memory_task': self.memory_task,
+                          'visual_stimulation': self.visual_stimulation,
+                          'naturalistic_motor_task': self.naturalistic_motor_task}
+        for task in self.__tasks:
             escape_check = self.__kb.getKeys(keyList=['escape'], waitRelease=True)
             if 'escape' in escape_check:
                 core.quit()
-            # self.__overall_instructions()
-            # self.object_recognition()
-            # self.mismatched_negativity()
-            # self.resting_state()
-            # self.memory_task()
-            # self.visual_stimulation()
-            self.naturalistic_motor_task()
-            self.__end_all_experiment()
-
-e = Experiment(portname='/dev/tty.usbserial-FTBXN67J', fullscreen=True, memory_condition='LL')
-e.run()
+            if self.__checkpoint.is_complete(task):
+                print(f"Skipping {task}, already completed...")
+                continue
+            self.__task = task
+            self.__gc.set_task(task)
+            self.__telemetry.publish('task', task=task)
+            self.__telemetry.publish('status', text='Running')
+            self.__rng.plan_jitter(task)
+            self.__resources.start_task(task)
+            task_functions[task]()
+            self.__resources.end_task()
+            self.__task = None
+            self.__checkpoint.complete_task(task)
+        self.__checkpoint.finish()
+        self.__end_all_experiment()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Optical Neuroimaging and Cognition (ONAC) task battery')
+    parser.add_argument('--tasks', nargs='+', choices=TASKS, default=TASKS,
+                        help='Tasks to run, in order (default: the full battery)')
+    parser.add_argument('--participant', default=None, help='Participant number (skips the start-up dialog)')
+    session = parser.add_mutually_exclusive_group()
+    session.add_argument('--resume', action='store_true', help='Resume from the participant\'s session checkpoint')
+    session.add_argument('--fresh', action='store_true',
+                         help='Start a new session even if the participant has an unfinished one (its checkpoint is '
+                              'overwritten)')
+    parser.add_argument('--port', default='/dev/tty.usbserial-FTBXN67J', help='Serial port of the NIRS trigger box')
+    parser.add_argument('--baudrate', type=int, default=9600,
+                        help='Baud rate of the trigger box (see trigger_latency.py)')
+    parser.add_argument('--memory-condition', default='LL', choices=['LL', 'RR'])
+    parser.add_argument('--config', default=None, help='Storage config json (default: onac_config.json)')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Seed overriding the one derived from the participant number, e.g. to replay a session')
+    parser.add_argument('--gc-policy', default='default', choices=POLICIES,
+                        help='\'controlled\' collects garbage only at breaks, baselines and instruction screens')
+    parser.add_argument('--profile-allocations', action='store_true',
+                        help='Record the top allocating source lines of every task phase (slow)')
+    parser.add_argument('--telemetry', default='127.0.0.1:47800',
+                        help='host:port to publish live telemetry to for monitor.py, or \'off\'')
+    args = parser.parse_args()
+
+    e = Experiment(portname=args.port, fullscreen=True, memory_condition=args.memory_condition,
+                   participant=args.participant, tasks=args.tasks, resume=args.resume, fresh=args.fresh, seed=args.seed,
+                   config=args.config, gc_policy=args.gc_policy, profile_allocations=args.profile_allocations,
+                   telemetry=parse_address(args.telemetry), baudrate=args.baudrate)
+    e.run()
@@ -0,0 +1,114 @@
+# Experimenter monitor for the ONAC tasks.
+
+# Listens for the telemetry published by master_WV.py (see telemetry.py) and redraws a summary in the terminal:
+# current task, block and trial, recent triggers and responses, frame-interval statistics and lost messages. Run it
+# in a separate terminal before or during a session; it never sends anything back to the experiment.
+
+# Usage: python monitor.py [--address 127.0.0.1:47800]
+
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+from collections import deque
+
+import argparse
+import json
+import select
+import socket
+import time
+
+from telemetry import parse_address
+
+REFRESH_INTERVAL = 0.25  # seconds
+
+#%%%%%%%%%% Monitor %%%%%%%%%%
+
+class Monitor:
+
+    def __init__(self, address, history=8):
+        self.__socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.__socket.bind(address)
+        self.__socket.setblocking(False)
+        self.__address = address
+        self.__state = {'task': '-', 'block': '-', 'trial': '-', 'status': 'Waiting for the experiment...'}
+        self.__triggers = deque(maxlen=history)
+        self.__responses = deque(maxlen=history)
+        self.__frames = None
+        self.__worst_frame = 0.0
+        self.__received = 0
+        self.__lost = 0
+        self.__sequences = {}  # source -> last sequence number
+        self.__last_message = None
+
+    def __handle(self, message):
+        self.__received += 1
+        self.__last_message = time.time()
+        source = message.get('source')
+        last = self.__sequences.get(source)
+        if last is not None and message['seq'] > last + 1:
+            self.__lost += message['seq'] - last - 1
+        self.__sequences[source] = message['seq']
+
+        kind = message['kind']
+        clock = time.strftime('%H:%M:%S', time.localtime(message['t']))
+        if kind == 'task':
+            self.__state.update(task=message['task'], block='-', trial='-')
+            self.__worst_frame = 0.0
+        elif kind == 'block':
+            self.__state.update(block=message['block'], trial='-')
+        elif kind == 'trial':
+            self.__state['trial'] = message['trial']
+        elif kind == 'status':
+            self.__state['status'] = message['text']
+        elif kind == 'trigger':
+            self.__triggers.appendleft(clock + '  ' + repr(message['code']))
+        elif kind == 'response':
+            self.__responses.appendleft(clock + '  ' + ', '.join(str(k) + '=' + str(v) for k, v in message.items()
+                                                                 if k not in ('kind', 'source', 'seq', 't')))
+        elif kind == 'frames':
+            self.__frames = message
+            self.__worst_frame = max(self.__worst_frame, message['max_ms'])
+
+    def __draw(self):
+        lines = ['ONAC experiment monitor (listening on ' + self.__address[0] + ':' + str(self.__address[1]) + ')', '',
+                 'Task:   ' + str(self.__state['task']),
+                 'Block:  ' + str(self.__state['block']),
+                 'Trial:  ' + str(self.__state['trial']),
+                 'Status: ' + str(self.__state['status']), '']
+        if self.__frames is not None:
+            lines.append(f"Frames: mean {self.__frames['mean_ms']:.2f}ms, max {self.__frames['max_ms']:.2f}ms "
+                         f"(worst this task {self.__worst_frame:.2f}ms)")
+        else:
+            lines.append('Frames: -')
+        if self.__last_message is not None:
+            lines.append(f'Messages: {self.__received} received, {self.__lost} lost, last '
+                         f'{time.time() - self.__last_message:.1f}s ago')
+        lines += ['', 'Triggers:'] + ['  ' + j for j in self.__triggers]
+        lines += ['', 'Responses:'] + ['  ' + j for j in self.__responses]
+        print('\033[2J\033[H' + '\n'.join(lines), flush=True)
+
+    def run(self):
+        next_draw = 0
+        while True:
+            readable, _, _ = select.select([self.__socket], [], [], REFRESH_INTERVAL)
+            while readable:
+                try:
+                    data = self.__socket.recv(65536)
+                except BlockingIOError:
+                    break
+                try:
+                    self.__handle(json.loads(data))
+                except (ValueError, KeyError):
+                    pass
+            if time.time() >= next_draw:
+                self.__draw()
+                next_draw = time.time() + REFRESH_INTERVAL
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Live monitor of an ONAC session')
+    parser.add_argument('--address', default='127.0.0.1:47800', help='host:port to listen on')
+    args = parser.parse_args()
+    try:
+        Monitor(parse_address(args.address)).run()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,204 @@
+# Constrained oddball sequence generation for the mismatched negativity task.
+
+# Generates a per-participant sequence of standard and deviant tones for every block, under three constraints:
+#   - a fixed deviant probability (the number of deviants per block is rounded to a multiple of the deviant types),
+#   - at least min_standards standards between two deviants (and lead_standards before the first deviant),
+#   - every deviant type occurs equally often in each block.
+
+# Valid sequences are sampled directly rather than by rejection: the standards left over after the minimum gaps are
+# spread over the gaps with a "stars and bars" draw, which is uniform over every valid placement of the deviants and
+# vectorised over many blocks at once.
+
+# Output uses the layout of auditory_stimuli.csv (block, trigger, sound, condition), written per participant to
+# <Lumo root>/mismatched_negativity_task/stimuli/P<n>_mismatched_negativity_task_stimuli.csv, like the other task
+# randomisations (see randomisation_script.py).
+
+# Usage: python oddball_sequences.py --participants 1 2 3 [--probability 0.15] [--min-standards 2]
+#        python oddball_sequences.py --benchmark
+
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+import pandas as pd
+import numpy as np
+import argparse
+import os
+import time
+
+from session_rng import SessionRNG
+from storage import Storage
+
+TASK = 'mismatched_negativity_task'
+
+#%%%%%%%%%% Sequence generation %%%%%%%%%%
+
+def deviant_positions(rng, n_sequences, n_tones, n_deviants, min_standards, lead_standards):
+    """
+    Draws the deviant positions of many sequences at once, uniformly over all valid placements.
+
+    :param rng: np.random.Generator.
+    :return: Array of shape (n_sequences, n_deviants) of sorted tone indices.
+    """
+
+    spare = n_tones - n_deviants - lead_standards - min_standards * (n_deviants - 1)
+    if spare < 0:
+        raise ValueError(f'{n_deviants} deviants with {min_standards} standards between them do not fit in '
+                         f'{n_tones} tones')
+    # Choose n_deviants of the spare + n_deviants slots; the i-th chosen slot minus i is the number of spare
+    # standards placed before deviant i
+    slots = np.argsort(rng.random((n_sequences, spare + n_deviants)), axis=1)[:, :n_deviants]
+    slots.sort(axis=1)
+    return lead_standards + min_standards * np.arange(n_deviants) + slots
+
+
+class OddballGenerator:
+
+    def __init__(self, standard, deviants, tones_per_block, deviant_probability=0.15, min_standards=2,
+                 lead_standards=None):
+        """
+        :param standard: (sound, trigger) of the standard tone.
+        :param deviants: Dictionary of deviant condition -> (sound, trigger).
+        :param tones_per_block: Number of tones in a block.
+        :param deviant_probability: Target proportion of deviants in a block.
+        :param min_standards: Minimum number of standards between two deviants.
+        :param lead_standards: Standards at the start of each block before any deviant. Defaults to min_standards.
+        """
+
+        self.__standard = standard
+        self.__conditions = list(deviants)
+        self.__deviants = deviants
+        self.__tones = tones_per_block
+        self.__min_standards = min_standards
+        self.__lead = min_standards if lead_standards is None else lead_standards
+        n_types = len(self.__conditions)
+        self.__n_deviants = max(n_types, int(round(deviant_probability * tones_per_block / n_types)) * n_types)
+        # Fails early if the constraints cannot be met
+        deviant_positions(np.random.default_rng(0), 1, self.__tones, self.__n_deviants, self.__min_standards,
+                          self.__lead)
+
+    @classmethod
+    def from_csv(cls, filepath, **kwargs):
+        """
+        Takes the tones and block length from an existing sequence file (e.g. auditory_stimuli.csv).
+        """
+
+        stimuli = pd.read_csv(filepath)
+        standard = stimuli.loc[stimuli['condition'] == 'standard', ['sound', 'trigger']].iloc[0]
+        deviants = stimuli.loc[stimuli['condition'] != 'standard', ['condition', 'sound', 'trigger']]
+        deviants = {row.condition: (row.sound, row.trigger)
+                    for row in deviants.drop_duplicates('condition').itertuples()}
+        tones_per_block = int(stimuli.groupby('block').size().max())
+        return cls((standard['sound'], standard['trigger']), deviants, tones_per_block, **kwargs)
+
+    @property
+    def n_deviants(self):
+        return self.__n_deviants
+
+    def sequences(self, rng, n_sequences):
+        """
+        :return: Array of shape (n_sequences, tones_per_block) of condition indices: 0 is the standard, i > 0 is
+                 deviant condition i - 1.
+        """
+
+        positions = deviant_positions(rng, n_sequences, self.__tones, self.__n_deviants, self.__min_standards,
+                                      self.__lead)
+        # Balanced deviant types, in random order within each sequence
+        types = np.tile(np.arange(1, len(self.__conditions) + 1), self.__n_deviants // len(self.__conditions))
+        order = np.argsort(rng.random((n_sequences, self.__n_deviants)), axis=1)
+        codes = np.zeros((n_sequences, self.__tones), dtype=np.int64)
+        np.put_along_axis(codes, positions, types[order], axis=1)
+        return codes
+
+    def generate(self, rng, n_blocks=6):
+        """
+        :return: DataFrame with one row per tone and the columns block, trigger, sound and condition.
+        """
+
+        codes = self.sequences(rng, n_blocks)
+        conditions = np.array(['standard'] + self.__conditions, dtype=object)
+        sounds = np.array([self.__standard[0]] + [self.__deviants[c][0] for c in self.__conditions], dtype=object)
+        triggers = np.array([self.__standard[1]] + [self.__deviants[c][1] for c in self.__conditions], dtype=object)
+        return pd.DataFrame({'block': np.repeat(np.arange(n_blocks), self.__tones),
+                             'trigger': triggers[codes.ravel()],
+                             'sound': sounds[codes.ravel()],
+                             'condition': conditions[codes.ravel()]})
+
+    def validate(self, sequence):
+        """
+        Checks a generated sequence against the constraints.
+
+        :return: List of the violations found (empty if the sequence is valid).
+        """
+
+        errors = []
+        for block, tones in sequence.groupby('block'):
+            deviant = (tones['condition'] != 'standard').to_numpy()
+            positions = np.flatnonzero(deviant)
+            if len(tones) != self.__tones:
+                errors.append(f'block {block}: {len(tones)} tones')
+            if len(positions) != self.__n_deviants:
+                errors.append(f'block {block}: {len(positions)} deviants')
+            if len(positions) and positions[0] < self.__lead:
+                errors.append(f'block {block}: deviant at tone {positions[0]}')
+            if np.any(np.diff(positions) <= self.__min_standards):
+                errors.append(f'block {block}: fewer than {self.__min_standards} standards between deviants')
+            counts = tones.loc[deviant, 'condition'].value_counts()
+            if len(counts) != len(self.__conditions) or counts.nunique() != 1:
+                errors.append(f'block {block}: unbalanced deviant types')
+        return errors
+
+
+def participant_file(root, participant):
+    return root + '/' + TASK + '/stimuli/P' + str(participant) + '_' + TASK + '_stimuli.csv'
+
+
+def write_participant(generator, root, participant, n_blocks=6):
+    """
+    Generates a participant's sequence from their mismatched negativity stream and writes it.
+
+    :return: Filepath of the written csv.
+    """
+
+    sequence = generator.generate(SessionRNG(participant).stream(TASK), n_blocks)
+    errors = generator.validate(sequence)
+    if errors:
+        raise RuntimeError('Invalid oddball sequence for P' + str(participant) + ': ' + '; '.join(errors))
+    filepath = participant_file(root, participant)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    sequence.to_csv(filepath, header=True, index=False)
+    return filepath
+
+#%%%%%%%%%% Benchmark %%%%%%%%%%
+
+def benchmark(n_sequences=100000, tones_per_block=300):
+    generator = OddballGenerator(('standard', 'S'), {'frequency': ('frequency_deviant', 'F'),
+                                                     'duration': ('duration_deviant', 'D'),
+                                                     'intensity': ('intensity_deviant', 'I')}, tones_per_block)
+    rng = np.random.default_rng(0)
+    start = time.perf_counter()
+    generator.sequences(rng, n_sequences)
+    elapsed = time.perf_counter() - start
+    print(f'{n_sequences} sequences of {tones_per_block} tones ({generator.n_deviants} deviants) in {elapsed:.2f}s, '
+          f'{n_sequences / elapsed:.0f} sequences/s')
+    return n_sequences / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate per-participant MMN oddball sequences')
+    parser.add_argument('--config', default=None, help='Storage config json (default: onac_config.json)')
+    parser.add_argument('--participants', nargs='+', default=[])
+    parser.add_argument('--blocks', type=int, default=6)
+    parser.add_argument('--probability', type=float, default=0.15, help='Deviant probability')
+    parser.add_argument('--min-standards', type=int, default=2, help='Minimum standards between deviants')
+    parser.add_argument('--lead-standards', type=int, default=None, help='Standards before the first deviant')
+    parser.add_argument('--benchmark', action='store_true')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark()
+    else:
+        root = Storage.load(args.config).stimulus_root('Lumo')
+        generator = OddballGenerator.from_csv(root + '/' + TASK + '/auditory_stimuli.csv',
+                                              deviant_probability=args.probability,
+                                              min_standards=args.min_standards, lead_standards=args.lead_standards)
+        for participant in args.participants:
+            print(f'Wrote {write_participant(generator, root, participant, args.blocks)}')
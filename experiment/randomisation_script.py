@@ -7,27 +7,30 @@ from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
+from session_rng import SessionRNG
+from storage import Storage
+from oddball_sequences import OddballGenerator, write_participant
+
 class randomisation:
 
-    def __init__(self, participant_number, tasks, password):
+    def __init__(self, participant_number, tasks, password, config=None):
         self.__participant_number = participant_number
         self.__tasks = tasks
         self.__password = password
         self.__new_stimuli = None
+        self.__rng = SessionRNG(participant_number)
+        self.__storage = Storage.load(config)
 
     def __randomise(self, participant_number, task):
-        filepath = '/Users/emilia/Documents/Dementia task piloting/Lumo/' + task + '/' + task + '_stimuli.csv'
-        if task == 'breath_holding':
-            filepath = '/Users/emilia/Documents/Dementia task piloting/Mini-CYRIL/' + task + '/' + task + '_stimuli.csv'
+        site = 'Mini-CYRIL' if task == 'breath_holding' else 'Lumo'
+        filepath = self.__storage.stimulus_root(site) + '/' + task + '/' + task + '_stimuli.csv'
         original_stimuli = pd.read_csv(filepath)
 
         # Randomise stimuli
-        randomised_stimuli = original_stimuli.sample(frac=1)
+        randomised_stimuli = self.__rng.shuffle(original_stimuli, task)
 
         # Export randomised stimuli
-        path = '/Users/emilia/Documents/Dementia task piloting/Lumo/' + task + '/stimuli'
-        if task == 'breath_holding':
-            path = '/Users/emilia/Documents/Dementia task piloting/Mini-CYRIL/breath_holding/stimuli'
+        path = self.__storage.stimulus_root(site) + '/' + task + '/stimuli'
         new_stimuli = path + '/P' + str(participant_number) + '_' + str(task) + '_stimuli.csv'
         randomised_stimuli.to_csv(new_stimuli, header=True, index=False)
 
@@ -48,6 +51,12 @@ class randomisation:
         if 'visual_stimulation' in self.__tasks:
             visual_stim_stim = self.__randomise(self.__participant_number, 'visual_stimulation')
 
+        if 'mismatched_negativity_task' in self.__tasks:
+            root = self.__storage.stimulus_root('Lumo')
+            generator = OddballGenerator.from_csv(root + '/mismatched_negativity_task/auditory_stimuli.csv')
+            MMN_stim = write_participant(generator, root, self.__participant_number)
+            attachments.append(MMN_stim)
+
         if 'breath_holding' in self.__tasks:
             breath_holding_stim = self.__randomise(self.__participant_number, 'breath_holding')
 
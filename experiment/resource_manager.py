@@ -0,0 +1,179 @@
+# Resource manager for the ONAC study.
+
+# Owns the stimuli (ImageStim, TextStim, RadialStim), audio streams (Sound) and movie decoders (MovieStim3) used by
+# the tasks. Resources are reference counted and cached by key, so that the same file is only loaded once, and
+# everything a task acquired is released when the task ends (or earlier, with release()). Peak RSS, texture memory
+# (images, gratings and movies) and audio memory are recorded per task.
+
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+from psychopy import sound
+from psychopy.visual import ImageStim, MovieStim3, TextStim
+
+import gc
+import os
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+#%%%%%%%%%% Memory usage %%%%%%%%%%
+
+def current_rss():
+    """
+    :return: Resident set size of this process in bytes, or None if it cannot be measured.
+    """
+
+    if psutil is not None:
+        return psutil.Process(os.getpid()).memory_info().rss
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+#%%%%%%%%%% Resource manager %%%%%%%%%%
+
+class ResourceManager:
+
+    def __init__(self, collect=gc.collect):
+        """
+        :param collect: Called to collect the garbage once resources are freed, e.g. a GCPolicy collection so the pause
+                        is recorded as an explicit one.
+        """
+
+        self.__collect = collect
+        self.__resources = {}  # key -> [resource, reference count, owning task, bytes, 'texture' or 'audio']
+        self.__task = None
+        self.__usage = {}  # task -> {'peak_rss': bytes, 'peak_texture': bytes, 'loaded': count}
+
+    #%%%%% TASK LIFECYCLE %%%%%
+    def start_task(self, task):
+        self.__task = task
+        self.__usage[task] = {'peak_rss': 0, 'peak_texture': 0, 'peak_audio': 0, 'loaded': 0}
+        self.sample()
+
+    def end_task(self):
+        """
+        Releases every resource acquired during the current task and records its memory usage.
+        """
+
+        if self.__task is None:
+            return
+        self.sample()
+        for key in [k for k, v in self.__resources.items() if v[2] == self.__task]:
+            self.__free(key)
+        self.__collect()
+        usage = self.__usage[self.__task]
+        print(f"{self.__task}: peak RSS {usage['peak_rss'] / 1e6:.0f}MB, "
+              f"peak texture memory {usage['peak_texture'] / 1e6:.0f}MB, peak audio memory "
+              f"{usage['peak_audio'] / 1e6:.0f}MB, {usage['loaded']} resources loaded")
+        self.__task = None
+
+    def sample(self):
+        """
+        Updates the peak memory usage of the current task. Cheap enough to call between blocks.
+        """
+
+        if self.__task is None:
+            return
+        usage = self.__usage[self.__task]
+        rss = current_rss()
+        if rss is not None:
+            usage['peak_rss'] = max(usage['peak_rss'], rss)
+        usage['peak_texture'] = max(usage['peak_texture'], self.texture_bytes())
+        usage['peak_audio'] = max(usage['peak_audio'], self.audio_bytes())
+
+    def texture_bytes(self):
+        return sum(v[3] for v in self.__resources.values() if v[4] == 'texture')
+
+    def audio_bytes(self):
+        return sum(v[3] for v in self.__resources.values() if v[4] == 'audio')
+
+    def report(self):
+        """
+        :return: List of dictionaries with the memory usage of each task.
+        """
+
+        return [{'task': task, 'peak_rss_mb': usage['peak_rss'] / 1e6, 'peak_texture_mb': usage['peak_texture'] / 1e6,
+                 'peak_audio_mb': usage['peak_audio'] / 1e6, 'resources_loaded': usage['loaded']}
+                for task, usage in self.__usage.items()]
+
+    #%%%%% ACQUIRING AND RELEASING %%%%%
+    def acquire(self, key, factory, nbytes=0, session=False, kind='texture'):
+        """
+        Returns the resource stored under key, creating it with factory() if it is not loaded yet.
+
+        :param key: Cache key, normally the file path.
+        :param factory: Function creating the resource.
+        :param nbytes: Estimated memory held by the resource (e.g. texture size).
+        :param session: Keep the resource for the whole session rather than releasing it at the end of the task.
+        :param kind: 'texture' (images and movies) or 'audio', for the memory report.
+        """
+
+        if key not in self.__resources:
+            owner = None if session else self.__task
+            self.__resources[key] = [factory(), 0, owner, nbytes, kind]
+            if self.__task is not None:
+                usage = self.__usage[self.__task]
+                usage['loaded'] += 1
+                usage['peak_texture'] = max(usage['peak_texture'], self.texture_bytes())
+                usage['peak_audio'] = max(usage['peak_audio'], self.audio_bytes())
+        self.__resources[key][1] += 1
+        return self.__resources[key][0]
+
+    def release(self, key):
+        """
+        Drops one reference to a resource and frees it once no references remain.
+        """
+
+        if key not in self.__resources:
+            return
+        self.__resources[key][1] -= 1
+        if self.__resources[key][1] <= 0:
+            self.__free(key)
+
+    def release_all(self):
+        for key in list(self.__resources):
+            self.__free(key)
+        self.__collect()
+
+    def __free(self, key):
+        resource = self.__resources.pop(key)[0]
+        if hasattr(resource, 'unload'):  # Movie decoders
+            resource.unload()
+        elif hasattr(resource, 'stop'):  # Audio streams
+            resource.stop()
+
+    #%%%%% STIMULUS FACTORIES %%%%%
+    def image(self, win, filepath, size=(1440, 900), session=False):
+        """
+        Image stimulus in pixel units; the texture is estimated as RGBA at the display size.
+        """
+
+        return self.acquire(filepath, lambda: ImageStim(win, filepath, units='pix', size=size),
+                            nbytes=size[0] * size[1] * 4, session=session)
+
+    def text(self, win, key, session=False, **kwargs):
+        """
+        Text stimulus, created with TextStim(win, **kwargs). Glyphs are drawn from the font's shared texture, so no
+        texture memory is counted for it.
+        """
+
+        return self.acquire(key, lambda: TextStim(win, **kwargs), session=session)
+
+    def sound(self, filepath):
+        """
+        Sound loaded from a file. Release it once played (e.g. at the end of the trial).
+        """
+
+        return self.acquire(filepath, lambda: sound.Sound(filepath), nbytes=os.path.getsize(filepath), kind='audio')
+
+    def movie(self, win, filepath, size=None):
+        """
+        Movie stimulus; the decoder holds roughly one RGBA frame at the display size.
+        """
+
+        nbytes = size[0] * size[1] * 4 if size is not None else 0
+        return self.acquire(filepath, lambda: MovieStim3(win, filepath, size=size), nbytes=nbytes)
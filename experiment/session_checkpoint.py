@@ -0,0 +1,157 @@
+# Session checkpoints for the ONAC study.
+
+# A checkpoint is a small JSON file written after every completed block and task. It records which tasks and blocks
+# are finished, the data collected so far and the state of the session's random number generator (see session_rng.py),
+# so that an interrupted session can be resumed from the next block. A checkpoint is unfinished until the session ends,
+# and a new session is never started over an unfinished one unless asked to (see --resume and --fresh in master_WV.py).
+
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+import json
+import os
+
+#%%%%%%%%%% Checkpoint %%%%%%%%%%
+
+class SessionCheckpoint:
+
+    def __init__(self, filepath, participant, rng=None, session=None):
+        """
+        :param filepath: The filepath of the checkpoint json.
+        :param participant: Participant number.
+        :param rng: The session's SessionRNG, whose state is saved with the checkpoint.
+        :param session: Date and time the session started (data.getDateStr()), which names its output files.
+        """
+
+        self.__filepath = filepath
+        self.__rng = rng
+        self.__state = {'participant': str(participant),
+                        'session': session,
+                        'completed_tasks': [],
+                        'blocks': {},
+                        'records': {},
+                        'task_state': {},
+                        'random_state': None,
+                        'finished': False}
+
+    @classmethod
+    def load(cls, filepath, participant, rng=None, session=None):
+        """
+        Loads an existing checkpoint, or creates a new one if none exists.
+
+        :param filepath: The filepath of the checkpoint json.
+        :param participant: Participant number.
+        :param rng: The session's SessionRNG, restored to its saved state.
+        :param session: Start of the session if a new checkpoint is created; a loaded one keeps its own.
+        """
+
+        checkpoint = cls(filepath, participant, rng, session)
+        if os.path.exists(filepath):
+            with open(filepath) as f:
+                state = json.load(f)
+            if state['participant'] != str(participant):
+                raise ValueError('Checkpoint ' + filepath + ' belongs to participant ' + state['participant'])
+            checkpoint.__state.update(state)
+            checkpoint.__state['finished'] = False  # Until the resumed session ends
+            checkpoint.restore_random_state()
+            print(f"Resuming session from checkpoint...")
+        return checkpoint
+
+    @staticmethod
+    def unfinished(filepath):
+        """
+        :return: True if filepath holds the checkpoint of a session that has not finished, which can still be resumed.
+        """
+
+        if not os.path.exists(filepath):
+            return False
+        with open(filepath) as f:
+            return not json.load(f).get('finished', False)
+
+    def save(self):
+        """
+        Writes the checkpoint atomically, so that a crash while saving never leaves a corrupted file.
+        """
+
+        if self.__rng is not None:
+            self.__state['random_state'] = self.__rng.state()
+        directory = os.path.dirname(self.__filepath)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp = self.__filepath + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.__state, f, default=_to_builtin)
+        os.replace(tmp, self.__filepath)
+
+    def restore_random_state(self):
+        if self.__rng is not None and self.__state['random_state'] is not None:
+            self.__rng.set_state(self.__state['random_state'])
+
+    @property
+    def session(self):
+        return self.__state['session']
+
+    #%%%%% TASKS %%%%%
+    def is_complete(self, task):
+        return task in self.__state['completed_tasks']
+
+    def complete_task(self, task):
+        if task not in self.__state['completed_tasks']:
+            self.__state['completed_tasks'].append(task)
+        self.save()
+
+    def finish(self):
+        """
+        Marks the session as finished, after which a new session may replace the checkpoint.
+        """
+
+        self.__state['finished'] = True
+        self.save()
+
+    #%%%%% BLOCKS %%%%%
+    def next_block(self, task):
+        """
+        :return: Index of the first block of the task that has not been completed.
+        """
+
+        return self.__state['blocks'].get(task, 0)
+
+    def complete_block(self, task, block, records=None):
+        """
+        Marks a block as completed and stores the data rows collected during it.
+
+        :param task: Task name.
+        :param block: Index of the completed block.
+        :param records: List of dictionaries, one per row of task data.
+        """
+
+        self.__state['blocks'][task] = block + 1
+        if records:
+            self.__state['records'].setdefault(task, []).extend(records)
+        self.save()
+
+    def records(self, task):
+        """
+        :return: All data rows stored for the task so far.
+        """
+
+        return list(self.__state['records'].get(task, []))
+
+    #%%%%% TASK STATE %%%%%
+    def task_state(self, task):
+        """
+        :return: Task-specific state (e.g. randomised stimulus orders), or None if none has been stored.
+        """
+
+        return self.__state['task_state'].get(task)
+
+    def set_task_state(self, task, state):
+        self.__state['task_state'][task] = state
+        self.save()
+
+
+def _to_builtin(value):
+    # NumPy scalars (e.g. values read from a DataFrame) are not JSON serialisable
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError('Cannot store ' + repr(value) + ' in a checkpoint')
+
@@ -0,0 +1,130 @@
+# Seedable random number generation for the ONAC study.
+
+# Every participant gets a seed (derived from the participant number unless given explicitly) and every task draws
+# from its own independent stream, so that adding or skipping a task never changes the randomisation of another.
+# Timing jitter is drawn in advance as NumPy arrays when a task starts, so no random numbers are drawn inside the
+# frame loops, and a whole session can be replayed exactly from its seed.
+
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+import numpy as np
+import json
+import zlib
+
+# Fixed study-level entropy, combined with the participant seed
+STUDY_SEED = 319284
+
+# Number of jitter values drawn per task in advance; more are drawn (from the same stream) if a task runs out
+JITTER_PLAN_SIZE = 256
+
+#%%%%%%%%%% Session RNG %%%%%%%%%%
+
+def participant_seed(participant):
+    """
+    :return: Seed derived from the participant number, e.g. '12' -> 12. Non-numeric IDs are hashed.
+    """
+
+    participant = str(participant).strip().lstrip('Pp')
+    if participant.isdigit():
+        return int(participant)
+    return zlib.crc32(participant.encode())
+
+
+class SessionRNG:
+
+    def __init__(self, participant, seed=None):
+        """
+        :param participant: Participant number.
+        :param seed: Optional seed overriding the one derived from the participant number, e.g. to replay a session.
+        """
+
+        self.__seed = participant_seed(participant) if seed is None else int(seed)
+        self.__streams = {}
+        self.__jitter = {}  # task -> [pre-drawn values, position]
+
+    @property
+    def seed(self):
+        return self.__seed
+
+    def stream(self, task):
+        """
+        :return: The np.random.Generator of a task. The same task always gets the same stream for a given seed.
+        """
+
+        if task not in self.__streams:
+            sequence = np.random.SeedSequence([STUDY_SEED, self.__seed], spawn_key=(zlib.crc32(task.encode()),))
+            self.__streams[task] = np.random.default_rng(sequence)
+        return self.__streams[task]
+
+    #%%%%% JITTER %%%%%
+    def plan_jitter(self, task, n=JITTER_PLAN_SIZE):
+        """
+        Pre-draws uniform [0, 1) jitter values for a task. Does nothing if the task already has a plan.
+        """
+
+        if task not in self.__jitter:
+            self.__jitter[task] = [self.stream(task + '/jitter').random(n), 0]
+
+    def __extend_jitter(self, task, n=JITTER_PLAN_SIZE):
+        planned, position = self.__jitter[task]
+        self.__jitter[task] = [np.concatenate((planned, self.stream(task + '/jitter').random(n))), position]
+
+    def jitter(self, task, scale=0.1):
+        """
+        :return: The next pre-drawn jitter value of a task, scaled to [0, scale).
+        """
+
+        self.plan_jitter(task)
+        if self.__jitter[task][1] >= len(self.__jitter[task][0]):
+            self.__extend_jitter(task)
+        planned, position = self.__jitter[task]
+        self.__jitter[task][1] = position + 1
+        return planned[position] * scale
+
+    #%%%%% RANDOMISATION %%%%%
+    def randint(self, task, low, high):
+        """
+        :return: Random integer in [low, high], inclusive like random.randint.
+        """
+
+        return int(self.stream(task).integers(low, high + 1))
+
+    def shuffle(self, stimuli, task):
+        """
+        :return: The rows of a DataFrame in random order, drawn from the task's stream.
+        """
+
+        return stimuli.sample(frac=1, random_state=self.stream(task))
+
+    #%%%%% STATE %%%%%
+    def state(self):
+        """
+        :return: JSON-serialisable state of all streams and jitter positions.
+        """
+
+        return {'seed': self.__seed,
+                'streams': {task: rng.bit_generator.state for task, rng in self.__streams.items()},
+                'jitter': {task: position for task, (planned, position) in self.__jitter.items()},
+                'jitter_planned': {task: len(planned) for task, (planned, position) in self.__jitter.items()}}
+
+    def set_state(self, state):
+        """
+        Restores the state returned by state(). Jitter plans are re-drawn from the seed, then positioned.
+        """
+
+        self.__seed = state['seed']
+        self.__streams = {}
+        self.__jitter = {}
+        for task, n in state['jitter_planned'].items():
+            self.__jitter[task] = [self.stream(task + '/jitter').random(n), state['jitter'][task]]
+        for task, bit_generator_state in state['streams'].items():
+            self.stream(task).bit_generator.state = bit_generator_state
+
+    def save_plan(self, filepath):
+        """
+        Writes the seed and all jitter values drawn so far, so a session can be replayed or inspected offline.
+        """
+
+        with open(filepath, 'w') as f:
+            json.dump({'seed': self.__seed,
+                       'jitter': {task: planned.tolist() for task, (planned, position) in self.__jitter.items()}}, f)
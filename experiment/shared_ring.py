@@ -0,0 +1,102 @@
+# Shared-memory ring buffer for passing messages between the render process and the I/O worker.
+
+# A single-producer, single-consumer byte ring in multiprocessing.shared_memory. Messages are length-prefixed and may
+# wrap around the end of the buffer. The producer only ever advances the head and the consumer only ever advances the
+# tail, so no lock is needed and neither side blocks: put() returns False when the ring is full and get() returns
+# None when it is empty.
+
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+from multiprocessing import shared_memory
+
+import numpy as np
+import struct
+
+HEADER_BYTES = 16  # head and tail, as two uint64 byte counters
+LENGTH = struct.Struct('<I')
+
+#%%%%%%%%%% Ring buffer %%%%%%%%%%
+
+class SharedRing:
+
+    def __init__(self, name=None, capacity=1 << 20):
+        """
+        Creates a new ring, or attaches to an existing one if name is given.
+
+        :param name: Name of an existing ring's shared memory block.
+        :param capacity: Size of the data region in bytes (new rings only).
+        """
+
+        self.__owner = name is None
+        if self.__owner:
+            self.__shm = shared_memory.SharedMemory(create=True, size=HEADER_BYTES + capacity)
+            self.__shm.buf[:HEADER_BYTES] = bytes(HEADER_BYTES)
+        else:
+            # Attaching processes are started with multiprocessing and share the owner's resource tracker, so the
+            # block stays registered once and is unlinked by the owner
+            self.__shm = shared_memory.SharedMemory(name=name)
+        self.__counters = np.ndarray((2,), dtype=np.uint64, buffer=self.__shm.buf[:HEADER_BYTES])
+        self.__data = self.__shm.buf[HEADER_BYTES:]
+        self.__capacity = len(self.__data)
+
+    @property
+    def name(self):
+        return self.__shm.name
+
+    def __len__(self):
+        """
+        :return: Number of bytes waiting to be read.
+        """
+
+        return int(self.__counters[0] - self.__counters[1])
+
+    def __write(self, position, payload):
+        start = position % self.__capacity
+        first = min(len(payload), self.__capacity - start)
+        self.__data[start:start + first] = payload[:first]
+        if first < len(payload):
+            self.__data[:len(payload) - first] = payload[first:]
+
+    def __read(self, position, n):
+        start = position % self.__capacity
+        first = min(n, self.__capacity - start)
+        if first == n:
+            return bytes(self.__data[start:start + n])
+        return bytes(self.__data[start:start + first]) + bytes(self.__data[:n - first])
+
+    def put(self, payload):
+        """
+        Appends one message. Never blocks.
+
+        :param payload: Message bytes.
+        :return: False if there was not enough free space (the message is dropped).
+        """
+
+        head = int(self.__counters[0])
+        needed = LENGTH.size + len(payload)
+        if needed > self.__capacity - (head - int(self.__counters[1])):
+            return False
+        self.__write(head, LENGTH.pack(len(payload)))
+        self.__write(head + LENGTH.size, payload)
+        self.__counters[0] = head + needed  # Publish only after the message is fully written
+        return True
+
+    def get(self):
+        """
+        Removes and returns the oldest message, or None if the ring is empty. Never blocks.
+        """
+
+        tail = int(self.__counters[1])
+        if int(self.__counters[0]) == tail:
+            return None
+        n = LENGTH.unpack(self.__read(tail, LENGTH.size))[0]
+        payload = self.__read(tail + LENGTH.size, n)
+        self.__counters[1] = tail + LENGTH.size + n
+        return payload
+
+    def close(self):
+        del self.__counters
+        self.__data.release()
+        self.__shm.close()
+        if self.__owner:
+            self.__shm.unlink()
@@ -0,0 +1,208 @@
+# Storage configuration for the ONAC study.
+
+# Resolves the stimulus and output folders of each site (Lumo and Mini-CYRIL) from a JSON config file instead of
+# hard-coded paths, so that the tasks can run on any machine. If a cache directory is configured (e.g. a tmpfs
+# RAM disk), stimuli are copied there once from the network store and verified by hash before the session, and all
+# stimulus reads during the tasks are served from the cache.
+
+# The stimulus csvs of the study store absolute paths under the original piloting machine's folders (DEFAULT_CONFIG);
+# resolve() rewrites those, like paths under the configured store, to the configured stimulus root or its cache.
+
+# The config file is onac_config.json next to this script, or the file named by the ONAC_CONFIG environment variable.
+# See onac_config.example.json.
+
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+import hashlib
+import json
+import os
+import shutil
+
+_thisDir = os.path.dirname(os.path.abspath(__file__))
+
+# Used when there is no config file
+DEFAULT_CONFIG = {'sites': {'Lumo': '/Users/emilia/Documents/Dementia task piloting/Lumo',
+                            'Mini-CYRIL': '/Users/emilia/Documents/Dementia task piloting/Mini-CYRIL'},
+                  'output_roots': {},
+                  'cache_dir': None,
+                  'audio': {'rate': 48000, 'channels': 2, 'sample_format': 'int16'}}
+
+# Folders holding participant outputs and session checkpoints are never copied to the cache
+OUTPUT_FOLDERS = ('participant_data', 'checkpoints')
+
+MANIFEST = 'manifest.json'
+
+#%%%%%%%%%% Storage %%%%%%%%%%
+
+def file_hash(filepath, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def site_relative(filepath, root):
+    """
+    :return: filepath relative to root if it lies inside root, otherwise the absolute filepath.
+    """
+
+    filepath = os.path.abspath(filepath)
+    root = os.path.abspath(root)
+    try:
+        if os.path.commonpath([filepath, root]) == root:
+            return os.path.relpath(filepath, root)
+    except ValueError:  # Different drives
+        pass
+    return filepath
+
+
+class Storage:
+
+    def __init__(self, config=None):
+        """
+        :param config: Dictionary with 'sites' (site name -> stimulus root), optional 'output_roots' (site name ->
+        folder for participant data, defaulting to the stimulus root), optional 'cache_dir' and optional 'audio' (the
+        output device's rate, channels and sample_format, used for preprocessing and playback).
+        """
+
+        if config is None:
+            config = DEFAULT_CONFIG
+        self.__sites = dict(config['sites'])
+        self.__output_roots = dict(config.get('output_roots') or {})
+        self.__cache_dir = config.get('cache_dir')
+        self.__audio = dict(DEFAULT_CONFIG['audio'], **(config.get('audio') or {}))
+        self.__staged = {}  # site -> cache folder, once staged and verified
+
+    @classmethod
+    def load(cls, filepath=None):
+        """
+        Loads the config file, falling back to DEFAULT_CONFIG if there is none.
+
+        :param filepath: Filepath of the config json. Defaults to $ONAC_CONFIG or onac_config.json.
+        """
+
+        if filepath is None:
+            filepath = os.environ.get('ONAC_CONFIG', os.path.join(_thisDir, 'onac_config.json'))
+        if not os.path.exists(filepath):
+            return cls()
+        with open(filepath) as f:
+            config = json.load(f)
+        for key in ('output_roots', 'cache_dir', 'audio'):
+            config.setdefault(key, DEFAULT_CONFIG[key])
+        return cls(config)
+
+    @property
+    def sites(self):
+        return dict(self.__sites)
+
+    @property
+    def audio_format(self):
+        """
+        :return: Dictionary with the rate, channels and sample_format of the audio output device.
+        """
+
+        return dict(self.__audio)
+
+    def __check_site(self, site):
+        if site not in self.__sites:
+            raise ValueError('Unknown site: ' + str(site))
+
+    def stimulus_root(self, site):
+        """
+        :return: Folder to read stimuli from: the verified cache if the site has been staged, otherwise the store.
+        """
+
+        self.__check_site(site)
+        return self.__staged.get(site, self.__sites[site])
+
+    def output_root(self, site):
+        """
+        :return: Folder under which <task>/participant_data/ outputs are written.
+        """
+
+        self.__check_site(site)
+        return self.__output_roots.get(site, self.__sites[site])
+
+    def participant_data(self, site, task):
+        """
+        :return: Folder for the participant outputs of a task, <output root>/<task>/participant_data, created if needed.
+        """
+
+        folder = os.path.join(self.output_root(site), task, 'participant_data')
+        os.makedirs(folder, exist_ok=True)
+        return folder
+
+    def checkpoints(self, site):
+        """
+        :return: Folder for the session checkpoints of a site, <output root>/checkpoints, created if needed.
+        """
+
+        folder = os.path.join(self.output_root(site), 'checkpoints')
+        os.makedirs(folder, exist_ok=True)
+        return folder
+
+    def resolve(self, filepath):
+        """
+        Maps an absolute path inside a site's store, or inside the site's folder on the original piloting machine (as
+        stored in the instructions and stimulus csvs), to the same file under the site's stimulus root (the cache, if
+        staged).
+        """
+
+        filepath = str(filepath)
+        for site in self.__sites:
+            for root in (self.__sites[site], DEFAULT_CONFIG['sites'].get(site)):
+                if root is None:
+                    continue
+                relative = site_relative(filepath, root)
+                if not os.path.isabs(relative):
+                    return os.path.join(self.stimulus_root(site), relative)
+        return filepath
+
+    #%%%%% CACHE %%%%%
+    def stage(self, site):
+        """
+        Copies the stimuli of a site into the cache directory and verifies every file by hash. Files already in the
+        cache with an unchanged source (same size and mtime) are only re-verified, not copied.
+
+        :return: The cache folder, or the store itself if no cache directory is configured.
+        """
+
+        self.__check_site(site)
+        if self.__cache_dir is None:
+            return self.__sites[site]
+
+        print(f'Staging {site} stimuli to {self.__cache_dir}...')
+        root = self.__sites[site]
+        cache = os.path.join(self.__cache_dir, site)
+        manifest_file = os.path.join(cache, MANIFEST)
+        manifest = {}
+        if os.path.exists(manifest_file):
+            with open(manifest_file) as f:
+                manifest = json.load(f)
+
+        copied = 0
+        for directory, folders, files in os.walk(root):
+            folders[:] = [d for d in folders if d not in OUTPUT_FOLDERS]
+            for name in files:
+                source = os.path.join(directory, name)
+                relative = os.path.relpath(source, root)
+                target = os.path.join(cache, relative)
+                stat = os.stat(source)
+                entry = manifest.get(relative)
+                if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime or \
+                        not os.path.exists(target):
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    shutil.copy2(source, target)
+                    entry = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': file_hash(source)}
+                    manifest[relative] = entry
+                    copied += 1
+                if file_hash(target) != entry['sha256']:
+                    raise IOError('Cached copy of ' + source + ' does not match the original')
+
+        os.makedirs(cache, exist_ok=True)
+        with open(manifest_file, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        print(f'Copied {copied} file(s), verified {len(manifest)}')
+        self.__staged[site] = cache
+        return cache
@@ -0,0 +1,154 @@
+# Live telemetry for the ONAC tasks.
+
+# The task code publishes small JSON messages (task, block, trial, triggers, responses and frame-interval statistics)
+# as UDP datagrams on the local machine, which monitor.py displays for the experimenter. The socket is non-blocking:
+# if the send buffer is full or nobody is listening the message is dropped, never waited for. The CPU time of every
+# publish call is recorded so its per-frame cost can be checked.
+
+# Run this file to benchmark the cost of publishing.
+
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+import numpy as np
+import argparse
+import json
+import socket
+import time
+
+DEFAULT_ADDRESS = ('127.0.0.1', 47800)
+
+# Frame-interval statistics are published once per this many frames (about once a second at 60Hz)
+FRAME_REPORT_INTERVAL = 60
+
+# Number of per-call costs kept; older values are overwritten
+COST_BUFFER_SIZE = 36000
+
+#%%%%%%%%%% Publisher %%%%%%%%%%
+
+class TelemetryPublisher:
+
+    def __init__(self, address=DEFAULT_ADDRESS, source='experiment'):
+        """
+        :param address: (host, port) the monitor listens on, or None to disable telemetry.
+        :param source: Name of the publishing process, shown by the monitor.
+        """
+
+        self.__address = address
+        self.__source = source
+        self.__socket = None
+        if address is not None:
+            self.__socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.__socket.setblocking(False)
+        self.__sequence = 0
+        self.__dropped = 0
+        self.__costs = np.zeros(COST_BUFFER_SIZE)
+        self.__n_costs = 0
+        self.__intervals = np.zeros(FRAME_REPORT_INTERVAL)
+        self.__n_intervals = 0
+        self.__last_frame = None
+
+    @property
+    def enabled(self):
+        return self.__socket is not None
+
+    def publish(self, kind, **fields):
+        """
+        Sends one message without blocking. Dropped if it cannot be sent immediately.
+
+        :param kind: Message type, e.g. 'task', 'block', 'trial', 'trigger', 'response' or 'frames'.
+        :param fields: JSON-serialisable values.
+        """
+
+        if self.__socket is None:
+            return
+        start = time.perf_counter()
+        self.__sequence += 1
+        fields.update(kind=kind, source=self.__source, seq=self.__sequence, t=time.time())
+        try:
+            self.__socket.sendto(json.dumps(fields, default=str).encode(), self.__address)
+        except OSError:  # Buffer full (BlockingIOError) or no listener
+            self.__dropped += 1
+        self.__costs[self.__n_costs % COST_BUFFER_SIZE] = time.perf_counter() - start
+        self.__n_costs += 1
+
+    def frame(self):
+        """
+        Records one flip. Call straight after win.flip(); publishes interval statistics every FRAME_REPORT_INTERVAL
+        frames.
+        """
+
+        if self.__socket is None:
+            return
+        now = time.perf_counter()
+        if self.__last_frame is not None:
+            self.__intervals[self.__n_intervals] = now - self.__last_frame
+            self.__n_intervals += 1
+            if self.__n_intervals == FRAME_REPORT_INTERVAL:
+                self.publish('frames', n=FRAME_REPORT_INTERVAL,
+                             mean_ms=float(self.__intervals.mean() * 1e3),
+                             max_ms=float(self.__intervals.max() * 1e3))
+                self.__n_intervals = 0
+        self.__last_frame = now
+
+    def pause(self):
+        """
+        Marks a gap in the frame stream (e.g. a key wait), so it is not counted as a long frame interval.
+        """
+
+        self.__last_frame = None
+        self.__n_intervals = 0
+
+    #%%%%% CPU COST %%%%%
+    def costs(self):
+        """
+        :return: CPU time of the recorded publish calls in seconds (at most COST_BUFFER_SIZE values).
+        """
+
+        return self.__costs[:min(self.__n_costs, COST_BUFFER_SIZE)].copy()
+
+    def report(self):
+        costs = self.costs() * 1e6
+        if len(costs) == 0:
+            return
+        print(f'Telemetry: {self.__sequence} message(s), {self.__dropped} dropped, publish cost median '
+              f'{np.median(costs):.1f}us, 99th percentile {np.percentile(costs, 99):.1f}us, max {costs.max():.1f}us')
+
+    def close(self):
+        if self.__socket is not None:
+            self.__socket.close()
+            self.__socket = None
+
+
+def parse_address(text):
+    """
+    :param text: 'host:port', 'port', or 'off'.
+    :return: (host, port), or None if telemetry is off.
+    """
+
+    if text is None or text == 'off':
+        return None
+    host, _, port = text.rpartition(':')
+    return (host or DEFAULT_ADDRESS[0], int(port))
+
+#%%%%%%%%%% Benchmark %%%%%%%%%%
+
+def benchmark(n_frames=6000, address=DEFAULT_ADDRESS):
+    """
+    Measures the per-frame cost of publishing a trial message and a frame sample every frame.
+    """
+
+    publisher = TelemetryPublisher(address, source='benchmark')
+    for i in range(n_frames):
+        publisher.publish('trial', task='benchmark', block=i // 600, trial=i)
+        publisher.frame()
+    publisher.report()
+    publisher.close()
+    return publisher.costs()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the cost of publishing telemetry')
+    parser.add_argument('--frames', type=int, default=6000)
+    parser.add_argument('--address', default='127.0.0.1:47800', help='host:port of the monitor')
+    args = parser.parse_args()
+    benchmark(args.frames, parse_address(args.address))
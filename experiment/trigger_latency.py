@@ -0,0 +1,253 @@
+# Serial trigger latency benchmark for the ONAC tasks.
+
+# Measures the trigger path without the USB-serial adapter of the NIRS system. A pseudo-terminal pair stands in for
+# the serial link: the tasks' side opens the slave end with pyserial, exactly like the experiment opens the adapter,
+# and a receiver thread standing in for the acquisition PC timestamps every byte read from the master end.
+
+# Three paths are measured, each replaying the trigger sequences of the tasks with emulated flips (callOnFlip
+# functions are called straight after the flip, as PsychoPy does):
+#   - 'direct': serial.Serial.write from the render loop (broadbandNIRS.py),
+#   - 'io_bridge': IOBridge.trigger with its default direct writes from the render process (master_WV.py),
+#   - 'io_worker': IOBridge.trigger with direct_triggers=False, written by the I/O worker process.
+
+# Writing from the worker adds ~1.3-5ms median host latency to flip-locked triggers (e.g. '1' ~5.0ms, 'C' ~4.8ms,
+# 'E' ~1.3ms, against ~0.07ms for a direct write): the worker polls the ring and runs at lower priority. This is
+# why IOBridge writes triggers from the render process by default; 'io_bridge' should match 'direct'.
+
+# A pty transfers bytes at memory speed whatever the baud rate, so the time a byte would take on the wire (10 bits per
+# byte for 8N1) is added by modelling the receiving UART: each byte arrives one byte time after the later of its
+# host arrival and the end of the previous byte. Both the measured host latency and the modelled wire latency are
+# reported, per trigger code, along with the throughput of back-to-back bursts such as the 'F'/'D' writes at the end
+# of each object recognition block.
+
+# Usage: python trigger_latency.py [--bauds 9600 19200 115200] [--repeats 20]
+# Unix only (uses pty).
+
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+import pandas as pd
+import numpy as np
+import argparse
+import os
+import pty
+import select
+import threading
+import time
+import tty
+
+import serial
+
+from io_bridge import IOBridge
+
+BITS_PER_BYTE = 10  # 8N1: start bit, 8 data bits, stop bit
+
+FRAME_DUR = 1 / 60
+
+# Trigger sequences of the tasks as (frames after the previous trigger, code, sent with callOnFlip). Stimulus
+# durations are shortened; only the order of writes and whether they are back-to-back matter here.
+SEQUENCES = {
+    'object_recognition': [(3, 'C', True)] + [(3, 'E', True), (3, 'F', False)] * 12 + [(0, 'D', False)],
+    'resting_state': [(3, 'G', True), (6, 'H', False)],
+    'memory_task': [(3, '1', True), (3, '1a', True), (3, '2r', True), (3, '2ar', True)],
+    'naturalistic_motor_task': [(3, 'CN', True), (6, 'CNe', False)],
+}
+
+#%%%%%%%%%% Loopback %%%%%%%%%%
+
+class Receiver(threading.Thread):
+
+    def __init__(self, fd):
+        """
+        Reads and timestamps every byte from the master end of the pty.
+        """
+
+        super().__init__(daemon=True)
+        self.__fd = fd
+        self.__running = True
+        self.bytes = []  # (byte, perf_counter at arrival)
+
+    def run(self):
+        while self.__running:
+            readable, _, _ = select.select([self.__fd], [], [], 0.01)
+            if readable:
+                now = time.perf_counter()
+                try:
+                    data = os.read(self.__fd, 4096)
+                except OSError:
+                    break
+                self.bytes.extend((b, now) for b in data)
+
+    def stop(self):
+        self.__running = False
+        self.join()
+
+
+def open_loopback():
+    """
+    :return: (master fd, slave fd, slave device path) of a raw pseudo-terminal pair. The slave fd is kept open until
+             the benchmark ends, as reads from the master fail once no process has the slave open.
+    """
+
+    master, slave = pty.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+    return master, slave, os.ttyname(slave)
+
+
+def wire_times(arrivals, baudrate):
+    """
+    Models a UART at baudrate receiving bytes that reach the host at the given times.
+
+    :return: Time at which each byte has been fully received.
+    """
+
+    byte_time = BITS_PER_BYTE / baudrate
+    received = np.empty(len(arrivals))
+    end = -np.inf
+    for i, arrival in enumerate(arrivals):
+        end = max(arrival, end) + byte_time
+        received[i] = end
+    return received
+
+#%%%%%%%%%% Trigger paths %%%%%%%%%%
+
+def _replay(sequence, write):
+    """
+    Replays one trigger sequence with emulated flips.
+
+    :return: List of (code, time of the call, time spent in the call).
+    """
+
+    sent = []
+    deadline = time.perf_counter()
+    for frames, code, on_flip in sequence:
+        if on_flip:
+            deadline += max(frames, 1) * FRAME_DUR
+            while time.perf_counter() < deadline:
+                pass
+        start = time.perf_counter()
+        write(code)
+        sent.append((code, start, time.perf_counter() - start))
+        if not on_flip:
+            deadline = time.perf_counter()
+    return sent
+
+
+def run_path(path, baudrate, repeats=10):
+    """
+    Replays every task sequence through one trigger path and matches the received bytes to the triggers sent.
+
+    :param path: 'direct', 'io_bridge' or 'io_worker'.
+    :return: DataFrame with one row per trigger.
+    """
+
+    master, slave, name = open_loopback()
+    receiver = Receiver(master)
+    receiver.start()
+    if path == 'direct':
+        port = serial.Serial(name, baudrate=baudrate)
+        write = lambda code: port.write(code.encode())
+    else:
+        port = IOBridge(name, baudrate=baudrate, direct_triggers=path == 'io_bridge')
+        write = port.trigger
+
+    sent = []
+    for repeat in range(repeats):
+        for task, sequence in SEQUENCES.items():
+            sent += [(task, repeat) + j for j in _replay(sequence, write)]
+            time.sleep(0.05)  # Let the link drain between sequences
+
+    if path == 'direct':
+        port.flush()
+    port.close()
+    expected = sum(len(code) for _, _, code, _, _ in sent)
+    timeout = time.perf_counter() + 5
+    while len(receiver.bytes) < expected and time.perf_counter() < timeout:
+        time.sleep(0.01)
+    receiver.stop()
+    os.close(master)
+    os.close(slave)
+    if len(receiver.bytes) < expected:
+        raise RuntimeError(f'{path}: received {len(receiver.bytes)} of {expected} bytes')
+
+    # Bytes arrive in the order they were written; a trigger is received with its last byte
+    arrivals = np.array([t for _, t in receiver.bytes[:expected]])
+    wire = wire_times(arrivals, baudrate)
+    last_byte = np.cumsum([len(code) for _, _, code, _, _ in sent]) - 1
+    records = pd.DataFrame(sent, columns=['task', 'repeat', 'code', 'sent', 'call_s'])
+    records['path'] = path
+    records['baudrate'] = baudrate
+    records['host_latency_ms'] = (arrivals[last_byte] - records['sent']) * 1e3
+    records['wire_latency_ms'] = (wire[last_byte] - records['sent']) * 1e3
+    records['call_us'] = records.pop('call_s') * 1e6
+    return records
+
+
+def burst_throughput(baudrate, n_bytes=1000):
+    """
+    Writes n_bytes back-to-back in single-byte writes, like consecutive trigger writes.
+
+    :return: Dictionary of measured host and modelled wire throughput in bytes per second.
+    """
+
+    master, slave, name = open_loopback()
+    receiver = Receiver(master)
+    receiver.start()
+    port = serial.Serial(name, baudrate=baudrate)
+    start = time.perf_counter()
+    for _ in range(n_bytes):
+        port.write(b'F')
+    port.flush()
+    timeout = time.perf_counter() + 5
+    while len(receiver.bytes) < n_bytes and time.perf_counter() < timeout:
+        time.sleep(0.01)
+    receiver.stop()
+    port.close()
+    os.close(master)
+    os.close(slave)
+    arrivals = np.array([t for _, t in receiver.bytes])
+    wire = wire_times(arrivals, baudrate)
+    return {'baudrate': baudrate, 'bytes': len(arrivals),
+            'host_bytes_per_s': len(arrivals) / (arrivals[-1] - start),
+            'wire_bytes_per_s': len(arrivals) / (wire[-1] - start)}
+
+
+def summarise(records):
+    """
+    :return: Latency distribution per path, baud rate and trigger code, and the gap between the end-of-block 'F' and
+             'D' triggers of the object recognition task.
+    """
+
+    summary = records.groupby(['path', 'baudrate', 'code']).agg(
+        n=('host_latency_ms', 'size'),
+        call_us_median=('call_us', 'median'),
+        host_ms_median=('host_latency_ms', 'median'),
+        host_ms_p99=('host_latency_ms', lambda x: np.percentile(x, 99)),
+        wire_ms_median=('wire_latency_ms', 'median'),
+        wire_ms_p99=('wire_latency_ms', lambda x: np.percentile(x, 99)))
+    ort = records[records['task'] == 'object_recognition']
+    end_of_block = ort.groupby(['path', 'baudrate', 'repeat']).tail(2)
+    gaps = end_of_block.groupby(['path', 'baudrate', 'repeat'])['wire_latency_ms'].agg(lambda x: x.iloc[-1] - x.iloc[0])
+    return summary.reset_index(), gaps.groupby(['path', 'baudrate']).median().rename('F_to_D_wire_ms').reset_index()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serial trigger latency benchmark over a pty loopback')
+    parser.add_argument('--bauds', type=int, nargs='+', default=[9600, 19200, 57600, 115200])
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--paths', nargs='+', default=['direct', 'io_bridge', 'io_worker'],
+                        choices=['direct', 'io_bridge', 'io_worker'])
+    parser.add_argument('--output', default=None, help='csv to write every trigger to')
+    args = parser.parse_args()
+
+    records = pd.concat([run_path(path, baudrate, args.repeats) for path in args.paths for baudrate in args.bauds],
+                        ignore_index=True)
+    summary, gaps = summarise(records)
+    pd.set_option('display.width', 200)
+    print(summary.to_string(index=False, float_format='%.3f'))
+    print()
+    print(gaps.to_string(index=False, float_format='%.3f'))
+    print()
+    print(pd.DataFrame([burst_throughput(b) for b in args.bauds]).to_string(index=False, float_format='%.0f'))
+    if args.output is not None:
+        records.to_csv(args.output, index=False)
@@ -0,0 +1,235 @@
+# Offline video transcoding for the ONAC tasks.
+
+# MovieStim3 decodes and scales the MMN movies and the naturalistic motor task instruction video in real time. This
+# script transcodes every referenced video once, in parallel, to H.264 at the exact display resolution and frame rate
+# with a short GOP (or intra-only), which is cheap to decode and seek. Results are cached by the content hash of the
+# source and the encoding parameters, and the decode cost of every source and transcoded file is recorded.
+
+# Transcoded files are written to <site root>/preprocessed_video/ with a manifest, inside the stimulus tree so that
+# they are staged with the other stimuli (see storage.py). A transcoded file is only used while it matches its hash and
+# its source is unchanged; otherwise the source is played. Requires ffmpeg on the PATH.
+
+# Usage: python video_transcoding.py [--size 1440 900] [--fps 60] [--gop 12 | --intra]
+
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pandas as pd
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import time
+
+from storage import Storage, file_hash, site_relative
+
+MANIFEST = 'manifest.json'
+
+#%%%%%%%%%% Transcoding %%%%%%%%%%
+
+def referenced_videos(storage):
+    """
+    :param storage: Storage config; the videos are listed under the stimulus root of the Lumo site, and the paths
+                    stored in the MMN movie csv (e.g. under the original piloting machine's folders) are resolved
+                    through it, as the task does.
+    :return: List of the video filepaths used by the tasks.
+    """
+
+    root = storage.stimulus_root('Lumo')
+    videos = []
+    movies = os.path.join(root, 'mismatched_negativity_task', 'MMN_movie_stimuli.csv')
+    if os.path.exists(movies):
+        videos += [storage.resolve(j) for j in pd.read_csv(movies).values.ravel() if pd.notna(j)]
+    instructions = os.path.join(root, 'naturalistic_motor_task', 'instruction_video.mp4')
+    if os.path.exists(instructions):
+        videos.append(instructions)
+    return list(dict.fromkeys(videos))
+
+
+def decode_cost(filepath):
+    """
+    Decodes a whole video with ffmpeg and measures the cost.
+
+    :return: Dictionary with frames decoded, wall-clock seconds, CPU seconds and CPU milliseconds per frame.
+    """
+
+    start = time.perf_counter()
+    result = subprocess.run(['ffmpeg', '-hide_banner', '-benchmark', '-threads', '1', '-i', filepath, '-an',
+                             '-f', 'null', '-'], capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    frames = re.findall(r'frame=\s*(\d+)', result.stderr)
+    cpu = re.findall(r'utime=([\d.]+)s', result.stderr)
+    frames = int(frames[-1]) if frames else 0
+    cpu = float(cpu[-1]) if cpu else None
+    return {'frames': frames, 'wall_s': wall, 'cpu_s': cpu,
+            'cpu_ms_per_frame': cpu * 1000 / frames if cpu is not None and frames else None}
+
+
+def _encoding_tag(size, fps, gop):
+    return str(size[0]) + 'x' + str(size[1]) + '_' + str(fps) + 'fps_gop' + str(gop)
+
+
+def _transcode(args):
+    source, target, size, fps, gop, threads = args
+    width, height = size
+    scale = ('scale=' + str(width) + ':' + str(height) + ':force_original_aspect_ratio=decrease,'
+             'pad=' + str(width) + ':' + str(height) + ':(ow-iw)/2:(oh-ih)/2,fps=' + str(fps))
+    tmp = target + '.part.mp4'
+    try:
+        subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y', '-i', source, '-vf', scale,
+                        '-c:v', 'libx264', '-preset', 'medium', '-crf', '18', '-tune', 'fastdecode',
+                        '-pix_fmt', 'yuv420p', '-g', str(gop), '-keyint_min', str(gop), '-sc_threshold', '0',
+                        '-c:a', 'aac', '-ar', '48000', '-movflags', '+faststart', '-threads', str(threads), tmp],
+                       check=True, capture_output=True, text=True)
+    except subprocess.CalledProcessError as e:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise RuntimeError('ffmpeg failed: ' + e.stderr.strip()) from e
+    os.replace(tmp, target)
+    return source, decode_cost(source), decode_cost(target)
+
+
+def transcode(storage, size=(1440, 900), fps=60, gop=12, workers=None):
+    """
+    Transcodes every referenced video that is not already cached.
+
+    :param storage: Storage config; the transcodes are written under the stimulus root of the Lumo site.
+    :param size: Display resolution (width, height).
+    :param fps: Display frame rate.
+    :param gop: Keyframe interval in frames; 1 gives intra-only video.
+    :param workers: Number of parallel ffmpeg processes. Defaults to half the number of cores.
+    :return: The manifest, mapping site-relative source paths to their transcoded file and decode metrics. If any
+             video fails, the others are still transcoded and recorded, and a RuntimeError listing the failures is
+             raised at the end.
+    """
+
+    if shutil.which('ffmpeg') is None:
+        raise RuntimeError('ffmpeg was not found on the PATH')
+    if workers is None:
+        workers = max(1, (os.cpu_count() or 2) // 2)
+    threads = max(1, (os.cpu_count() or 2) // workers)
+
+    root = storage.stimulus_root('Lumo')
+    output = os.path.join(root, 'preprocessed_video')
+    os.makedirs(output, exist_ok=True)
+    manifest_file = os.path.join(output, MANIFEST)
+    manifest = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+
+    tag = _encoding_tag(size, fps, gop)
+    jobs = []
+    keys = {}
+    for video in referenced_videos(storage):
+        key = site_relative(video, root)
+        target = os.path.join(output, file_hash(video)[:16] + '_' + tag + '.mp4')
+        entry = manifest.get(key)
+        if entry is not None and entry['file'] == os.path.basename(target) and 'source_sha256' in entry and \
+                os.path.exists(target) and file_hash(target) == entry['sha256']:
+            continue
+        keys[video] = (key, target)
+        jobs.append((video, target, size, fps, gop, threads))
+
+    print(f'Transcoding {len(jobs)} video(s) to {tag} with {workers} worker(s)...')
+    failures = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(_transcode, job): job[0] for job in jobs}
+        for future in as_completed(futures):
+            key, target = keys[futures[future]]
+            try:
+                source, source_cost, target_cost = future.result()
+            except Exception as e:
+                failures[key] = e
+                print(f'{key}: failed ({e})')
+                continue
+            stat = os.stat(source)
+            manifest[key] = {'file': os.path.basename(target), 'sha256': file_hash(target),
+                             'source_sha256': file_hash(source), 'source_size': stat.st_size,
+                             'source_mtime': stat.st_mtime,
+                             'encoding': tag, 'source_decode': source_cost, 'decode': target_cost}
+            print(f"{key}: {source_cost['cpu_ms_per_frame']} -> {target_cost['cpu_ms_per_frame']} ms/frame")
+
+    tmp = manifest_file + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, manifest_file)
+    if failures:
+        raise RuntimeError(f'{len(failures)} of {len(jobs)} video(s) failed to transcode: ' +
+                           '; '.join(key + ': ' + str(e) for key, e in failures.items()))
+    return manifest
+
+
+class VideoCache:
+
+    def __init__(self, root, verify=True):
+        """
+        Looks up the transcoded copy of a video.
+
+        :param root: Stimulus root of the site (the store or its staged cache).
+        :param verify: Check the hash of every transcoded file when the cache is opened, so corrupted files are found
+                       at setup rather than during a block.
+        """
+
+        self.__root = root
+        self.__checked = {}  # site-relative source -> transcoded copy, or None if it cannot be used
+        self.__folder = os.path.join(root, 'preprocessed_video')
+        self.__manifest = {}
+        manifest_file = os.path.join(self.__folder, MANIFEST)
+        if os.path.exists(manifest_file):
+            with open(manifest_file) as f:
+                self.__manifest = json.load(f)
+        else:
+            print(f'No transcoded video in {self.__folder}, run video_transcoding.py')
+        if verify:
+            for key, entry in self.__manifest.items():
+                target = os.path.join(self.__folder, entry['file'])
+                if os.path.exists(target) and file_hash(target) != entry['sha256']:
+                    print(f'Warning: the transcoded copy of {key} is corrupted, rerun video_transcoding.py')
+                    self.__checked[key] = None
+
+    def __source_changed(self, filepath, entry):
+        # Manifests written before source hashes were recorded cannot be checked, so they are transcoded again
+        if 'source_sha256' not in entry:
+            return True
+        stat = os.stat(filepath)
+        if stat.st_size == entry['source_size'] and stat.st_mtime == entry['source_mtime']:
+            return False
+        return file_hash(filepath) != entry['source_sha256']
+
+    def resolve(self, filepath):
+        """
+        :return: The transcoded copy of filepath, or filepath itself (with a warning) if it was not transcoded, is
+                 corrupted or its source has changed since.
+        """
+
+        key = site_relative(filepath, self.__root)
+        if key not in self.__checked:
+            entry = self.__manifest.get(key)
+            if entry is None or not os.path.exists(os.path.join(self.__folder, entry['file'])):
+                print(f'Warning: {filepath} has not been transcoded and will be decoded and scaled in real time')
+                self.__checked[key] = None
+            elif self.__source_changed(filepath, entry):
+                print(f'Warning: {filepath} has changed since it was transcoded and will be decoded and scaled in '
+                      f'real time, rerun video_transcoding.py')
+                self.__checked[key] = None
+            else:
+                self.__checked[key] = os.path.join(self.__folder, entry['file'])
+        return filepath if self.__checked[key] is None else self.__checked[key]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Transcode task videos for cheap decoding')
+    parser.add_argument('--config', default=None, help='Storage config json (default: onac_config.json)')
+    parser.add_argument('--size', type=int, nargs=2, default=[1440, 900], metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--fps', type=int, default=60)
+    parser.add_argument('--gop', type=int, default=12, help='Keyframe interval in frames')
+    parser.add_argument('--intra', action='store_true', help='Intra-only video (same as --gop 1)')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    storage = Storage.load(args.config)
+    transcode(storage, tuple(args.size), args.fps, 1 if args.intra else args.gop, args.workers)
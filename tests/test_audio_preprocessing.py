@@ -0,0 +1,68 @@
+import os
+import sys
+
+import numpy as np
+from scipy.io import wavfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'experiment'))
+from audio_preprocessing import AudioCache, preprocess, referenced_wavs
+from storage import DEFAULT_CONFIG, Storage
+
+
+def tone(filepath, rate=44100):
+    t = np.arange(rate // 10) / rate
+    wavfile.write(str(filepath), rate, (0.3 * np.sin(2 * np.pi * 440 * t) * 32767).astype(np.int16))
+    return str(filepath)
+
+
+def make_site(root):
+    folder = root / 'mismatched_negativity_task' / 'auditory_stimuli'
+    folder.mkdir(parents=True)
+    (root / 'mismatched_negativity_task' / 'auditory_stimuli.csv').write_text('block,trigger,sound,condition\n'
+                                                                              '0,S,standard,standard\n')
+    return tone(folder / 'standard.wav')
+
+
+def make_storage(root):
+    return Storage({'sites': {'Lumo': str(root), 'Mini-CYRIL': str(root / 'Mini-CYRIL')}})
+
+
+def test_resolve_uses_the_preprocessed_copy_of_an_unchanged_source(tmp_path):
+    source = make_site(tmp_path)
+    preprocess(make_storage(tmp_path), 48000, 2, 'int16', workers=1)
+    resolved = AudioCache(str(tmp_path), 48000, 2, 'int16').resolve(source)
+    assert resolved != source
+    rate, samples = wavfile.read(resolved)
+    assert rate == 48000 and samples.shape[1] == 2 and samples.dtype == np.int16
+
+
+def test_resolve_falls_back_to_an_edited_source(tmp_path, capsys):
+    source = make_site(tmp_path)
+    preprocess(make_storage(tmp_path), 48000, 2, 'int16', workers=1)
+    wavfile.write(source, 44100, np.zeros(4410, dtype=np.int16))
+    assert AudioCache(str(tmp_path), 48000, 2, 'int16').resolve(source) == source
+    assert 'has changed' in capsys.readouterr().out
+
+
+def test_resolve_keeps_a_touched_but_unchanged_source(tmp_path):
+    source = make_site(tmp_path)
+    preprocess(make_storage(tmp_path), 48000, 2, 'int16', workers=1)
+    os.utime(source, (0, 0))
+    assert AudioCache(str(tmp_path), 48000, 2, 'int16').resolve(source) != source
+
+
+def test_legacy_instruction_paths_are_resolved_and_keyed_by_site(tmp_path):
+    folder = tmp_path / 'naturalistic_motor_task' / 'instructions'
+    folder.mkdir(parents=True)
+    source = tone(folder / 'clap.wav', rate=22050)
+    # The stimulus csv stores the instruction under the original piloting machine's folder
+    legacy = DEFAULT_CONFIG['sites']['Lumo'] + '/naturalistic_motor_task/instructions/clap.wav'
+    (tmp_path / 'naturalistic_motor_task' / 'naturalistic_motor_task_stimuli.csv').write_text(
+        'stimulus,trigger,end_trigger,instruction\nClap,C,E,' + legacy + '\n')
+    storage = make_storage(tmp_path)
+    assert referenced_wavs(storage) == {'naturalistic_motor_task/clap.wav': [source]}
+    manifest = preprocess(storage, 48000, 2, 'int16', workers=1)
+    assert list(manifest) == [os.path.join('naturalistic_motor_task', 'instructions', 'clap.wav')]
+    # Looked up as the task plays it
+    resolved = AudioCache(str(tmp_path), 48000, 2, 'int16').resolve(storage.resolve(legacy))
+    assert resolved != source and wavfile.read(resolved)[0] == 48000
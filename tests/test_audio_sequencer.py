@@ -0,0 +1,36 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+from scipy.io import wavfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'experiment'))
+from audio_sequencer import AudioSequencer
+
+
+def write_tone(filepath, rate=44100, seconds=0.05):
+    t = np.arange(int(rate * seconds)) / rate
+    wavfile.write(filepath, rate, (0.5 * np.sin(2 * np.pi * 440 * t) * 32767).astype(np.int16))
+    return str(filepath)
+
+
+def test_render_places_tones_at_exact_sample_onsets(tmp_path):
+    tone = write_tone(tmp_path / 'standard.wav')
+    sequencer = AudioSequencer(sample_rate=48000, channels=2, soa=0.5)
+    buffer, onsets = sequencer.render([tone] * 3, ['S', 'S', 'D'], ['standard', 'standard', 'deviant'])
+    assert buffer.shape == (72000, 2)
+    assert list(onsets['onset_sample']) == [0, 24000, 48000]
+    assert list(onsets['trigger']) == ['S', 'S', 'D']
+    assert np.all(buffer[2400:24000] == 0)
+
+
+def test_render_rejects_an_empty_block():
+    with pytest.raises(ValueError, match='without tones'):
+        AudioSequencer(48000, 2).render([], [], [])
+
+
+def test_render_rejects_mismatched_lengths(tmp_path):
+    tone = write_tone(tmp_path / 'standard.wav')
+    with pytest.raises(ValueError):
+        AudioSequencer(48000, 2).render([tone, tone], ['S'], ['standard', 'standard'])
@@ -0,0 +1,59 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'analysis'))
+from block_averaging import BlockAnalysis, analyse_cohort, simulate_recording
+
+FS = 10.0
+
+
+def test_glm_recovers_known_betas():
+    analysis = BlockAnalysis('visual_stimulation', FS)
+    onsets = np.arange(10) * 140 + 20
+    codes = np.array(['A', 'B'])[np.arange(10) % 2]
+    n_samples = 1540
+    X, names = analysis.design_matrix(n_samples, onsets, codes)
+    assert names == ['A', 'B', 'constant', 'drift']
+    betas = np.array([[1.0, 2.0, -0.5], [0.5, -1.0, 3.0], [4.0, 0.0, 1.0], [0.2, -0.3, 0.0]])
+    noise = np.random.default_rng(0).normal(0, 0.01, size=(3, n_samples))
+    data = (X @ betas).T + noise
+    estimated = analysis.glm(data, onsets, codes)
+    for i, name in enumerate(names):
+        np.testing.assert_allclose(estimated[name], betas[i], atol=0.05)
+
+
+def test_glm_keeps_the_leading_dimensions():
+    recording = simulate_recording('P0', 'visual_stimulation', FS, 6, seed=0)
+    data = recording['data'].reshape(3, 2, -1)
+    betas = BlockAnalysis('visual_stimulation', FS).glm(data, recording['onsets'], recording['codes'])
+    assert betas['A'].shape == (3, 2)
+    flat = BlockAnalysis('visual_stimulation', FS).glm(recording['data'], recording['onsets'], recording['codes'])
+    np.testing.assert_allclose(betas['A'].ravel(), flat['A'])
+
+
+def test_block_average_is_baseline_corrected_per_condition():
+    analysis = BlockAnalysis('visual_stimulation', FS)
+    data = np.full((2, 1000), 5.0)
+    onsets = np.array([100, 300, 500, 700, 990])
+    codes = np.array(['A', 'B', 'A', 'B', 'A'])
+    for onset, code in zip(onsets, codes):
+        data[:, onset:onset + 100] += 1.0 if code == 'A' else 2.0
+    averages = analysis.block_average(data, onsets, codes)
+    mean, sem, n = averages['A']
+    assert n == 2  # The last block runs past the end of the recording and is dropped
+    assert mean.shape == (2, 140)
+    np.testing.assert_allclose(mean[:, :20], 0.0)
+    np.testing.assert_allclose(mean[:, 20:120], 1.0)
+    np.testing.assert_allclose(averages['B'][0][:, 20:120], 2.0)
+
+
+def test_parallel_cohort_analysis_matches_serial():
+    recordings = [simulate_recording('P' + str(p), 'visual_stimulation', FS, 4, seed=p) for p in range(3)]
+    serial = analyse_cohort(recordings, 'visual_stimulation', FS, workers=1)
+    parallel = analyse_cohort(recordings, 'visual_stimulation', FS, workers=2)
+    for a, b in zip(serial, parallel):
+        assert a['participant'] == b['participant']
+        for name in a['betas']:
+            np.testing.assert_allclose(a['betas'][name], b['betas'][name])
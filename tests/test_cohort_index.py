@@ -0,0 +1,77 @@
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'analysis'))
+from cohort_index import CohortIndex
+
+# Named as Experiment.__filename_save names them: P<participant>_<session>_<suffix>
+MORNING = '2024-04-02_10h15.40.001'
+AFTERNOON = '2024-04-02_15h30.00.000'
+
+
+def write(root, task, name, text='frames,dropped_frames\n600,3\n'):
+    folder = root / task / 'participant_data'
+    folder.mkdir(parents=True, exist_ok=True)
+    (folder / name).write_text(text)
+    return folder / name
+
+
+def test_visits_on_the_same_day_are_separate_sessions(tmp_path):
+    write(tmp_path, 'visual_stimulation', 'P1_2024-03-05_14h02.11.123_data.csv')
+    write(tmp_path, 'visual_stimulation', 'P1_' + MORNING + '_data.csv')
+    write(tmp_path, 'visual_stimulation', 'P1_' + AFTERNOON + '_data.csv')
+    index = CohortIndex(str(tmp_path / 'index.sqlite'), {'Lumo': str(tmp_path)})
+    index.update()
+    assert index.query('SELECT participant, session_date, session FROM sessions ORDER BY session') == \
+        [(1, '2024-03-05', '2024-03-05_14h02.11.123'), (1, '2024-04-02', MORNING), (1, '2024-04-02', AFTERNOON)]
+    index.close()
+
+
+def test_the_tasks_of_one_visit_share_a_session(tmp_path):
+    write(tmp_path, 'object_recognition_task', 'P2_' + MORNING + '_object_recognition_task.csv', 'a\n1\n')
+    write(tmp_path, 'memory_task', 'P2_' + MORNING + '_data.csv', 'a\n1\n')
+    write(tmp_path, 'mismatched_negativity_task', 'P2_' + MORNING + '_mismatched_negativity_task.csv', 'a\n1\n')
+    index = CohortIndex(str(tmp_path / 'index.sqlite'), {'Lumo': str(tmp_path)})
+    index.update()
+    assert index.query('SELECT COUNT(*) FROM sessions') == [(1,)]
+    assert sorted(row[4] for row in index.sessions()) == \
+        ['memory_task', 'mismatched_negativity_task', 'object_recognition_task']
+    index.close()
+
+
+def test_copied_files_keep_their_session(tmp_path):
+    copied = write(tmp_path, 'memory_task', 'P3_' + MORNING + '_data.csv', 'a\n1\n')
+    month_later = time.mktime((2024, 5, 2, 12, 0, 0, 0, 0, -1))
+    os.utime(copied, (month_later, month_later))
+    index = CohortIndex(str(tmp_path / 'index.sqlite'), {'Lumo': str(tmp_path)})
+    index.update()
+    assert index.query('SELECT session_date, session FROM sessions') == [('2024-04-02', MORNING)]
+    index.close()
+
+
+def test_files_without_a_session_are_grouped_by_date(tmp_path):
+    legacy = write(tmp_path, 'memory_task', 'P4_data.csv', 'a\n1\n')
+    modified = time.mktime((2023, 11, 20, 12, 0, 0, 0, 0, -1))
+    os.utime(legacy, (modified, modified))
+    index = CohortIndex(str(tmp_path / 'index.sqlite'), {'Lumo': str(tmp_path)})
+    index.update()
+    assert index.query('SELECT participant, session_date, session FROM sessions') == [(4, '2023-11-20', '2023-11-20')]
+    index.close()
+
+
+def test_deleted_and_moved_files_are_removed(tmp_path):
+    kept = write(tmp_path, 'memory_task', 'P1_2024-03-05_14h02.11.123_data.csv', 'a\n1\n')
+    moved = write(tmp_path, 'memory_task', 'P2_2024-03-06_09h00.00.000_data.csv', 'a\n1\n')
+    deleted = write(tmp_path, 'memory_task', 'P3_2024-03-07_09h00.00.000_data.csv', 'a\n1\n')
+    index = CohortIndex(str(tmp_path / 'index.sqlite'), {'Lumo': str(tmp_path)})
+    index.update()
+    deleted.unlink()
+    renamed = moved.with_name('P2_2024-03-08_09h00.00.000_data.csv')
+    os.replace(moved, renamed)
+    index.update()
+    assert index.query('SELECT participant, session_date FROM sessions ORDER BY participant') == \
+        [(1, '2024-03-05'), (2, '2024-03-08')]
+    assert index.query('SELECT participant FROM participants ORDER BY participant') == [(1,), (2,)]
+    assert sorted(row[-1] for row in index.sessions()) == sorted([str(kept), str(renamed)])
+    index.close()
@@ -0,0 +1,34 @@
+import gc
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'experiment'))
+from gc_policy import GCPolicy
+
+
+def test_forced_collections_are_recorded_as_explicit():
+    policy = GCPolicy('default')
+    policy.start()
+    try:
+        policy.set_task('memory_task')
+        policy.collect('release', force=True)  # As the resource manager does at the end of a task
+        policy.collect('break')  # Only marks the phase under the default policy
+    finally:
+        policy.stop()
+    pauses = policy.pauses()
+    assert [(p['task'], p['phase'], p['explicit']) for p in pauses if p['phase'] in ('release', 'break')] == \
+        [('memory_task', 'release', True)]
+
+
+def test_controlled_policy_only_collects_at_collection_points():
+    policy = GCPolicy('controlled')
+    policy.start()
+    try:
+        assert not gc.isenabled()
+        policy.set_task('visual_stimulation')
+        policy.phase('stimulation')
+        policy.collect('baseline')
+    finally:
+        policy.stop()
+    assert gc.isenabled()
+    assert all(p['explicit'] for p in policy.pauses())
@@ -0,0 +1,56 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'analysis'))
+from block_averaging import BlockAnalysis, simulate_recording
+from motion_correction import inject_artefacts, tddr, tddr_chunked
+
+FS = 10.0
+CHUNK = 60.0  # 600 samples, so the recording below spans ten chunks
+
+
+def recording(seed=0):
+    clean = simulate_recording('P0', 'visual_stimulation', FS, 4, n_blocks=40, seed=seed)
+    return clean, inject_artefacts(clean['data'], FS, seed=seed + 1)
+
+
+def average_error(data, clean):
+    analysis = BlockAnalysis('visual_stimulation', FS)
+    averages = [analysis.block_average(d, clean['onsets'], clean['codes']) for d in (data, clean['data'])]
+    difference = np.stack([averages[0][code][0] - averages[1][code][0] for code in sorted(averages[1])])
+    return np.sqrt(np.mean(difference ** 2))
+
+
+def test_tddr_removes_injected_artefacts():
+    clean, corrupted = recording()
+    assert average_error(tddr(corrupted, FS), clean) < 0.6 * average_error(corrupted, clean)
+
+
+def test_chunked_tddr_matches_tddr_without_steps_at_chunk_boundaries():
+    clean, corrupted = recording()
+    full = tddr(corrupted, FS)
+    chunked = tddr_chunked(corrupted, FS, chunk_seconds=CHUNK, overlap_seconds=10.0)
+    assert chunked.shape == corrupted.shape
+    np.testing.assert_allclose(average_error(chunked, clean), average_error(full, clean), rtol=0.1)
+    steps = np.diff(chunked, axis=-1)
+    boundaries = np.arange(600, corrupted.shape[-1], 600)
+    # The change across each boundary is the signal's own, not a jump between independently corrected chunks
+    typical = np.median(np.abs(steps))
+    np.testing.assert_allclose(steps[:, boundaries - 1], np.diff(full, axis=-1)[:, boundaries - 1],
+                               atol=0.1 * typical)
+
+
+def test_chunked_tddr_writes_into_a_memory_mapped_output(tmp_path):
+    _, corrupted = recording(seed=3)
+    np.save(tmp_path / 'raw.npy', corrupted)
+    data = np.load(tmp_path / 'raw.npy', mmap_mode='r')
+    out = np.lib.format.open_memmap(str(tmp_path / 'corrected.npy'), mode='w+', dtype=float, shape=data.shape)
+    assert tddr_chunked(data, FS, chunk_seconds=CHUNK, out=out) is out
+    out.flush()
+    np.testing.assert_allclose(np.load(tmp_path / 'corrected.npy'), tddr_chunked(corrupted, FS, chunk_seconds=CHUNK))
+    # Recordings shorter than a chunk are corrected in one piece, into out as well
+    short = np.empty((4, 500))
+    assert tddr_chunked(corrupted[:, :500], FS, chunk_seconds=CHUNK, out=short) is short
+    np.testing.assert_allclose(short, tddr(corrupted[:, :500], FS))
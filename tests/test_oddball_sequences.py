@@ -0,0 +1,61 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'experiment'))
+from oddball_sequences import OddballGenerator, deviant_positions, write_participant
+
+DEVIANTS = {'frequency': ('frequency_deviant', 'F'), 'duration': ('duration_deviant', 'D'),
+            'intensity': ('intensity_deviant', 'I')}
+
+
+def test_sequences_satisfy_the_constraints():
+    generator = OddballGenerator(('standard', 'S'), DEVIANTS, 200, deviant_probability=0.15, min_standards=2,
+                                 lead_standards=5)
+    assert generator.n_deviants == 30
+    codes = generator.sequences(np.random.default_rng(1), 500)
+    assert codes.shape == (500, 200)
+    for sequence in codes:
+        positions = np.flatnonzero(sequence)
+        assert len(positions) == 30
+        assert positions[0] >= 5
+        assert np.all(np.diff(positions) >= 3)  # At least two standards between deviants
+        assert np.array_equal(np.bincount(sequence[positions]), [0, 10, 10, 10])
+
+
+def test_every_valid_placement_is_equally_likely():
+    # 2 deviants in 6 tones with 2 standards between them and none before: (0, 3), (0, 4), (0, 5), (1, 4), (1, 5)
+    # and (2, 5)
+    positions = deviant_positions(np.random.default_rng(2), 60000, 6, 2, 2, 0)
+    placements, counts = np.unique(positions, axis=0, return_counts=True)
+    assert [tuple(p) for p in placements] == [(0, 3), (0, 4), (0, 5), (1, 4), (1, 5), (2, 5)]
+    np.testing.assert_allclose(counts / 60000, 1 / 6, atol=0.01)
+
+
+def test_impossible_constraints_are_rejected():
+    with pytest.raises(ValueError, match='do not fit'):
+        OddballGenerator(('standard', 'S'), DEVIANTS, 30, deviant_probability=0.5, min_standards=2)
+
+
+def test_validate_reports_violations():
+    generator = OddballGenerator(('standard', 'S'), DEVIANTS, 60, deviant_probability=0.1)
+    sequence = generator.generate(np.random.default_rng(3), n_blocks=2)
+    assert generator.validate(sequence) == []
+    first = sequence.index[(sequence['block'] == 0) & (sequence['condition'] != 'standard')][0]
+    sequence.loc[first + 1, ['trigger', 'sound', 'condition']] = sequence.loc[first, ['trigger', 'sound', 'condition']]
+    errors = generator.validate(sequence)
+    assert any('block 0: 7 deviants' in e for e in errors)
+    assert any('fewer than 2 standards' in e for e in errors)
+    assert any('unbalanced' in e for e in errors)
+
+
+def test_participant_sequences_are_reproducible(tmp_path):
+    generator = OddballGenerator(('standard', 'S'), DEVIANTS, 60, deviant_probability=0.1)
+    first = pd.read_csv(write_participant(generator, str(tmp_path), 7, n_blocks=3))
+    second = pd.read_csv(write_participant(generator, str(tmp_path / 'again'), 7, n_blocks=3))
+    other = pd.read_csv(write_participant(generator, str(tmp_path), 8, n_blocks=3))
+    assert list(first.columns) == ['block', 'trigger', 'sound', 'condition'] and len(first) == 180
+    assert first.equals(second) and not first.equals(other)
@@ -0,0 +1,91 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'analysis'))
+from block_averaging import simulate_recording
+from pipeline import EXPERIMENT_NAME, Pipeline, handler_files, onac_stages, task_files
+
+MORNING = '2024-04-02_10h15.40.001'
+AFTERNOON = '2024-04-02_15h30.00.000'
+
+
+def write(filepath, text):
+    filepath.parent.mkdir(parents=True, exist_ok=True)
+    filepath.write_text(text)
+    return filepath
+
+
+@pytest.fixture
+def study(tmp_path):
+    outputs = tmp_path / 'outputs'
+    write(tmp_path / 'stimuli' / 'visual_stimulation' / 'stimuli' / 'P1_visual_stimulation_stimuli.csv',
+          'Link,condition\na.png,A\n')
+    write(outputs / 'memory_task' / 'participant_data' / ('P1_' + MORNING + '_data.csv'),
+          'phase,condition,response,reaction_time\nrecall,LL,1,0.6\nrecall,LL,0,0.8\n')
+    write(outputs / 'visual_stimulation' / 'participant_data' / ('P1_' + MORNING + '_data.csv'),
+          'frames,dropped_frames\n600,6\n')
+    write(tmp_path / 'data' / ('1_' + EXPERIMENT_NAME + '_' + MORNING + '.csv'), 'trial,key\n0,space\n')
+    recording = simulate_recording('P1', 'visual_stimulation', 10.0, 2, n_blocks=4, seed=0)
+    (tmp_path / 'nirs').mkdir()
+    np.savez(tmp_path / 'nirs' / 'P1_visual_stimulation.npz', data=recording['data'], onsets=recording['onsets'],
+             codes=recording['codes'])
+    context = {'stimulus_root': str(tmp_path / 'stimuli'), 'output_root': str(outputs),
+               'handler_dir': str(tmp_path / 'data'), 'nirs_dir': str(tmp_path / 'nirs')}
+    return tmp_path, context
+
+
+def run(tmp_path, context, params=None):
+    pipeline = Pipeline(onac_stages(), str(tmp_path / 'cache'), context, params, workers=1)
+    _, report = pipeline.run([1])
+    return pipeline, set(report.loc[~report['cached'], 'stage'])
+
+
+def test_a_changed_file_reruns_exactly_the_downstream_stages(study):
+    tmp_path, context = study
+    _, ran = run(tmp_path, context)
+    assert ran == {'stimuli', 'task_data', 'experiment_handler', 'merged', 'scores', 'nirs'}
+    assert run(tmp_path, context)[1] == set()
+    write(tmp_path / 'outputs' / 'memory_task' / 'participant_data' / ('P1_' + MORNING + '_data.csv'),
+          'phase,condition,response,reaction_time\nrecall,LL,1,0.6\nrecall,LL,1,0.7\n')
+    pipeline, ran = run(tmp_path, context)
+    assert ran == {'task_data', 'merged', 'scores'}
+    scores = pipeline.load(1, 'scores').set_index('measure')['value']
+    assert scores['recall_LL_accuracy'] == 1.0 and scores['dropped_fraction'] == 0.01
+
+
+def test_a_changed_parameter_reruns_its_stage_and_prunes_the_old_output(study):
+    tmp_path, context = study
+    run(tmp_path, context)
+    _, ran = run(tmp_path, context, {'nirs': {'motion_correction': True}})
+    assert ran == {'nirs'}
+    assert len(os.listdir(tmp_path / 'cache' / 'nirs')) == 1
+    # Going back to the old parameters recomputes the pruned output
+    assert run(tmp_path, context)[1] == {'nirs'}
+
+
+def test_every_session_of_a_task_is_read(study):
+    tmp_path, context = study
+    write(tmp_path / 'outputs' / 'memory_task' / 'participant_data' / ('P1_' + AFTERNOON + '_data.csv'),
+          'phase,condition,response,reaction_time\nrecall,LL,1,0.5\n')
+    write(tmp_path / 'outputs' / 'memory_task' / 'participant_data' / ('P12_' + AFTERNOON + '_data.csv'),
+          'phase,condition,response,reaction_time\nrecall,LL,0,0.5\n')
+    assert [os.path.basename(f) for f in task_files(1, context)] == \
+        ['P1_' + MORNING + '_data.csv', 'P1_' + AFTERNOON + '_data.csv', 'P1_' + MORNING + '_data.csv']
+    pipeline, _ = run(tmp_path, context)
+    memory = pipeline.load(1, 'task_data')['memory_task']
+    assert list(memory['session']) == [MORNING, MORNING, AFTERNOON]
+
+
+def test_handler_files_are_the_lumo_sessions_only(study):
+    tmp_path, context = study
+    data = tmp_path / 'data'
+    for name in ('1_' + EXPERIMENT_NAME + ' broadband NIRS_' + AFTERNOON + '.csv',  # broadbandNIRS.py
+                 '1_' + EXPERIMENT_NAME + '_' + MORNING + '_memory_usage.csv',  # Session reports
+                 '12_' + EXPERIMENT_NAME + '_' + MORNING + '.csv'):
+        write(data / name, 'trial\n0\n')
+    write(data / ('1_' + EXPERIMENT_NAME + '_' + AFTERNOON + '.csv'), 'trial\n0\n')
+    assert [os.path.basename(f) for f in handler_files(1, context)] == \
+        ['1_' + EXPERIMENT_NAME + '_' + MORNING + '.csv', '1_' + EXPERIMENT_NAME + '_' + AFTERNOON + '.csv']
@@ -0,0 +1,51 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'experiment'))
+from session_checkpoint import SessionCheckpoint
+
+
+def test_round_trip_restores_progress(tmp_path):
+    filepath = str(tmp_path / 'data' / 'P1_session_checkpoint.json')
+    checkpoint = SessionCheckpoint(filepath, 1)
+    checkpoint.save()
+    checkpoint.set_task_state('memory_task', {'k': 1, 'encoding_order': [2, 0, 1]})
+    checkpoint.complete_block('object_recognition', 0, [{'stimulus': 'a.png'}, {'stimulus': 'b.png'}])
+    checkpoint.complete_block('object_recognition', 1, [{'stimulus': 'c.png', 'onset': np.float64(0.5)}])
+    checkpoint.complete_task('object_recognition')
+    checkpoint.complete_block('memory_task', 0, [{'reaction_time': np.float64(0.61), 'response': np.int64(1)}])
+
+    resumed = SessionCheckpoint.load(filepath, '1')
+    assert resumed.is_complete('object_recognition') and not resumed.is_complete('memory_task')
+    assert resumed.next_block('object_recognition') == 2
+    assert resumed.next_block('memory_task') == 1
+    assert resumed.next_block('visual_stimulation') == 0
+    assert resumed.records('object_recognition') == [{'stimulus': 'a.png'}, {'stimulus': 'b.png'},
+                                                     {'stimulus': 'c.png', 'onset': 0.5}]
+    assert resumed.records('memory_task') == [{'reaction_time': 0.61, 'response': 1}]
+    assert resumed.task_state('memory_task') == {'k': 1, 'encoding_order': [2, 0, 1]}
+    assert not os.path.exists(filepath + '.tmp')
+
+
+def test_load_refuses_another_participants_checkpoint(tmp_path):
+    filepath = str(tmp_path / 'P1_session_checkpoint.json')
+    SessionCheckpoint(filepath, 1).save()
+    with pytest.raises(ValueError, match='belongs to participant 1'):
+        SessionCheckpoint.load(filepath, 2)
+
+
+def test_a_session_is_unfinished_until_it_ends(tmp_path):
+    filepath = str(tmp_path / 'P1_session_checkpoint.json')
+    assert not SessionCheckpoint.unfinished(filepath)
+    checkpoint = SessionCheckpoint(filepath, 1)
+    checkpoint.save()
+    checkpoint.complete_task('object_recognition')
+    assert SessionCheckpoint.unfinished(filepath)
+    checkpoint.finish()
+    assert not SessionCheckpoint.unfinished(filepath)
+    # Resuming a finished session (e.g. to add a task) makes it unfinished again until it ends
+    SessionCheckpoint.load(filepath, 1).save()
+    assert SessionCheckpoint.unfinished(filepath)
@@ -0,0 +1,65 @@
+import json
+import os
+import sys
+
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'experiment'))
+from session_checkpoint import SessionCheckpoint
+from session_rng import SessionRNG, participant_seed
+
+
+def draw(rng):
+    stimuli = pd.DataFrame({'stimulus': list('abcdefgh')})
+    return ([rng.jitter('object_recognition') for _ in range(5)],
+            rng.randint('memory_task', 0, 1),
+            list(rng.shuffle(stimuli, 'memory_task')['stimulus']))
+
+
+def test_the_same_seed_gives_the_same_plan():
+    assert draw(SessionRNG('12')) == draw(SessionRNG(12)) == draw(SessionRNG('3', seed=12))
+    assert draw(SessionRNG('12')) != draw(SessionRNG('13'))
+
+
+def test_participant_seeds():
+    assert participant_seed('P12') == participant_seed(' 12') == 12
+    assert participant_seed('pilot') == participant_seed('pilot') != participant_seed('pilot2')
+
+
+def test_tasks_draw_from_independent_streams():
+    rng = SessionRNG(5)
+    rng.jitter('object_recognition')
+    rng.randint('object_recognition', 0, 100)
+    fresh = SessionRNG(5)
+    assert [rng.jitter('memory_task') for _ in range(3)] == [fresh.jitter('memory_task') for _ in range(3)]
+
+
+def test_jitter_is_scaled_and_planned_beyond_the_first_draws():
+    rng = SessionRNG(7)
+    rng.plan_jitter('visual_stimulation', n=4)
+    values = [rng.jitter('visual_stimulation', scale=0.5) for _ in range(10)]
+    assert all(0 <= v < 0.5 for v in values)
+    assert len(set(values)) == 10
+
+
+def test_checkpoint_round_trip_continues_every_stream(tmp_path):
+    filepath = str(tmp_path / 'P4_session_checkpoint.json')
+    rng = SessionRNG(4, seed=99)
+    draw(rng)
+    SessionCheckpoint(filepath, 4, rng).save()
+    expected = draw(rng)
+
+    restored = SessionRNG(4)  # Seeded from the participant number until the checkpoint restores it
+    SessionCheckpoint.load(filepath, 4, restored)
+    assert restored.seed == 99
+    assert draw(restored) == expected
+
+
+def test_save_plan_records_the_seed_and_jitter(tmp_path):
+    rng = SessionRNG(8)
+    values = [rng.jitter('resting_state', scale=1.0) for _ in range(3)]
+    rng.save_plan(str(tmp_path / 'plan.json'))
+    with open(tmp_path / 'plan.json') as f:
+        plan = json.load(f)
+    assert plan['seed'] == 8
+    assert plan['jitter']['resting_state'][:3] == values
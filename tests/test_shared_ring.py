@@ -0,0 +1,57 @@
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'experiment'))
+from io_bridge import IOBridge
+from shared_ring import LENGTH, SharedRing
+
+
+@pytest.fixture
+def ring():
+    ring = SharedRing(capacity=64)
+    yield ring
+    ring.close()
+
+
+def test_messages_wrap_around_the_end_of_the_buffer(ring):
+    sent = [bytes([i]) * (10 + i) for i in range(40)]
+    received = []
+    for message in sent:
+        assert ring.put(message)
+        received.append(ring.get())
+    assert received == sent  # 40 messages of 10-49 bytes have wrapped the 64-byte buffer many times
+    assert len(ring) == 0 and ring.get() is None
+
+
+def test_a_full_ring_refuses_messages_until_read(ring):
+    message = b'x' * (32 - LENGTH.size)
+    assert ring.put(message) and ring.put(message)
+    assert not ring.put(b'y')
+    assert ring.get() == message
+    assert ring.put(b'y')
+    assert [ring.get(), ring.get(), ring.get()] == [message, b'y', None]
+
+
+def test_an_attached_ring_reads_what_the_owner_wrote(ring):
+    attached = SharedRing(ring.name)
+    assert ring.put(b'trigger')
+    assert attached.get() == b'trigger' and ring.get() is None
+    attached.close()
+
+
+def test_the_worker_writes_csvs_and_reports_errors_between_blocks(tmp_path):
+    bridge = IOBridge()
+    try:
+        records = [{'frame': i, 'value': i * 0.5} for i in range(3)]
+        bridge.write_csv(records, str(tmp_path / 'participant_data' / 'P1_data.csv'), index=False)
+        bridge.check()
+        assert pd.read_csv(tmp_path / 'participant_data' / 'P1_data.csv').to_dict('records') == records
+        (tmp_path / 'file').write_text('')
+        bridge.write_csv(records, str(tmp_path / 'file' / 'P1_data.csv'))
+        with pytest.raises(RuntimeError, match='I/O worker error'):
+            bridge.check()
+    finally:
+        bridge.close()
@@ -0,0 +1,58 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'analysis'))
+from signal_quality import SignalQuality, quality_indices, simulate_intensity
+
+FS = 10.0
+
+
+def test_indices_of_known_signals():
+    t = np.arange(600) / FS
+    heartbeat = np.sin(2 * np.pi * 1.2 * t)
+    epochs = np.empty((1, 3, 2, 600))
+    epochs[0, 0] = 1000 * (1 + np.array([0.01, 0.02])[:, None] * heartbeat)  # Same heartbeat at both wavelengths
+    epochs[0, 1] = 1000 * (1 + 0.01 * np.stack([heartbeat, -heartbeat]))  # In antiphase
+    epochs[0, 2] = 1000 * (1 + 0.05 * np.sin(2 * np.pi * 0.05 * t))  # Slow drift only
+    indices = quality_indices(epochs, FS)
+    np.testing.assert_allclose(indices['sci'][0, :2], [1, -1], atol=1e-3)
+    np.testing.assert_allclose(indices['cardiac_power'][0, :2], 1, atol=1e-3)
+    assert indices['cardiac_power'][0, 2] < 1e-3
+    # CV of a sinusoid of relative amplitude a is 100 a / sqrt(2) percent, at the worst wavelength
+    np.testing.assert_allclose(indices['cv'][0, 0], 100 * 0.02 / np.sqrt(2), rtol=1e-3)
+    assert indices['sci'].shape == indices['cv'].shape == (1, 3)
+
+
+def test_sampling_too_slow_for_the_cardiac_band_is_rejected():
+    with pytest.raises(ValueError, match='cannot resolve the cardiac band'):
+        quality_indices(np.ones((1, 1, 2, 100)), 4.0)
+
+
+def test_bad_channels_are_flagged_in_every_block():
+    data = simulate_intensity(8, 3000, FS, bad_channels=[2, 5], seed=0)
+    quality = SignalQuality(FS).assess(data, 'visual_stimulation', np.arange(5) * 140 + 20)
+    assert len(quality) == 5 * 8
+    assert set(quality.loc[~quality['good'], 'channel']) == {2, 5}
+    assert (quality.groupby('channel')['good'].sum()[[2, 5]] == 0).all()
+
+
+def test_resting_state_is_cut_into_segments():
+    quality = SignalQuality(FS)
+    data = simulate_intensity(2, 2000, FS, seed=1)
+    assert quality.epochs(data, 'resting_state', [100]).shape == (6, 2, 2, 300)
+    assert quality.epochs(data, 'resting_state', [100], offset=800).shape == (2, 2, 2, 300)
+    with pytest.raises(ValueError, match='shorter than one segment'):
+        quality.epochs(data, 'resting_state', [100], offset=300)
+
+
+def test_session_matrix_scores_every_task_and_block():
+    data = simulate_intensity(4, 3000, FS, bad_channels=[1], seed=2)
+    recordings = {'resting_state': {'data': data, 'onsets': [0]},
+                  'breath_holding': {'data': data, 'onsets': [200, 600, 1000]}}
+    quality, matrix = SignalQuality(FS).session(recordings)
+    assert matrix.shape == (4, 10 + 3)
+    assert (matrix.loc[[0, 2, 3]] == 1).all().all()
+    assert (matrix.loc[1] < 1).all()
@@ -0,0 +1,65 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'analysis'))
+from spectral_unmixing import SpectralUnmixer, load_extinction, simulate_recording, synthetic_extinction
+
+WAVELENGTHS = np.linspace(780, 900, 121)
+
+
+def test_unmixing_recovers_known_concentrations():
+    extinction = synthetic_extinction(WAVELENGTHS)
+    intensity, truth = simulate_recording(extinction, 4, 1000, dpf=5.0, separation=3.5, seed=0)
+    unmixer = SpectralUnmixer(extinction, dpf=5.0, separation=3.5)
+    unmixer.set_reference(intensity[..., :1])
+    result = unmixer.unmix(intensity)
+    assert result.shape == (4, 3, 1000)
+    np.testing.assert_allclose(result, truth - truth[..., :1], atol=1e-9)
+    # Single precision stays well within the size of the signals (~0.1-2uM)
+    result32 = SpectralUnmixer(extinction, dpf=5.0, separation=3.5, dtype=np.float32)
+    result32.set_reference(intensity[..., :1])
+    np.testing.assert_allclose(result32.unmix(intensity), truth - truth[..., :1], atol=1e-3)
+
+
+def test_the_wavelength_dependence_of_the_pathlength_is_corrected():
+    extinction = synthetic_extinction(WAVELENGTHS)
+    dependence = np.linspace(1.2, 0.8, len(WAVELENGTHS))
+    truth = np.array([1.0, -0.5, 0.1])  # uM
+    attenuation = (extinction @ truth) * dependence * 6.26 * 3.0 / 1000
+    intensity = np.stack([np.full(len(WAVELENGTHS), 1e4), 1e4 * 10 ** -attenuation], axis=-1)[None]
+    unmixer = SpectralUnmixer(extinction, wavelength_dependence=dependence)
+    unmixer.set_reference(intensity[..., :1])
+    np.testing.assert_allclose(unmixer.unmix(intensity)[0, :, 1], truth, atol=1e-9)
+
+
+def test_unmix_file_matches_unmixing_in_memory(tmp_path):
+    extinction = synthetic_extinction(WAVELENGTHS)
+    intensity, truth = simulate_recording(extinction, 2, 1000, seed=1)
+    np.save(tmp_path / 'intensity.npy', intensity)
+    unmixer = SpectralUnmixer(extinction)
+    result = unmixer.unmix_file(str(tmp_path / 'intensity.npy'), str(tmp_path / 'concentrations.npy'),
+                                chunk_samples=300, baseline_samples=10)
+    reference = SpectralUnmixer(extinction)
+    reference.set_reference(intensity[..., :10])
+    np.testing.assert_allclose(np.load(tmp_path / 'concentrations.npy'), reference.unmix(intensity))
+    np.testing.assert_allclose(result, truth - truth[..., :10].mean(axis=-1, keepdims=True), atol=1e-3)
+
+
+def test_unmixing_needs_a_reference_and_matching_wavelengths():
+    unmixer = SpectralUnmixer(synthetic_extinction(WAVELENGTHS))
+    with pytest.raises(RuntimeError, match='set_reference'):
+        unmixer.unmix(np.ones((1, 121, 5)))
+    unmixer.set_reference(np.ones((1, 121, 5)))
+    with pytest.raises(ValueError, match='Expected 121 wavelengths'):
+        unmixer.unmix(np.ones((1, 100, 5)))
+
+
+def test_extinction_spectra_are_interpolated_at_the_pixels(tmp_path):
+    (tmp_path / 'spectra.csv').write_text('wavelength,HbO2,HHb,oxCCO\n900,3,1,2\n700,1,3,0\n')
+    extinction = load_extinction(str(tmp_path / 'spectra.csv'), [700, 750, 800])
+    np.testing.assert_allclose(extinction, [[1, 3, 0], [1.5, 2.5, 0.5], [2, 2, 1]])
+    with pytest.raises(ValueError, match='do not cover'):
+        load_extinction(str(tmp_path / 'spectra.csv'), [650, 800])
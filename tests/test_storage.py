@@ -0,0 +1,62 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'experiment'))
+from storage import DEFAULT_CONFIG, Storage
+
+LEGACY_LUMO = DEFAULT_CONFIG['sites']['Lumo']
+
+
+def make_storage(tmp_path, cache_dir=None):
+    store = tmp_path / 'store'
+    for site in ('Lumo', 'Mini-CYRIL'):
+        (store / site / 'Instructions').mkdir(parents=True)
+        (store / site / 'Instructions' / 'a.png').write_bytes(site.encode())
+    config = {'sites': {site: str(store / site) for site in ('Lumo', 'Mini-CYRIL')},
+              'output_roots': {'Lumo': str(tmp_path / 'outputs')},
+              'cache_dir': cache_dir}
+    return Storage(config), store
+
+
+def test_resolve_rewrites_legacy_paths_to_the_configured_store(tmp_path):
+    storage, store = make_storage(tmp_path)
+    assert storage.resolve(LEGACY_LUMO + '/Instructions/a.png') == os.path.join(str(store / 'Lumo'),
+                                                                                'Instructions', 'a.png')
+    legacy_cyril = DEFAULT_CONFIG['sites']['Mini-CYRIL'] + '/Instructions/a.png'
+    assert storage.resolve(legacy_cyril) == os.path.join(str(store / 'Mini-CYRIL'), 'Instructions', 'a.png')
+
+
+def test_resolve_rewrites_legacy_and_store_paths_to_the_cache(tmp_path):
+    storage, store = make_storage(tmp_path, cache_dir=str(tmp_path / 'cache'))
+    cache = storage.stage('Lumo')
+    expected = os.path.join(cache, 'Instructions', 'a.png')
+    assert storage.resolve(LEGACY_LUMO + '/Instructions/a.png') == expected
+    assert storage.resolve(str(store / 'Lumo' / 'Instructions' / 'a.png')) == expected
+    assert open(expected, 'rb').read() == b'Lumo'
+
+
+def test_resolve_leaves_other_paths_unchanged(tmp_path):
+    storage, _ = make_storage(tmp_path)
+    assert storage.resolve('/elsewhere/a.png') == '/elsewhere/a.png'
+    assert storage.resolve(LEGACY_LUMO + ' old/a.png') == LEGACY_LUMO + ' old/a.png'
+
+
+def test_participant_data_is_created_under_the_output_root(tmp_path):
+    storage, store = make_storage(tmp_path)
+    folder = storage.participant_data('Lumo', 'memory_task')
+    assert folder == os.path.join(str(tmp_path / 'outputs'), 'memory_task', 'participant_data')
+    assert os.path.isdir(folder)
+    # Sites without an output root write next to their stimuli
+    assert storage.participant_data('Mini-CYRIL', 'breath_holding').startswith(str(store / 'Mini-CYRIL'))
+
+
+def test_checkpoints_are_kept_under_the_output_root_and_not_staged(tmp_path):
+    storage, store = make_storage(tmp_path, cache_dir=str(tmp_path / 'cache'))
+    folder = storage.checkpoints('Lumo')
+    assert folder == os.path.join(str(tmp_path / 'outputs'), 'checkpoints') and os.path.isdir(folder)
+    # Sites without an output root keep them in the store, which is never copied to the cache
+    (store / 'Mini-CYRIL' / 'checkpoints').mkdir()
+    (store / 'Mini-CYRIL' / 'checkpoints' / 'P1_broadband_checkpoint.json').write_text('{}')
+    cache = storage.stage('Mini-CYRIL')
+    assert storage.checkpoints('Mini-CYRIL') == os.path.join(str(store / 'Mini-CYRIL'), 'checkpoints')
+    assert not os.path.exists(os.path.join(cache, 'checkpoints'))
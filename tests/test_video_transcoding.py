@@ -0,0 +1,78 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'experiment'))
+import video_transcoding
+from storage import DEFAULT_CONFIG, Storage
+from video_transcoding import VideoCache, transcode
+
+
+def fake_transcode(args):
+    source, target = args[:2]
+    if 'broken' in source:
+        raise RuntimeError('ffmpeg failed: invalid data')
+    shutil.copyfile(source, target)
+    return source, {'cpu_ms_per_frame': 2.0}, {'cpu_ms_per_frame': 1.0}
+
+
+@pytest.fixture
+def site(tmp_path, monkeypatch):
+    monkeypatch.setattr(video_transcoding.shutil, 'which', lambda name: '/usr/bin/' + name)
+    monkeypatch.setattr(video_transcoding, '_transcode', fake_transcode)
+    folder = tmp_path / 'mismatched_negativity_task'
+    folder.mkdir()
+    for name in ('a', 'b', 'broken'):
+        (folder / (name + '.mp4')).write_bytes(name.encode() * 100)
+    (folder / 'MMN_movie_stimuli.csv').write_text('movie\n' + '\n'.join(str(folder / (n + '.mp4'))
+                                                                         for n in ('a', 'b', 'broken')) + '\n')
+    return tmp_path
+
+
+def make_storage(root):
+    return Storage({'sites': {'Lumo': str(root), 'Mini-CYRIL': str(root / 'Mini-CYRIL')}})
+
+
+def test_failed_jobs_are_reported_after_the_others_are_recorded(site):
+    with pytest.raises(RuntimeError, match='1 of 3'):
+        transcode(make_storage(site), workers=2)
+    cache = VideoCache(str(site))
+    for name in ('a', 'b'):
+        source = str(site / 'mismatched_negativity_task' / (name + '.mp4'))
+        assert cache.resolve(source) != source
+    broken = str(site / 'mismatched_negativity_task' / 'broken.mp4')
+    assert cache.resolve(broken) == broken
+
+
+def test_edited_sources_are_not_replaced_by_old_transcodes(site):
+    with pytest.raises(RuntimeError):
+        transcode(make_storage(site), workers=1)
+    source = site / 'mismatched_negativity_task' / 'a.mp4'
+    source.write_bytes(b'edited')
+    assert VideoCache(str(site)).resolve(str(source)) == str(source)
+
+
+def test_corrupted_transcodes_are_not_used(site):
+    with pytest.raises(RuntimeError):
+        transcode(make_storage(site), workers=1)
+    source = str(site / 'mismatched_negativity_task' / 'a.mp4')
+    target = VideoCache(str(site)).resolve(source)
+    with open(target, 'ab') as f:
+        f.write(b'x')
+    assert VideoCache(str(site)).resolve(source) == source
+
+
+def test_legacy_movie_paths_are_resolved_and_keyed_by_site(site):
+    # The MMN movie csv stores the movies under the original piloting machine's folder
+    legacy = DEFAULT_CONFIG['sites']['Lumo'] + '/mismatched_negativity_task/'
+    (site / 'mismatched_negativity_task' / 'MMN_movie_stimuli.csv').write_text('movie\n' + legacy + 'a.mp4\n' +
+                                                                             legacy + 'b.mp4\n')
+    storage = make_storage(site)
+    manifest = transcode(storage, workers=1)
+    assert sorted(manifest) == [os.path.join('mismatched_negativity_task', name + '.mp4') for name in ('a', 'b')]
+    # Looked up as the task plays it
+    source = str(site / 'mismatched_negativity_task' / 'a.mp4')
+    target = VideoCache(str(site)).resolve(storage.resolve(legacy + 'a.mp4'))
+    assert target != source and open(target, 'rb').read() == open(source, 'rb').read()